@@ -0,0 +1,213 @@
+import numpy as np
+import pandas as pd
+
+# Results at least this old count as previous values for the D value
+TWO_DAYS = np.timedelta64(2, "D")
+SECONDS_IN_A_DAY = 86400
+# Upper bound on the number of values gathered at once for the medians
+MEDIAN_CHUNK_SIZE = 1 << 22
+
+BATCH_FEATURES_COLUMNS = [
+    "C1",
+    "RV1",
+    "RV1_ratio",
+    "RV2",
+    "RV2_ratio",
+    "change_within_48hrs",
+    "D",
+]
+
+
+def to_datetime64(dates):
+    """
+    Converts creatinine result dates in either the history.csv ("%Y-%m-%d %H:%M:%S")
+    or the LIMS ("%Y%m%d%H%M%S") format to a datetime64[s] array.
+
+    Args:
+    - dates (iterable): The dates, as strings or integers.
+
+    Returns:
+    - np.ndarray: The dates as datetime64[s].
+    """
+    dates = pd.Series(dates, dtype=str)
+    is_lims = dates.str.isdigit()
+    parsed = pd.Series(pd.NaT, index=dates.index, dtype="datetime64[ns]")
+    parsed[~is_lims] = pd.to_datetime(dates[~is_lims], format="%Y-%m-%d %H:%M:%S")
+    parsed[is_lims] = pd.to_datetime(dates[is_lims], format="%Y%m%d%H%M%S")
+    return parsed.to_numpy().astype("datetime64[s]")
+
+
+def compute_features_batch(
+    event_mrns,
+    event_dates,
+    event_results,
+    history_mrns,
+    history_dates,
+    history_results,
+    rv_from_history=False,
+):
+    """
+    Computes the creatinine features of many test results in one vectorised pass.
+
+    Every event sees the stored history of its patient plus the events of the same
+    patient that come before it, as the live loop would when replaying them in date
+    order. Features are the same as `D_value_compute` and `RV_compute` given those
+    previous results in date order. Events without previous results get the
+    features the live loop uses for patients without a history (C1 set, the rest
+    0), and events whose latest previous result is more than a year away, for
+    which `RV_compute` returns 0, get 0 for C1 and the RV values.
+
+    Args:
+    - event_mrns (np.ndarray): MRN of each event.
+    - event_dates (np.ndarray): datetime64 date of each event.
+    - event_results (np.ndarray): Creatinine result of each event.
+    - history_mrns (np.ndarray): MRN of each stored result.
+    - history_dates (np.ndarray): datetime64 date of each stored result.
+    - history_results (np.ndarray): Value of each stored result.
+    - rv_from_history (bool): Date the RV features from the latest stored result
+      when the patient has one, rather than from the latest previous result, as
+      the live loop does: it hands LIMS results back before the stored ones, and
+      `RV_compute` looks at the last one.
+
+    Returns:
+    - pd.DataFrame: One row per event, in input order, with BATCH_FEATURES_COLUMNS.
+    """
+    event_count = len(event_mrns)
+    mrns = np.concatenate([np.asarray(history_mrns), np.asarray(event_mrns)])
+    times = np.concatenate(
+        [
+            np.asarray(history_dates, dtype="datetime64[s]"),
+            np.asarray(event_dates, dtype="datetime64[s]"),
+        ]
+    ).astype(np.int64)
+    values = np.concatenate(
+        [
+            np.asarray(history_results, dtype=np.float64),
+            np.asarray(event_results, dtype=np.float64),
+        ]
+    )
+    # stored results come before events at the same time, events keep their order
+    is_event = np.zeros(len(mrns), dtype=bool)
+    is_event[len(mrns) - event_count :] = True
+    _, codes = np.unique(mrns, return_inverse=True)
+    order = np.lexsort((np.arange(len(mrns)), is_event, times, codes))
+    codes, times, values = codes[order], times[order], values[order]
+
+    # position of every row in the sorted table and the start of its patient
+    positions = np.arange(len(codes))
+    group_starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    starts = group_starts[np.cumsum(np.r_[True, codes[1:] != codes[:-1]]) - 1]
+    prefix_minimums = pd.Series(values).groupby(codes).cummin().to_numpy()
+
+    # the events, in sorted order, and the rows before them
+    event_rows = positions[is_event[order]]
+    event_index = order[event_rows] - (len(mrns) - event_count)
+    start = starts[event_rows]
+    previous_count = event_rows - start
+    has_previous = previous_count > 0
+    latest_result = values[event_rows]
+    event_time = times[event_rows]
+
+    # D: compare with the lowest result at least 48 hours old
+    two_days = TWO_DAYS.astype("timedelta64[s]").astype(np.int64)
+    base = times.min() - two_days if len(times) else 0
+    span = (times.max() - base + 1) if len(times) else 1
+    keys = codes.astype(np.int64) * span + (times - base)
+    cutoff_keys = codes[event_rows].astype(np.int64) * span + (
+        event_time - two_days - base
+    )
+    old_count = np.searchsorted(keys, cutoff_keys, side="right") - start
+    has_old = old_count > 0
+    minimum_old = prefix_minimums[np.where(has_old, start + old_count - 1, 0)]
+    D = np.where(has_old, latest_result - minimum_old, 0.0)
+    change = old_count > 1
+
+    # RV: minimum or median of all the previous results, depending on how far
+    # away the latest previous result is
+    latest_previous = np.where(has_previous, event_rows - 1, 0)
+    if rv_from_history:
+        # the latest stored row up to every row, from the patient's rows only
+        stored = np.where(is_event[order], -1, positions)
+        latest_stored = np.maximum.accumulate(stored)[latest_previous]
+        latest_previous = np.where(
+            has_previous & (latest_stored >= start), latest_stored, latest_previous
+        )
+    delta = times[latest_previous] - event_time
+    days = np.floor_divide(delta, SECONDS_IN_A_DAY)
+    diff = np.abs((delta - days * SECONDS_IN_A_DAY) / SECONDS_IN_A_DAY + days)
+    within_week = has_previous & (diff <= 7)
+    within_year = has_previous & ~within_week & (diff <= 365)
+    minimum = prefix_minimums[latest_previous]
+    median = _prefix_medians(values, start, previous_count, within_year)
+
+    C1 = np.where(has_previous & ~within_week & ~within_year, 0.0, latest_result)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        RV1 = np.where(within_week, minimum, 0.0)
+        RV1_ratio = np.where(within_week, latest_result / minimum, 0.0)
+        RV2 = np.where(within_year, median, 0.0)
+        RV2_ratio = np.where(within_year, latest_result / median, 0.0)
+
+    features = pd.DataFrame(
+        {
+            "C1": C1,
+            "RV1": RV1,
+            "RV1_ratio": RV1_ratio,
+            "RV2": RV2,
+            "RV2_ratio": RV2_ratio,
+            "change_within_48hrs": change,
+            "D": D,
+        },
+        index=event_index,
+    )
+    return features.sort_index().reset_index(drop=True)
+
+
+def _prefix_medians(values, starts, counts, needed):
+    """
+    Median of values[start:start + count] for every (start, count) pair where
+    `needed` is set, as computed by `statistics.median`. Rows are padded to the
+    longest prefix and sorted in chunks.
+    """
+    medians = np.zeros(len(starts))
+    rows = np.flatnonzero(needed)
+    if len(rows) == 0:
+        return medians
+    width = int(counts[rows].max())
+    chunk = max(1, MEDIAN_CHUNK_SIZE // width)
+    columns = np.arange(width)
+    for i in range(0, len(rows), chunk):
+        block = rows[i : i + chunk]
+        count = counts[block]
+        index = starts[block, None] + columns[None, :]
+        padded = np.where(
+            columns[None, :] < count[:, None],
+            values[np.minimum(index, len(values) - 1)],
+            np.inf,
+        )
+        padded.sort(axis=1)
+        lower = np.take_along_axis(padded, ((count - 1) // 2)[:, None], axis=1)[:, 0]
+        upper = np.take_along_axis(padded, (count // 2)[:, None], axis=1)[:, 0]
+        medians[block] = (lower + upper) / 2
+    return medians
+
+
+def history_features(rows):
+    """
+    Computes the features of every result in a history, replayed in date order as
+    if each one arrived from LIMS.
+
+    Args:
+    - rows (iterable): (mrn, date, result) triples, e.g. from `read_history_csv`.
+
+    Returns:
+    - pd.DataFrame: One row per result, in input order, with BATCH_FEATURES_COLUMNS.
+    """
+    mrns, dates, results = zip(*rows)
+    return compute_features_batch(
+        np.array(mrns),
+        to_datetime64(dates),
+        np.array(results),
+        np.array([], dtype=str),
+        np.array([], dtype="datetime64[s]"),
+        np.array([], dtype=np.float64),
+    )
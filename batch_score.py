@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Scores a recorded message stream offline, without the live loop: the patients
+are split into partitions by MRN, and every partition, in its own process, parses
+its messages, replays its admissions and discharges, reads the history of its
+patients, computes the features of its LIMS results with `compute_features_batch`
+and predicts them all at once. The predictions are written as CSV, and scored against the AKI
+labels when they are given:
+
+    ./batch_score.py --history data/history.csv --messages messages.mllp --labels aki.csv
+
+Predictions are the ones a detector started on the history alone would make for
+the same messages, with results of a patient arriving in date order.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from batch_features import BATCH_FEATURES_COLUMNS, compute_features_batch, to_datetime64
+from compiled_tree import load_compiled_tree
+from constants import (
+    DEFAULT_AGE,
+    DEFAULT_SEX,
+    FEATURES_COLUMNS,
+    HISTORY_DATE_FORMAT,
+    LIMS_DATE_FORMAT,
+)
+from hl7_parser import message_mrn, parse_message
+from simulator import read_hl7_messages
+from utils import label_encode, read_history_csv, shard_of
+
+PREDICTIONS_COLUMNS = ["mrn", "date", "result"] + FEATURES_COLUMNS + ["aki"]
+
+
+def read_labels(path):
+    """
+    Reads AKI labels in the aki.csv format as (mrn, date) with the date in the
+    LIMS format, as pages carry it.
+    """
+    labels = set()
+    with open(path) as file:
+        next(file)
+        for line in file:
+            mrn, date = line.strip().split(",")
+            date = datetime.strptime(date, HISTORY_DATE_FORMAT).strftime(LIMS_DATE_FORMAT)
+            labels.add((mrn, date))
+    return labels
+
+
+def f3_score(pages, labels):
+    """
+    Precision, recall and F3 of a set of (mrn, date) pages against the labels.
+    """
+    true_positives = len(pages & labels)
+    precision = true_positives / len(pages) if pages else 0.0
+    recall = true_positives / len(labels) if labels else 0.0
+    if precision == 0 and recall == 0:
+        f3 = 0.0
+    else:
+        f3 = 10 * precision * recall / (9 * precision + recall)
+    return {"f3": f3, "precision": precision, "recall": recall}
+
+
+def partition_messages(messages, partitions):
+    """
+    Splits the messages by the partition of their MRN, keeping their position in
+    the stream.
+    Returns:
+        - routed {list}: the (position, message) pairs of every partition
+    """
+    if partitions == 1:
+        return [list(enumerate(messages))]
+    routed = [[] for _ in range(partitions)]
+    for position, hl7_data in enumerate(messages):
+        try:
+            index = shard_of(message_mrn(hl7_data), partitions)
+        except Exception:
+            # reported as failed when the partition parses it
+            index = 0
+        routed[index].append((position, hl7_data))
+    return routed
+
+
+def score_partition(messages, history_path, model_path):
+    """
+    Scores the LIMS messages of one partition. Patients are admitted and
+    discharged as the messages say; a result for a patient who is not admitted is
+    predicted negative and admits them with the default age and sex, as the live
+    loop does. Every result counts towards the features of the later ones.
+    Args:
+        - messages {list}: (position, message) pairs, in stream order
+        - history_path {str}: path to history.csv
+        - model_path {str}: path to the joblib decision tree
+    Returns:
+        - predictions {pd.DataFrame}: PREDICTIONS_COLUMNS of every LIMS message,
+          with the features as the model sees them, indexed by its position in
+          the stream
+        - failed {int}: the number of messages that could not be parsed
+    """
+    patients = {}
+    positions, mrns, dates, results, ages, sexes, admitted = [], [], [], [], [], [], []
+    failed = 0
+    for position, hl7_data in messages:
+        try:
+            category, mrn, data = parse_message(hl7_data)
+        except Exception:
+            failed += 1
+            continue
+        if category == "PAS-admit":
+            # a patient admitted twice keeps their first record
+            patients.setdefault(mrn, (int(data[0]), str(data[1])))
+        elif category == "PAS-discharge":
+            patients.pop(mrn, None)
+        elif category == "LIMS":
+            patient = patients.get(mrn)
+            admitted.append(patient is not None)
+            if patient is None:
+                patient = patients[mrn] = (DEFAULT_AGE, DEFAULT_SEX)
+            positions.append(position)
+            mrns.append(mrn)
+            dates.append(data[0])
+            results.append(data[1])
+            ages.append(patient[0])
+            sexes.append(label_encode(patient[1]))
+    if not positions:
+        return pd.DataFrame(columns=PREDICTIONS_COLUMNS), failed
+
+    # only the history of the patients with results matters
+    patients = set(mrns)
+    history = [row for row in read_history_csv(history_path) if row[0] in patients]
+    if history:
+        history_mrns, history_dates, history_results = zip(*history)
+        history_dates = to_datetime64(history_dates)
+    else:
+        history_mrns, history_dates, history_results = [], np.array([], dtype="datetime64[s]"), []
+    features = compute_features_batch(
+        np.array(mrns),
+        to_datetime64(dates),
+        np.array(results, dtype=np.float64),
+        np.array(history_mrns, dtype=str),
+        history_dates,
+        np.array(history_results, dtype=np.float64),
+        rv_from_history=True,
+    )
+    predictions = pd.DataFrame(
+        {"mrn": mrns, "date": dates, "result": results, "age": ages, "sex": sexes},
+        index=positions,
+    )
+    for column in BATCH_FEATURES_COLUMNS:
+        predictions[column] = features[column].to_numpy()
+    tree = load_compiled_tree(model_path)
+    labels = tree.predict_many(predictions[FEATURES_COLUMNS].to_numpy(dtype=np.float64))
+    predictions["aki"] = np.where(admitted, labels, "n")
+    return predictions, failed
+
+
+def batch_score(messages, history_path, model_path, partitions):
+    """
+    Scores every LIMS message of a stream, `partitions` processes at a time.
+    Args:
+        - messages {list}: the HL7 messages, without their MLLP framing
+        - history_path {str}: path to history.csv
+        - model_path {str}: path to the joblib decision tree
+        - partitions {int}: number of MRN partitions, scored in parallel
+    Returns:
+        - predictions {pd.DataFrame}: PREDICTIONS_COLUMNS of every LIMS message,
+          in stream order
+        - failed {int}: the number of messages that could not be parsed
+    """
+    work = [
+        (partition, history_path, model_path)
+        for partition in partition_messages(messages, partitions)
+    ]
+    if partitions == 1:
+        scored = [score_partition(*work[0])]
+    else:
+        with multiprocessing.get_context("spawn").Pool(partitions) as pool:
+            scored = pool.starmap(score_partition, work)
+    frames = [frame for frame, _ in scored if len(frame)]
+    if frames:
+        predictions = pd.concat(frames)
+    else:
+        predictions = pd.DataFrame(columns=PREDICTIONS_COLUMNS)
+    return (
+        predictions.sort_index().reset_index(drop=True),
+        sum(failed for _, failed in scored),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--history", default=os.environ.get("HISTORY_PATH", "data/history.csv")
+    )
+    parser.add_argument("--messages", required=True, help="MLLP file of the stream")
+    parser.add_argument("--labels", help="AKI labels of the stream, in the aki.csv format")
+    parser.add_argument("--model", default="dt_model.joblib")
+    parser.add_argument("--output", default="predictions.csv")
+    parser.add_argument(
+        "--partitions",
+        default=os.cpu_count(),
+        type=int,
+        help="Number of MRN partitions, scored in parallel",
+    )
+    flags = parser.parse_args()
+
+    start_time = time.perf_counter()
+    messages = read_hl7_messages(flags.messages)
+    predictions, failed = batch_score(
+        messages, flags.history, flags.model, max(flags.partitions, 1)
+    )
+    predictions.to_csv(flags.output, index=False)
+    pages = set(
+        zip(
+            predictions["mrn"][predictions["aki"] == "y"],
+            predictions["date"][predictions["aki"] == "y"],
+        )
+    )
+    summary = {
+        "messages": len(messages),
+        "lims_messages": len(predictions),
+        "failed_messages": failed,
+        "pages": len(pages),
+        "seconds": time.perf_counter() - start_time,
+    }
+    if flags.labels:
+        labels = read_labels(flags.labels)
+        summary["labels"] = len(labels)
+        summary.update(f3_score(pages, labels))
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+Throughput of the HL7 parsing paths on synthetic admit, LIMS and discharge
+messages built from history.csv.
+
+    python -m benchmarks.hl7_parsing [--history data/history.csv] [--messages 30000]
+"""
+import argparse
+import time
+from fixtures import synthetic_messages
+from hl7_parser import parse_message
+from utils import parse_hl7_message, parse_system_message
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history", default="data/history.csv")
+    parser.add_argument("--messages", default=30000, type=int)
+    flags = parser.parse_args()
+
+    messages = synthetic_messages(flags.history, flags.messages)
+    paths = {
+        "hl7.parse": lambda data: parse_system_message(parse_hl7_message(data)),
+        "bytes": parse_message,
+    }
+    for name, parse in paths.items():
+        start = time.perf_counter()
+        for data in messages:
+            parse(data)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:>10}: {len(messages) / elapsed:10.0f} messages/s  "
+            f"{elapsed / len(messages) * 1e6:8.1f}us per message"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Time to load a history into a fresh database, and the memory it takes,
+e.g. on a history written by benchmarks.workload:
+
+    python -m benchmarks.workload --output-dir /tmp/workload --patients 1000000 --messages 10
+    python -m benchmarks.load_history --history /tmp/workload/history.csv
+    python -m benchmarks.load_history --history /tmp/workload/history.csv --backend columnar
+
+The columnar store is also reopened, which maps its files instead of loading them.
+"""
+import argparse
+import json
+import os
+import resource
+import tempfile
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history", default="data/history.csv")
+    parser.add_argument("--persistence-mode", default="journal")
+    parser.add_argument("--backend", default="sqlite", choices=("sqlite", "columnar"))
+    flags = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        # the state paths are read from the environment when constants is imported
+        os.environ["STATE_DIR"] = state_dir
+        from storage import open_database
+        from utils import read_history_csv
+
+        start = time.perf_counter()
+        rows = sum(1 for _ in read_history_csv(flags.history))
+        parse_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        db = open_database(flags.backend, flags.history, flags.persistence_mode)
+        load_seconds = time.perf_counter() - start
+        db.close()
+        load_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+        reopen_seconds = None
+        if flags.backend == "columnar":
+            start = time.perf_counter()
+            db = open_database(flags.backend, flags.history, flags.persistence_mode)
+            reopen_seconds = time.perf_counter() - start
+            db.close()
+
+    result = {
+        "history": flags.history,
+        "backend": flags.backend,
+        "rows": rows,
+        "parse_seconds": parse_seconds,
+        "load_seconds": load_seconds,
+        "rows_per_second": rows / load_seconds,
+        "reopen_seconds": reopen_seconds,
+        "max_rss_bytes": load_rss,
+    }
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
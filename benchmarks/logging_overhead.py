@@ -0,0 +1,87 @@
+"""
+Per-message overhead of the scoring stage's logging, at each level, against the
+print() calls it replaced. Every message makes the log calls a LIMS message makes
+in main.score, on synthetic LIMS messages built from history.csv, with the
+records written to os.devnull by the listener thread.
+
+    python -m benchmarks.logging_overhead [--history data/history.csv] [--messages 50000]
+
+"hot path" is the time the calls take on the calling thread, "drained" adds the
+time until the listener has written every queued record.
+"""
+import argparse
+import contextlib
+import logging
+import os
+import time
+from datetime import datetime
+from benchmarks.workload import lims_message
+from hl7_parser import parse_message
+from logs import configure_logging, stop_logging
+from utils import read_history_csv
+
+logger = logging.getLogger("main")
+
+
+def parsed_messages(path, count):
+    messages = []
+    for mrn, date, result in read_history_csv(path):
+        date = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        messages.append(parse_message(lims_message(mrn, date, result)))
+        if len(messages) >= count:
+            break
+    return messages
+
+
+def log_message(category, mrn, data):
+    logger.debug("Parsed values: %s %s %s", category, mrn, data)
+    logger.debug("Message from LIMS! Retreiving Patient History...")
+    logger.debug("Patient History found!")
+    logger.debug("Features created, calling DT!")
+
+
+def print_message(category, mrn, data):
+    # what the scoring stage printed before it logged
+    print("Parsed values: ", category, mrn, data)
+    print("Message from LIMS! Retreiving Patient History...")
+    print("Patient History found!")
+    print("Features created...")
+    print("Calling DT!")
+    print("-" * 80)
+
+
+def measure(messages, handle):
+    start = time.perf_counter()
+    for category, mrn, data in messages:
+        handle(category, mrn, data)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history", default="data/history.csv")
+    parser.add_argument("--messages", default=50000, type=int)
+    flags = parser.parse_args()
+
+    messages = parsed_messages(flags.history, flags.messages)
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull):
+            elapsed = measure(messages, print_message)
+        print(
+            f"{'print':>8}: {elapsed / len(messages) * 1e6:8.2f}us per message hot path "
+            f"{elapsed / len(messages) * 1e6:8.2f}us drained"
+        )
+        for level in ["DEBUG", "INFO", "WARNING"]:
+            configure_logging(level, "text", devnull)
+            start = time.perf_counter()
+            elapsed = measure(messages, log_message)
+            stop_logging()
+            drained = time.perf_counter() - start
+            print(
+                f"{level:>8}: {elapsed / len(messages) * 1e6:8.2f}us per message hot path "
+                f"{drained / len(messages) * 1e6:8.2f}us drained"
+            )
+
+
+if __name__ == "__main__":
+    main()
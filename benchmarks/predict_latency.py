@@ -0,0 +1,60 @@
+"""
+Microbenchmark of the per-call latency of the DT prediction paths on feature rows
+derived from history.csv.
+
+    python -m benchmarks.predict_latency [--history data/history.csv] [--calls 5000]
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from joblib import load
+from constants import DT_MODEL_PATH, FEATURES_COLUMNS
+from compiled_tree import CompiledDecisionTree
+from fixtures import history_feature_rows
+from utils import predict_with_dt
+
+
+def time_calls(predict, rows):
+    """
+    Time every call of `predict` over the rows, returns the latencies in seconds.
+    """
+    latencies = np.empty(len(rows))
+    for i, row in enumerate(rows):
+        start = time.perf_counter()
+        predict(row)
+        latencies[i] = time.perf_counter() - start
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--history", default="data/history.csv")
+    parser.add_argument("--calls", default=5000, type=int)
+    flags = parser.parse_args()
+
+    dt_model = load(DT_MODEL_PATH)
+    rows = history_feature_rows(flags.history).values.tolist()[: flags.calls]
+    paths = {
+        "dataframe": lambda row: predict_with_dt(
+            dt_model, pd.DataFrame([row], columns=FEATURES_COLUMNS)
+        ),
+        "compiled": CompiledDecisionTree.from_model(dt_model).predict,
+    }
+    for name, predict in paths.items():
+        latencies = time_calls(predict, rows) * 1e6
+        print(
+            f"{name:>10}: mean {latencies.mean():8.1f}us  "
+            f"p50 {np.percentile(latencies, 50):8.1f}us  "
+            f"p99 {np.percentile(latencies, 99):8.1f}us"
+        )
+    # amortised cost per row of the batch path
+    compiled = CompiledDecisionTree.from_model(dt_model)
+    start = time.perf_counter()
+    compiled.predict_many(np.array(rows))
+    per_row = (time.perf_counter() - start) / len(rows) * 1e6
+    print(f"{'batch':>10}: {per_row:8.2f}us per row over {len(rows)} rows")
+
+
+if __name__ == "__main__":
+    main()
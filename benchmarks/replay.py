@@ -0,0 +1,438 @@
+"""
+End-to-end replay benchmark: runs main.py as a subprocess against an in-process
+MLLP server and pager, replays a message stream the way simulator.py does (one
+message at a time, waiting for its ACK) and writes the results as JSON.
+
+    python -m benchmarks.replay --output replay.json [--messages 5000 --patients 500 ...]
+    python -m benchmarks.replay --mllp-file messages.mllp --history data/history.csv --labels aki.csv
+    python -m benchmarks.replay --connections 4 --shards 4
+    python -m benchmarks.replay --in-flight 32 --group-commit-window 0.002
+
+Reports throughput, ACK round trip times, page latencies (from sending a LIMS
+message to its page reaching the pager), the detector's RSS (from /proc, so Linux
+only), its startup time and time to the first ACK, and the F3 score of the pages
+against the labels. With --restart the detector is started again on the state
+the replay left, to measure the time to the first ACK after a restart. With
+--in-flight the messages are sent without waiting for the ACK of the previous
+ones, as a high-rate feed would, so the detector can group commit them.
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from benchmarks.workload import (
+    generate_workload,
+    write_history_csv,
+    INTERVAL_DISTRIBUTIONS,
+)
+from batch_score import read_labels, f3_score
+from constants import MLLP_START_CHAR, MLLP_END_CHAR
+from hl7_parser import parse_message, message_mrn
+from simulator import read_hl7_messages, parse_mllp_messages, verify_ack
+from utils import shard_of
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class PageRecorder(BaseHTTPRequestHandler):
+    """
+    Pager that accepts every page and records when it arrived.
+    """
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        mrn, date = body.split(",")
+        with self.server.lock:
+            self.server.pages.append((mrn, date, time.perf_counter()))
+        self.send_response(200)
+        self.send_header("Content-Length", "3")
+        self.end_headers()
+        self.wfile.write(b"ok\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+class RSSSampler(threading.Thread):
+    """
+    Samples the resident set size of a process and its children until it exits.
+    """
+
+    def __init__(self, pid, interval=0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+        self.last = 0
+
+    def process_tree(self, pid):
+        pids = [pid]
+        try:
+            with open(f"/proc/{pid}/task/{pid}/children") as file:
+                for child in file.read().split():
+                    pids += self.process_tree(int(child))
+        except OSError:
+            pass
+        return pids
+
+    def read_rss(self, pid):
+        try:
+            with open(f"/proc/{pid}/status") as file:
+                for line in file:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            return None
+        return None
+
+    def run(self):
+        while True:
+            rss = self.read_rss(self.pid)
+            if rss is None:
+                return
+            for child in self.process_tree(self.pid)[1:]:
+                rss += self.read_rss(child) or 0
+            self.last = rss
+            self.peak = max(self.peak, rss)
+            time.sleep(self.interval)
+
+
+def percentiles(values):
+    """
+    Summary of a list of latencies in seconds, in milliseconds.
+    """
+    if len(values) == 0:
+        return None
+    values = np.asarray(values) * 1000
+    return {
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max()),
+    }
+
+
+def receive_acks(client, buffer):
+    """
+    Waits for the next ACKs on the connection. Returns how many arrived and the
+    bytes received after them.
+    """
+    received = []
+    while not received:
+        data = client.recv(4096)
+        if not data:
+            raise ConnectionError("detector closed the connection")
+        buffer += data
+        received, buffer = parse_mllp_messages(buffer, "detector")
+    for ack in received:
+        acked, error = verify_ack([ack])
+        if error or not acked:
+            raise ConnectionError(f"message not acknowledged: {error}")
+    return len(received), buffer
+
+
+def send_stream(client, stream, ack_rtts, sent_at, in_flight=1):
+    """
+    Sends the messages on a connection, with up to `in_flight` of them waiting
+    for their ACK; with 1 each ACK is waited for before sending the next message.
+    """
+    buffer = b""
+    waiting = collections.deque()
+
+    def receive():
+        nonlocal buffer
+        count, buffer = receive_acks(client, buffer)
+        acked_at = time.perf_counter()
+        for _ in range(count):
+            ack_rtts.append(acked_at - waiting.popleft())
+
+    for message in stream:
+        while len(waiting) >= in_flight:
+            receive()
+        category, mrn, data = parse_message(message)
+        start = time.perf_counter()
+        if category == "LIMS":
+            sent_at.setdefault((mrn, data[0]), start)
+        client.sendall(MLLP_START_CHAR + message + MLLP_END_CHAR)
+        waiting.append(start)
+    while waiting:
+        receive()
+
+
+def start_detector(listeners, pager, history_path, state_dir, persistence_mode, shards, log_path):
+    """
+    Runs main.py against the MLLP `listeners` and the `pager`, logging to `log_path`.
+    """
+    env = dict(
+        os.environ,
+        MLLP_ADDRESS=",".join(
+            f"localhost:{listener.getsockname()[1]}" for listener in listeners
+        ),
+        PAGER_ADDRESS=f"localhost:{pager.server_address[1]}",
+        HISTORY_PATH=history_path,
+        STATE_DIR=state_dir,
+        PERSISTENCE_MODE=persistence_mode,
+        SHARDS=str(shards),
+    )
+    with open(log_path, "a") as log:
+        return subprocess.Popen(
+            [sys.executable, "main.py"], cwd=REPO_DIR, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+
+
+def stop_detector(detector):
+    detector.send_signal(signal.SIGTERM)
+    try:
+        detector.wait(60)
+    except subprocess.TimeoutExpired:
+        detector.kill()
+
+
+def measure_restart(message, listeners, pager, history_path, state_dir, persistence_mode, shards, log_path):
+    """
+    Starts a detector again on the state a previous one left, and measures the
+    time from starting it to its connections and to the ACK of `message`, sent
+    on the first one.
+    """
+    started = time.perf_counter()
+    detector = start_detector(
+        listeners, pager, history_path, state_dir, persistence_mode, shards, log_path
+    )
+    clients = []
+    try:
+        clients = [listener.accept()[0] for listener in listeners]
+        connected_seconds = time.perf_counter() - started
+        clients[0].sendall(MLLP_START_CHAR + message + MLLP_END_CHAR)
+        receive_acks(clients[0], b"")
+        first_ack_seconds = time.perf_counter() - started
+    finally:
+        for client in clients:
+            client.close()
+        stop_detector(detector)
+    return {"startup_seconds": connected_seconds, "first_ack_seconds": first_ack_seconds}
+
+
+def replay(
+    stream, history_path, labels, state_dir, persistence_mode, drain, log_path,
+    connections=1, shards=1, restart=False, in_flight=1,
+):
+    """
+    Replays the stream against a new detector and measures it. With several
+    connections the stream is split between them by MRN, so the messages of a
+    patient keep their order, and they are replayed concurrently. With `restart`
+    the time to the first ACK of a detector restarted on the state the replay
+    left is measured too.
+    """
+    pager = ThreadingHTTPServer(("localhost", 0), PageRecorder)
+    pager.lock = threading.Lock()
+    pager.pages = []
+    threading.Thread(target=pager.serve_forever, daemon=True).start()
+    listeners = []
+    for _ in range(connections):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("localhost", 0))
+        listener.listen(1)
+        listeners.append(listener)
+    streams = [[] for _ in range(connections)]
+    for message in stream:
+        streams[shard_of(message_mrn(message), connections)].append(message)
+
+    started = time.perf_counter()
+    open(log_path, "w").close()
+    detector = start_detector(
+        listeners, pager, history_path, state_dir, persistence_mode, shards, log_path
+    )
+    sampler = RSSSampler(detector.pid)
+    sampler.start()
+    clients = []
+    try:
+        clients = [listener.accept()[0] for listener in listeners]
+        startup_seconds = time.perf_counter() - started
+        rss_after_startup = sampler.last
+
+        ack_rtts = [[] for _ in range(connections)]
+        sent_at = [{} for _ in range(connections)]
+        senders = [
+            threading.Thread(
+                target=send_stream, args=(clients[i], streams[i], ack_rtts[i], sent_at[i], in_flight)
+            )
+            for i in range(connections)
+        ]
+        replay_started = time.perf_counter()
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+        replay_seconds = time.perf_counter() - replay_started
+        first_ack_seconds = replay_started - started + min(
+            (rtts[0] for rtts in ack_rtts if rtts), default=0.0
+        )
+        ack_rtts = [rtt for rtts in ack_rtts for rtt in rtts]
+        sent_at = {key: at for times in sent_at for key, at in times.items()}
+        if len(ack_rtts) != len(stream):
+            raise ConnectionError("Not every message was acknowledged, see the detector log")
+
+        # pages are sent in the background, wait until they stop arriving
+        deadline = time.perf_counter() + drain
+        seen = -1
+        while time.perf_counter() < deadline and seen != len(pager.pages):
+            seen = len(pager.pages)
+            time.sleep(0.5)
+        rss_final = sampler.last
+        # stopped before its connections close, so it does not reconnect
+        stop_detector(detector)
+        for client in clients:
+            client.close()
+        clients = []
+        if restart:
+            restart_result = measure_restart(
+                stream[0], listeners, pager, history_path, state_dir, persistence_mode, shards, log_path
+            )
+    finally:
+        for client in clients:
+            client.close()
+        if detector.poll() is None:
+            stop_detector(detector)
+        for listener in listeners:
+            listener.close()
+        pager.shutdown()
+        pager.server_close()
+
+    first_pages = {}
+    for mrn, date, at in pager.pages:
+        first_pages.setdefault((mrn, date), at)
+    page_latencies = [
+        at - sent_at[key] for key, at in first_pages.items() if key in sent_at
+    ]
+    result = {
+        "messages": len(stream),
+        "lims_messages": len(sent_at),
+        "startup_seconds": startup_seconds,
+        "first_ack_seconds": first_ack_seconds,
+        "replay_seconds": replay_seconds,
+        "throughput_messages_per_second": len(stream) / replay_seconds if replay_seconds else None,
+        "ack_rtt_ms": percentiles(ack_rtts),
+        "page_latency_ms": percentiles(page_latencies),
+        "pages": len(pager.pages),
+        "distinct_pages": len(first_pages),
+        "rss_bytes": {
+            "after_startup": rss_after_startup,
+            "final": rss_final,
+            "peak": sampler.peak,
+        },
+    }
+    if restart:
+        result["restart"] = restart_result
+    if labels is not None:
+        result["labels"] = len(labels)
+        result.update(f3_score(set(first_pages), labels))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default="replay.json", help="Where to write the JSON results")
+    parser.add_argument("--mllp-file", help="Replay this MLLP file instead of a synthetic stream")
+    parser.add_argument("--history", default="data/history.csv", help="History of the --mllp-file stream")
+    parser.add_argument("--labels", help="AKI labels of the stream, in the aki.csv format")
+    parser.add_argument("--patients", default=500, type=int)
+    parser.add_argument("--messages", default=5000, type=int)
+    parser.add_argument("--admit-ratio", default=0.2, type=float)
+    parser.add_argument("--discharge-ratio", default=0.15, type=float)
+    parser.add_argument("--history-depth", default=5, type=float)
+    parser.add_argument("--aki-prevalence", default=0.15, type=float)
+    parser.add_argument("--interval", default="exponential", choices=INTERVAL_DISTRIBUTIONS)
+    parser.add_argument("--interval-hours", default=12, type=float)
+    parser.add_argument("--seed", default=0, type=int)
+    parser.add_argument("--persistence-mode", default="journal")
+    parser.add_argument("--connections", default=1, type=int, help="Number of concurrent MLLP feeds")
+    parser.add_argument("--shards", default=1, type=int, help="Number of detector shard processes")
+    parser.add_argument("--drain", default=10.0, type=float, help="Seconds to wait for the last pages")
+    parser.add_argument(
+        "--restart", action="store_true", help="Also measure the time to the first ACK after a restart"
+    )
+    parser.add_argument(
+        "--in-flight", default=1, type=int, help="Messages sent on a connection before waiting for an ACK"
+    )
+    parser.add_argument(
+        "--group-commit-window", type=float, help="GROUP_COMMIT_WINDOW of the detector, in seconds"
+    )
+    flags = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        config = {
+            "persistence_mode": flags.persistence_mode,
+            "connections": flags.connections,
+            "shards": flags.shards,
+            "restart": flags.restart,
+            "in_flight": flags.in_flight,
+            "group_commit_window": flags.group_commit_window,
+        }
+        if flags.group_commit_window is not None:
+            # the detector inherits the environment
+            os.environ["GROUP_COMMIT_WINDOW"] = str(flags.group_commit_window)
+        if flags.mllp_file:
+            stream = read_hl7_messages(flags.mllp_file)
+            history_path = os.path.abspath(flags.history)
+            labels = read_labels(flags.labels) if flags.labels else None
+            config.update(mllp_file=flags.mllp_file, history=flags.history, labels=flags.labels)
+        else:
+            workload = {
+                "patients": flags.patients,
+                "messages": flags.messages,
+                "admit_ratio": flags.admit_ratio,
+                "discharge_ratio": flags.discharge_ratio,
+                "history_depth": flags.history_depth,
+                "aki_prevalence": flags.aki_prevalence,
+                "interval": flags.interval,
+                "interval_hours": flags.interval_hours,
+                "seed": flags.seed,
+            }
+            history, stream, labels = generate_workload(**workload)
+            labels = set(labels)
+            history_path = os.path.join(work_dir, "history.csv")
+            write_history_csv(history_path, history)
+            config.update(workload)
+
+        log_path = os.path.abspath(flags.output) + ".log"
+        result = replay(
+            stream,
+            history_path,
+            labels,
+            os.path.join(work_dir, "state"),
+            flags.persistence_mode,
+            flags.drain,
+            log_path,
+            flags.connections,
+            flags.shards,
+            flags.restart,
+            flags.in_flight,
+        )
+
+    report = {
+        "benchmark": "replay",
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "host": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "config": config,
+        "results": result,
+    }
+    with open(flags.output, "w") as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+    print(json.dumps(result, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
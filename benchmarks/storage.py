@@ -0,0 +1,172 @@
+"""
+Compares the storage backends on the same history: time to load it on a first
+start and to open it again, test result inserts per second (persisting every
+PIPELINE_PERSIST_INTERVAL inserts, as the pipeline does), history and feature
+state lookup latencies, snapshot time and RSS. Every backend runs in a process
+of its own, so their memory is measured apart.
+
+    python -m benchmarks.storage --output storage.json --patients 200000
+    python -m benchmarks.storage --history /tmp/workload/history.csv --backends columnar
+
+The default 200000 patients with 5 results each give about 1M results.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import tempfile
+import time
+from datetime import datetime, timedelta
+from benchmarks.replay import percentiles
+from benchmarks.workload import (
+    Population,
+    generate_history,
+    write_history_csv,
+    HL7_DATE_FORMAT,
+)
+from constants import STORAGE_BACKENDS, PIPELINE_PERSIST_INTERVAL
+from storage import open_database
+from utils import read_history_csv
+
+
+def current_rss():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def time_calls(call, arguments):
+    latencies = []
+    for argument in arguments:
+        start = time.perf_counter()
+        call(argument)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def measure(backend, history_path, patients, sample, inserts, seed, results):
+    """
+    Benchmarks one backend, in a process of its own, putting its results on the
+    `results` queue. Results are inserted for the `patients` and looked up for
+    the MRNs in `sample`.
+    """
+    rng = random.Random(seed)
+    with tempfile.TemporaryDirectory() as state_dir:
+        start = time.perf_counter()
+        db = open_database(backend, history_path, "journal", state_dir=state_dir)
+        load_seconds = time.perf_counter() - start
+        db.close()
+
+        start = time.perf_counter()
+        db = open_database(backend, history_path, "journal", state_dir=state_dir)
+        open_seconds = time.perf_counter() - start
+        rss_after_open = current_rss()
+
+        for mrn in patients:
+            db.insert_patient(mrn, 40, "f")
+        date = datetime(2024, 6, 1)
+        start = time.perf_counter()
+        for i in range(inserts):
+            date += timedelta(seconds=rng.randint(1, 600))
+            db.insert_test_result(
+                rng.choice(patients), date.strftime(HL7_DATE_FORMAT), round(rng.uniform(40, 200), 2)
+            )
+            if (i + 1) % PIPELINE_PERSIST_INTERVAL == 0:
+                db.persist_db()
+        db.persist_db()
+        insert_seconds = time.perf_counter() - start
+
+        history_latencies = time_calls(db.get_test_results, sample)
+        db.feature_cache.clear()
+        feature_latencies = time_calls(db.get_feature_state, sample)
+        rss_after_lookups = current_rss()
+
+        start = time.perf_counter()
+        db.snapshot()
+        snapshot_seconds = time.perf_counter() - start
+        db.close()
+
+    results.put(
+        {
+            "backend": backend,
+            "load_seconds": load_seconds,
+            "open_seconds": open_seconds,
+            "inserts_per_second": inserts / insert_seconds,
+            "history_lookup_ms": percentiles(history_latencies),
+            "feature_state_lookup_ms": percentiles(feature_latencies),
+            "snapshot_seconds": snapshot_seconds,
+            "rss_bytes": {
+                "after_open": rss_after_open,
+                "after_lookups": rss_after_lookups,
+                "peak": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            },
+        }
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default="storage.json", help="Where to write the JSON results")
+    parser.add_argument("--history", help="History to load, generated when not given")
+    parser.add_argument("--patients", default=200000, type=int)
+    parser.add_argument("--history-depth", default=5, type=float)
+    parser.add_argument("--backends", default=",".join(STORAGE_BACKENDS))
+    parser.add_argument("--inserts", default=20000, type=int)
+    parser.add_argument("--lookups", default=5000, type=int)
+    parser.add_argument("--seed", default=0, type=int)
+    flags = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as work_dir:
+        history_path = flags.history
+        if history_path is None:
+            population = Population(flags.patients, flags.history_depth, flags.seed)
+            history_path = os.path.join(work_dir, "history.csv")
+            write_history_csv(
+                history_path,
+                generate_history(population),
+                width=int(population.depths.max(initial=0)),
+            )
+        # picked here so the MRNs of the history are not in the measured processes
+        rng = random.Random(flags.seed)
+        mrns = sorted({mrn for mrn, _, _ in read_history_csv(history_path)})
+        patients = rng.sample(mrns, min(len(mrns), 1000))
+        sample = [rng.choice(mrns) for _ in range(flags.lookups)]
+        del mrns
+        results = []
+        for backend in flags.backends.split(","):
+            queue = context.Queue()
+            process = context.Process(
+                target=measure,
+                args=(backend, history_path, patients, sample, flags.inserts, flags.seed, queue),
+            )
+            process.start()
+            results.append(queue.get())
+            process.join()
+
+    report = {
+        "benchmark": "storage",
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "host": {"python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()},
+        "config": {
+            "history": flags.history,
+            "patients": flags.patients,
+            "history_depth": flags.history_depth,
+            "inserts": flags.inserts,
+            "lookups": flags.lookups,
+            "seed": flags.seed,
+        },
+        "results": results,
+    }
+    with open(flags.output, "w") as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+"""
+Synthetic workloads for the benchmarks: a history of creatinine results in the
+wide layout of data/history.csv and a stream of admit, LIMS and discharge messages
+in the format `simulator.py` replays, with the AKI labels of the stream in the
+format of aki.csv.
+
+The history and the stream are generated lazily, so workloads of millions of
+patients and messages are written with bounded memory:
+
+    python -m benchmarks.workload --output-dir /tmp/workload --patients 1000000 --messages 10000000
+
+The same seed and parameters always give the same files.
+"""
+import argparse
+import csv
+import heapq
+import math
+import os
+import random
+from datetime import datetime, timedelta
+import numpy as np
+from constants import MLLP_START_CHAR, MLLP_END_CHAR
+from hl7_messages import HL7_DATE_FORMAT, admit_message, discharge_message, lims_message
+
+HISTORY_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+# Results of a patient vary by up to this much around their baseline, and an AKI
+# multiplies the baseline by at least AKI_MIN_RATIO, well above the 1.5 of the NHS
+# algorithm
+NORMAL_VARIATION = 0.1
+AKI_MIN_RATIO = 1.8
+AKI_MAX_RATIO = 3.0
+INTERVAL_DISTRIBUTIONS = ("exponential", "uniform", "lognormal")
+# Spread of the lognormal intervals, in log space
+LOGNORMAL_SIGMA = 1.0
+DEFAULT_START = datetime(2024, 6, 1)
+
+
+def interval_sampler(rng, distribution, mean_hours):
+    """
+    Returns a function drawing the time between two results of a patient, with the
+    given distribution and mean, rounded to whole minutes of at least one.
+    """
+    if distribution == "exponential":
+        draw = lambda: rng.expovariate(1 / mean_hours)
+    elif distribution == "uniform":
+        draw = lambda: rng.uniform(0, 2 * mean_hours)
+    elif distribution == "lognormal":
+        mu = math.log(mean_hours) - LOGNORMAL_SIGMA**2 / 2
+        draw = lambda: rng.lognormvariate(mu, LOGNORMAL_SIGMA)
+    else:
+        raise ValueError(f"Unknown interval distribution {distribution}")
+    return lambda: timedelta(minutes=max(1, round(draw() * 60)))
+
+
+class Population:
+    """
+    The patients of a workload: their MRNs, baseline creatinine and number of
+    historical results, drawn once from the seed.
+    """
+
+    def __init__(self, patients, history_depth, seed):
+        rng = np.random.default_rng(seed)
+        self.mrns = [str(mrn) for mrn in rng.choice(10**8 - 10**4, patients, replace=False) + 10**4]
+        self.baselines = rng.uniform(40, 90, patients)
+        self.depths = rng.poisson(history_depth, patients)
+        self.seed = seed
+
+    def __len__(self):
+        return len(self.mrns)
+
+    def result(self, rng, patient):
+        return round(
+            self.baselines[patient] * rng.uniform(1 - NORMAL_VARIATION, 1 + NORMAL_VARIATION), 2
+        )
+
+    def aki_result(self, rng, patient):
+        return round(self.baselines[patient] * rng.uniform(AKI_MIN_RATIO, AKI_MAX_RATIO), 2)
+
+
+def generate_history(
+    population, interval="exponential", interval_hours=24 * 30, start=DEFAULT_START
+):
+    """
+    Yields the (mrn, [(date, result), ...]) history of every patient, results in
+    date order and before `start`.
+    """
+    rng = random.Random(population.seed)
+    draw_interval = interval_sampler(rng, interval, interval_hours)
+    for patient, mrn in enumerate(population.mrns):
+        date = start
+        results = []
+        for _ in range(population.depths[patient]):
+            date -= draw_interval()
+            results.append((date.replace(second=0), population.result(rng, patient)))
+        results.reverse()
+        yield mrn, results
+
+
+class Admission:
+    """
+    A stay of a patient in the stream, producing its messages one at a time.
+    """
+
+    __slots__ = ("patient", "date", "lims_left", "discharged", "aki_at", "lims_sent")
+
+    def __init__(self, patient, date, lims_count, discharged, aki_at):
+        self.patient = patient
+        self.date = date
+        self.lims_left = lims_count
+        self.discharged = discharged
+        self.aki_at = aki_at
+        self.lims_sent = 0
+
+
+def generate_stream(
+    population,
+    messages=5000,
+    admit_ratio=0.2,
+    discharge_ratio=0.15,
+    aki_prevalence=0.15,
+    interval="exponential",
+    interval_hours=12,
+    start=DEFAULT_START,
+):
+    """
+    Yields the (message, label) of every message of the stream, in date order; the
+    label is the (mrn, date) of an AKI result, with the date in the LIMS format, and
+    None otherwise.
+
+    Every admission is an ADT^A01, then its ORU^R01 results, `interval` apart,
+    then, for `discharge_ratio / admit_ratio` of them, an ADT^A03. A patient is not
+    admitted again during a stay. `aki_prevalence` of the admissions have one AKI
+    result, on a patient that has previous results; the others stay around the
+    patient's baseline.
+    """
+    rng = random.Random(population.seed + 1)
+    sizes = np.random.default_rng(population.seed + 1)
+    draw_interval = interval_sampler(rng, interval, interval_hours)
+    admissions = max(1, round(messages * admit_ratio))
+    discharges = min(admissions, round(messages * discharge_ratio))
+    lims_counts = sizes.multinomial(
+        max(0, messages - admissions - discharges), np.full(admissions, 1 / admissions)
+    )
+    discharged = np.zeros(admissions, dtype=bool)
+    discharged[sizes.choice(admissions, discharges, replace=False)] = True
+    # admissions arrive uniformly, about one message per hour overall
+    span_minutes = max(1, messages) * 60
+    arrivals = np.sort(sizes.integers(0, span_minutes, admissions))
+
+    has_results = population.depths > 0
+    admitted = set()
+    # (date, order, admission) of the next message of every ongoing admission
+    ongoing = []
+    order = 0
+    for index in range(admissions + 1):
+        arrival = start + timedelta(minutes=int(arrivals[index])) if index < admissions else None
+        while ongoing and (arrival is None or ongoing[0][0] <= arrival):
+            date, _, admission = heapq.heappop(ongoing)
+            mrn = population.mrns[admission.patient]
+            if admission.lims_left:
+                admission.lims_left -= 1
+                if (
+                    admission.aki_at is not None
+                    and admission.lims_sent >= admission.aki_at
+                    and has_results[admission.patient]
+                ):
+                    admission.aki_at = None
+                    result = population.aki_result(rng, admission.patient)
+                    label = (mrn, date.strftime(HL7_DATE_FORMAT))
+                else:
+                    result = population.result(rng, admission.patient)
+                    label = None
+                admission.lims_sent += 1
+                has_results[admission.patient] = True
+                yield lims_message(mrn, date, result), label
+                next_date = date + (draw_interval() if admission.lims_left else timedelta(hours=1))
+            elif admission.discharged:
+                admission.discharged = False
+                yield discharge_message(mrn, date), None
+                next_date = None
+            else:
+                next_date = None
+            if next_date is None:
+                admitted.discard(admission.patient)
+            else:
+                order += 1
+                heapq.heappush(ongoing, (next_date, order, admission))
+        if arrival is None:
+            return
+        patient = rng.randrange(len(population))
+        for _ in range(100):
+            if patient not in admitted:
+                break
+            patient = rng.randrange(len(population))
+        else:
+            raise ValueError("Not enough patients for the number of concurrent admissions")
+        admitted.add(patient)
+        lims_count = int(lims_counts[index])
+        aki_at = rng.randrange(lims_count) if lims_count and rng.random() < aki_prevalence else None
+        date_of_birth = datetime(rng.randint(1930, 2005), rng.randint(1, 12), rng.randint(1, 28))
+        yield admit_message(population.mrns[patient], arrival, date_of_birth, rng.choice("FM")), None
+        admission = Admission(patient, arrival, lims_count, bool(discharged[index]), aki_at)
+        order += 1
+        first = arrival + (draw_interval() if lims_count else timedelta(hours=1))
+        heapq.heappush(ongoing, (first, order, admission))
+
+
+def generate_workload(
+    patients=500,
+    messages=5000,
+    admit_ratio=0.2,
+    discharge_ratio=0.15,
+    history_depth=5,
+    aki_prevalence=0.15,
+    interval="exponential",
+    interval_hours=12,
+    history_interval_hours=24 * 30,
+    seed=0,
+    start=DEFAULT_START,
+):
+    """
+    Generates a whole workload in memory, see `generate_history` and
+    `generate_stream`.
+
+    Returns:
+    - history (dict): The (date, result) pairs of every patient, by MRN.
+    - stream (list): The messages, in order.
+    - labels (list): The (mrn, date) of the AKIs, date in the LIMS format.
+    """
+    population = Population(patients, history_depth, seed)
+    history = dict(generate_history(population, interval, history_interval_hours, start))
+    stream = []
+    labels = []
+    for message, label in generate_stream(
+        population, messages, admit_ratio, discharge_ratio, aki_prevalence, interval, interval_hours, start
+    ):
+        stream.append(message)
+        if label is not None:
+            labels.append(label)
+    return history, stream, labels
+
+
+def write_history_csv(path, history, width=None):
+    """
+    Writes a history in the wide layout of data/history.csv. `history` can be any
+    iterable of (mrn, results) pairs; give `width`, the largest number of results
+    of a patient, to write it without holding it in memory.
+    """
+    if width is None:
+        history = dict(history)
+        width = max((len(results) for results in history.values()), default=0)
+    if isinstance(history, dict):
+        history = history.items()
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        header = ["mrn"]
+        for i in range(width):
+            header += [f"creatinine_date_{i}", f"creatinine_result_{i}"]
+        writer.writerow(header)
+        for mrn, results in history:
+            row = [mrn]
+            for date, result in results:
+                row += [date.strftime(HISTORY_DATE_FORMAT), result]
+            writer.writerow(row + [""] * (2 * (width - len(results))))
+
+
+def write_mllp(path, stream):
+    """
+    Writes a stream of messages with their MLLP framing, as `simulator.py` reads it.
+    """
+    with open(path, "wb") as file:
+        for message in stream:
+            file.write(MLLP_START_CHAR + message + MLLP_END_CHAR)
+
+
+def write_labels(path, labels):
+    """
+    Writes the AKI labels in the format of aki.csv.
+    """
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["mrn", "date"])
+        for mrn, date in labels:
+            writer.writerow(
+                [mrn, datetime.strptime(date, HL7_DATE_FORMAT).strftime(HISTORY_DATE_FORMAT)]
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output-dir", required=True, help="Where to write history.csv, messages.mllp and aki.csv")
+    parser.add_argument("--patients", default=2000, type=int)
+    parser.add_argument("--messages", default=10000, type=int)
+    parser.add_argument("--admit-ratio", default=0.2, type=float)
+    parser.add_argument("--discharge-ratio", default=0.15, type=float)
+    parser.add_argument("--history-depth", default=5, type=float, help="Mean number of historical results per patient")
+    parser.add_argument("--aki-prevalence", default=0.15, type=float, help="Fraction of admissions with an AKI")
+    parser.add_argument("--interval", default="exponential", choices=INTERVAL_DISTRIBUTIONS)
+    parser.add_argument("--interval-hours", default=12, type=float, help="Mean time between results during a stay")
+    parser.add_argument("--history-interval-hours", default=24 * 30, type=float, help="Mean time between historical results")
+    parser.add_argument("--seed", default=0, type=int)
+    flags = parser.parse_args()
+
+    os.makedirs(flags.output_dir, exist_ok=True)
+    population = Population(flags.patients, flags.history_depth, flags.seed)
+    write_history_csv(
+        os.path.join(flags.output_dir, "history.csv"),
+        generate_history(population, flags.interval, flags.history_interval_hours),
+        width=int(population.depths.max(initial=0)),
+    )
+    labels = []
+
+    def stream():
+        for message, label in generate_stream(
+            population,
+            flags.messages,
+            flags.admit_ratio,
+            flags.discharge_ratio,
+            flags.aki_prevalence,
+            flags.interval,
+            flags.interval_hours,
+        ):
+            if label is not None:
+                labels.append(label)
+            yield message
+
+    write_mllp(os.path.join(flags.output_dir, "messages.mllp"), stream())
+    write_labels(os.path.join(flags.output_dir, "aki.csv"), labels)
+    print(
+        f"Wrote {flags.patients} patients with {int(population.depths.sum())} results, "
+        f"{flags.messages} messages and {len(labels)} AKIs to {flags.output_dir}"
+    )
+
+
+if __name__ == "__main__":
+    main()
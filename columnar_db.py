@@ -0,0 +1,655 @@
+import json
+import logging
+import os
+import threading
+import numpy as np
+from constants import (
+    ON_DISK_COLUMNAR_PATH,
+    PERSISTENCE_MODES,
+    COLUMNAR_INITIAL_CAPACITY,
+    COLUMNAR_INDEX_INTERVAL,
+    COMPACTION_AGE,
+)
+from utils import (
+    populate_test_results_table,
+    to_epoch_seconds,
+    is_lims_date,
+    encode_date,
+    decode_date,
+)
+from feature_cache import FeatureCache, FeatureSummary
+from storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# One file per column, a row per test result. Results are kept as float64 so the
+# features match the ones computed from the SQLite store exactly.
+COLUMNS = {
+    "mrn": np.int32,
+    "time": np.int64,
+    "result": np.float64,
+    # 1 when the date came from LIMS, which SQLite stores as an integer, 0 when
+    # it came from history.csv and is handed back as text
+    "lims": np.uint8,
+}
+# Number of rows converted at once when bulk loading
+BULK_LOAD_CHUNK = 65536
+# Columns of a features row, as in the SQLite features table
+FEATURE_COLUMNS = (
+    "mrn",
+    "age",
+    "sex",
+    "C1",
+    "RV1",
+    "RV1_ratio",
+    "RV2",
+    "RV2_ratio",
+    "has_changed_48h",
+    "D",
+    "aki",
+)
+
+
+class ColumnarDatabase(Storage):
+    """
+    Patient history in append-only, memory-mapped column files instead of an
+    in-memory SQLite database, behind the same interface as `InMemoryDatabase`.
+    Starting maps the files rather than copying them, so memory only grows with
+    the pages that are read.
+
+    Rows are found through a per-MRN index: the row numbers sorted by MRN id,
+    with the offset of every MRN id's first row. It is rebuilt every
+    COLUMNAR_INDEX_INTERVAL rows; rows appended since are indexed in memory.
+    Admitted patients, the MRN of every id and the features rows of the patients
+    are kept in small append-only logs. Feature summaries are only kept in memory.
+    """
+
+    # summaries are built from the mapped rows when needed, so there is nothing
+    # to compact or rebuild
+    stores_summaries = False
+
+    def __init__(
+        self, history_load_path, persistence_mode="backup", shard=None, state_dir=None
+    ):
+        assert (
+            persistence_mode in PERSISTENCE_MODES
+        ), f"Unknown persistence mode: {persistence_mode}"
+        # appended rows are already in the mapped files, so both modes only have
+        # to flush them when persisting
+        self.persistence_mode = persistence_mode
+        # (index, count) when this database only holds the patients of one shard
+        self.shard = shard
+        if state_dir is None:
+            self.path = ON_DISK_COLUMNAR_PATH
+        else:
+            self.path = os.path.join(state_dir, "columnar")
+        # re-entrant as a patient's rows are read under it to build their summary
+        self.lock = threading.RLock()
+        self.feature_cache = FeatureCache()
+        # mrn -> (age, sex) of the admitted patients
+        self.patients = {}
+        # mrn -> features row
+        self.features = {}
+        # MRN of every id, and the id of every MRN
+        self.mrns = []
+        self.mrn_ids = {}
+        # rows written, and rows covered by the index on disk
+        self.rows = 0
+        self.indexed_rows = 0
+        self.columns = {}
+        self.order = np.zeros(0, dtype=np.int64)
+        self.starts = np.zeros(1, dtype=np.int64)
+        # rows appended since the index was built, per MRN id
+        self.unindexed = {}
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        self.load_db(history_load_path)
+
+    def file_path(self, name):
+        return os.path.join(self.path, name)
+
+    def open_log(self, name):
+        """
+        Read the complete lines of an append-only log and open it for appending.
+        A line torn by a crash is cut off.
+        Args:
+            - name {str}: file name of the log
+        Returns:
+            - (lines, log) {tuple}: the lines and the file opened for appending
+        """
+        path = self.file_path(name)
+        lines = []
+        size = 0
+        if os.path.exists(path):
+            with open(path) as log:
+                for line in log:
+                    if not line.endswith("\n"):
+                        break
+                    lines.append(line[:-1])
+                    size += len(line.encode())
+            os.truncate(path, size)
+        return lines, open(path, "a")
+
+    def map_columns(self, capacity):
+        """
+        Memory-map the column files, growing them to hold at least `capacity` rows.
+        """
+        for name, dtype in COLUMNS.items():
+            path = self.file_path(name + ".col")
+            itemsize = np.dtype(dtype).itemsize
+            with open(path, "ab") as column:
+                size = max(os.path.getsize(path), capacity * itemsize)
+                column.truncate(size)
+            self.columns[name] = np.memmap(
+                path, dtype=dtype, mode="r+", shape=(size // itemsize,)
+            )
+
+    def load_db(self, history_load_path):
+        """
+        Map the column files and their index, or bulk load history.csv into them
+        on the first start.
+        """
+        names, self.mrn_log = self.open_log("mrns.txt")
+        for mrn in names:
+            self.mrn_ids[mrn] = len(self.mrns)
+            self.mrns.append(mrn)
+        entries, self.patient_log = self.open_log("patients.log")
+        for entry in entries:
+            entry = entry.split("\t")
+            if entry[0] == "A":
+                self.patients.setdefault(entry[1], (int(entry[2]), entry[3]))
+            elif entry[0] == "D":
+                self.patients.pop(entry[1], None)
+        # the last row logged for a patient is their current one
+        rows, self.features_log = self.open_log("features.log")
+        for row in rows:
+            row = tuple(json.loads(row))
+            self.features[row[0]] = row
+
+        meta_path = self.file_path("meta.json")
+        if not os.path.exists(meta_path):
+            logger.info("Loading the history.csv file in the columnar store.")
+            self.map_columns(COLUMNAR_INITIAL_CAPACITY)
+            # indexes the rows and writes the metadata
+            populate_test_results_table(self, history_load_path, self.shard)
+            return
+        with open(meta_path) as meta:
+            meta = json.load(meta)
+        self.rows = meta["rows"]
+        self.indexed_rows = meta["indexed_rows"]
+        self.map_columns(max(COLUMNAR_INITIAL_CAPACITY, self.rows))
+        self.order = np.load(
+            self.file_path(f"order-{self.indexed_rows}.npy"), mmap_mode="r"
+        )
+        self.starts = np.load(
+            self.file_path(f"starts-{self.indexed_rows}.npy"), mmap_mode="r"
+        )
+        # rows persisted after the index was last built
+        mrn_ids = self.columns["mrn"][self.indexed_rows : self.rows]
+        for row, mrn_id in enumerate(mrn_ids.tolist(), self.indexed_rows):
+            self.unindexed.setdefault(mrn_id, []).append(row)
+        logger.info("Mapped %d test results from %s.", self.rows, self.path)
+
+    def mrn_id(self, mrn):
+        """
+        Id of an MRN in the mrn column, assigning the next one to a new MRN.
+        """
+        mrn_id = self.mrn_ids.get(mrn)
+        if mrn_id is None:
+            mrn_id = len(self.mrns)
+            self.mrn_ids[mrn] = mrn_id
+            self.mrns.append(mrn)
+            self.mrn_log.write(mrn + "\n")
+        return mrn_id
+
+    def append_rows(self, mrn_ids, times, results, lims):
+        """
+        Append test results to the column files, growing them when they are full.
+        Returns:
+            - first {int}: the row number of the first appended row
+        """
+        count = len(mrn_ids)
+        capacity = len(self.columns["mrn"])
+        if self.rows + count > capacity:
+            self.flush()
+            self.map_columns(max(2 * capacity, self.rows + count))
+        first = self.rows
+        end = first + count
+        self.columns["mrn"][first:end] = mrn_ids
+        self.columns["time"][first:end] = times
+        self.columns["result"][first:end] = results
+        self.columns["lims"][first:end] = lims
+        self.rows = end
+        return first
+
+    def rows_of(self, mrn):
+        """
+        Row numbers of a patient's test results.
+        Args:
+            - mrn {str}: Medical Record Number
+        """
+        mrn_id = self.mrn_ids.get(mrn)
+        if mrn_id is None:
+            return np.zeros(0, dtype=np.int64)
+        if mrn_id + 1 < len(self.starts):
+            rows = self.order[self.starts[mrn_id] : self.starts[mrn_id + 1]]
+        else:
+            rows = np.zeros(0, dtype=np.int64)
+        unindexed = self.unindexed.get(mrn_id)
+        if unindexed:
+            rows = np.concatenate((rows, unindexed))
+            # in the order the index would put them
+            rows = rows[
+                np.lexsort(
+                    (self.columns["time"][rows], 1 - self.columns["lims"][rows])
+                )
+            ]
+        return rows
+
+    def find_row(self, mrn, time_, lims):
+        """
+        Row number of a patient's test result at a date, or None.
+        """
+        rows = self.rows_of(mrn)
+        found = rows[
+            (self.columns["time"][rows] == time_) & (self.columns["lims"][rows] == lims)
+        ]
+        return int(found[0]) if len(found) else None
+
+    def read_times(self, mrn):
+        """
+        A patient's test results as (time, lims, result) rows, as stored.
+        """
+        with self.lock:
+            rows = self.rows_of(mrn)
+            times = self.columns["time"][rows].tolist()
+            lims = self.columns["lims"][rows].tolist()
+            results = self.columns["result"][rows].tolist()
+        return list(zip(times, lims, results))
+
+    def read_results(self, mrn):
+        """
+        A patient's test results as (date, result) rows.
+        """
+        return [
+            (decode_date(time_, lims), result)
+            for time_, lims, result in self.read_times(mrn)
+        ]
+
+    def insert_patient(self, mrn, age, sex, update_disk_db=True):
+        """
+        Insert the patient info from PAS.
+        Args:
+            - mrn {str}: Medical Record Number of the patient
+            - age {int}: Age of the patient
+            - sex {str}: Sex of the patient ('m'/'f')
+        """
+        with self.lock:
+            if mrn in self.patients:
+                logger.warning("Patient %s is already in the patients table!", mrn)
+                return
+            self.patients[mrn] = (int(age), sex)
+            self.patient_log.write(f"A\t{mrn}\t{int(age)}\t{sex}\n")
+
+    def get_patient(self, mrn):
+        """
+        Get the (mrn, age, sex) of an admitted patient, or None.
+        Args:
+            - mrn {str}: Medical Record Number
+        """
+        patient = self.patients.get(mrn)
+        if patient is None:
+            return None
+        return (mrn,) + patient
+
+    def discharge_patient(self, mrn):
+        """
+        Remove the patient from the admitted patients. Test results are kept for
+        historic data.
+        Args:
+            - mrn {str}: Medical Record Number
+        """
+        with self.lock:
+            self.patients.pop(mrn, None)
+            self.patient_log.write(f"D\t{mrn}\n")
+            self.feature_cache.discharge(mrn)
+
+    def insert_test_result(self, mrn, date, result, features=None):
+        """
+        Append a test result to the columns, and store the features it was
+        scored with when given.
+        Args:
+            - mrn {str}: Medical Record Number of the patient
+            - date {str}: creatinine result date
+            - result {float}: creatinine result
+            - features {dict}: columns of the features row to update, see
+              `update_patient_features`
+        """
+        time_, lims = encode_date(date)
+        with self.lock:
+            if self.find_row(mrn, time_, lims) is not None:
+                logger.warning(
+                    "Test result on date-time: %s for: %s is already in the test_results table!",
+                    date,
+                    mrn,
+                )
+                return
+            # the summary is loaded before the result is in the columns
+            summary = self.get_feature_state(mrn)
+            mrn_id = self.mrn_id(mrn)
+            row = self.append_rows([mrn_id], [time_], [float(result)], [lims])
+            self.unindexed.setdefault(mrn_id, []).append(row)
+            summary.add_time(time_, lims, result)
+            if features:
+                self.update_patient_features(mrn, **features)
+
+    def append_chunk(self, chunk):
+        """
+        Convert a chunk of (mrn, date, result) rows to columns and append them.
+        history.csv dates are parsed by NumPy in one go.
+        """
+        count = len(chunk)
+        mrn_ids = np.fromiter(
+            (self.mrn_id(mrn) for mrn, _, _ in chunk), dtype=np.int32, count=count
+        )
+        results = np.fromiter(
+            (float(result) for _, _, result in chunk), dtype=np.float64, count=count
+        )
+        lims = np.fromiter(
+            (is_lims_date(date) for _, date, _ in chunk), dtype=np.uint8, count=count
+        )
+        times = np.empty(count, dtype=np.int64)
+        text = lims == 0
+        times[text] = np.array(
+            [row[1] for row, is_text in zip(chunk, text) if is_text],
+            dtype="datetime64[s]",
+        ).astype(np.int64)
+        for i in np.flatnonzero(~text):
+            times[i] = to_epoch_seconds(chunk[i][1])
+        self.append_rows(mrn_ids, times, results, lims)
+
+    def insert_test_results(self, rows):
+        """
+        Append many test results and rebuild the index. Rows that are already
+        stored are skipped.
+        Args:
+            - rows {iterable}: (mrn, date, result) tuples, can be a generator
+        Returns:
+            - inserted {int}: the number of rows inserted
+        """
+        with self.lock:
+            before = len(self.order) + sum(len(r) for r in self.unindexed.values())
+            chunk = []
+            for row in rows:
+                chunk.append(row)
+                if len(chunk) == BULK_LOAD_CHUNK:
+                    self.append_chunk(chunk)
+                    chunk = []
+            if chunk:
+                self.append_chunk(chunk)
+            self.create_indexes()
+            self.feature_cache.clear()
+            return len(self.order) - before
+
+    def get_test_result(self, mrn, date):
+        """
+        Get the (mrn, date, result) of a patient's test result at a date, or None.
+        Args:
+            - mrn {str}: Medical Record Number
+            - date {str}: The date and time of the test
+        """
+        try:
+            time_, lims = encode_date(date)
+        except ValueError:
+            return None
+        with self.lock:
+            row = self.find_row(mrn, time_, lims)
+            if row is None:
+                return None
+            return (
+                mrn,
+                decode_date(time_, lims),
+                float(self.columns["result"][row]),
+            )
+
+    def get_test_results(self, mrn):
+        """
+        Get the (mrn, date, result) test results of a patient.
+        Args:
+            - mrn {str}: Medical Record Number
+        """
+        return [(mrn, date, result) for date, result in self.read_results(mrn)]
+
+    def get_patient_history(self, mrn):
+        """
+        Get patient info along with all their test results and their dates.
+        Args:
+            - mrn {str}: Medical Record Number
+        Returns:
+            - _ {list}: (mrn, age, sex, date, result) records, empty if the
+              patient is not admitted
+        """
+        patient = self.patients.get(mrn)
+        if patient is None:
+            return []
+        return [(mrn,) + patient + row for row in self.read_results(mrn)]
+
+    def get_feature_state(self, mrn):
+        """
+        Get the feature summary of a patient, building it from the columns if it
+        is not cached.
+        Args:
+            - mrn {str}: Medical Record Number
+        Returns:
+            - _ {FeatureSummary}: the summary, empty if there are no results
+        """
+
+        def load_summary():
+            summary = FeatureSummary(lambda: self.read_times(mrn))
+            for time_, lims, result in self.read_times(mrn):
+                summary.add_time(time_, lims, result)
+            return summary
+
+        return self.feature_cache.get(mrn, load_summary)
+
+    def rebuild_features(self):
+        """
+        Drop the cached feature summaries. Summaries are not stored with the
+        columns, they are built from the mapped rows of a patient when needed:
+        see `stores_summaries`.
+        Returns:
+            - rebuilt {int}: always 0
+        """
+        self.feature_cache.clear()
+        return 0
+
+    def compact(self, age=COMPACTION_AGE, stopping=None):
+        """
+        Nothing to compact: the rows already live in the column files, and only
+        the pages of the patients being looked up are resident. The detector
+        does not run a compactor for this backend, see `stores_summaries`.
+        Returns:
+            - archived {int}: always 0
+            - reclaimed {int}: always 0
+        """
+        return 0, 0
+
+    def summary_bytes(self):
+        """
+        Always 0: summaries are not stored with the columns.
+        """
+        return 0
+
+    def insert_patient_features(
+        self, mrn, age, sex, c1, rv1, rv1_r, rv2, rv2_r, change, D, aki=None
+    ):
+        """
+        Store the features of a patient, see `InMemoryDatabase.insert_patient_features`.
+        """
+        with self.lock:
+            if mrn in self.features:
+                logger.warning(
+                    "The features for patient %s are already in the features table!",
+                    mrn,
+                )
+                return
+            self.store_features(
+                (mrn, age, sex, c1, rv1, rv1_r, rv2, rv2_r, change, D, aki)
+            )
+
+    def get_patient_features(self, mrn):
+        """
+        Get the features row of a patient, or None.
+        Args:
+            - mrn {str}: Medical Record Number
+        """
+        return self.features.get(mrn)
+
+    def update_patient_features(self, mrn, **kwargs):
+        """
+        Update patient features based on the provided keyword arguments, storing
+        a row for a patient who has none.
+        Args:
+            - mrn {str}: Medical Record Number of the patient to update
+            - **kwargs {dict}: Where key=column, value=new value
+        """
+        with self.lock:
+            features = self.features.get(mrn)
+            if features is None:
+                features = (mrn,) + (None,) * (len(FEATURE_COLUMNS) - 1)
+            features = list(features)
+            for column, value in kwargs.items():
+                features[FEATURE_COLUMNS.index(column)] = value
+            self.store_features(tuple(features))
+
+    def store_features(self, row):
+        """
+        Keep the features row of a patient and append it to the features log.
+        """
+        self.features[row[0]] = row
+        self.features_log.write(json.dumps(row) + "\n")
+
+    def database_loaded(self):
+        """
+        Whether any test results are stored.
+        """
+        return self.rows > 0
+
+    def create_indexes(self):
+        """
+        Rebuild the per-MRN index over every row and persist it. Rows are ordered
+        as the SQLite (mrn, date) index orders them, and duplicate (mrn, date)
+        rows are left out, keeping the first one stored.
+        """
+        with self.lock:
+            self.flush()
+            count = self.rows
+            mrns = self.columns["mrn"][:count]
+            times = self.columns["time"][:count]
+            lims = self.columns["lims"][:count]
+            # LIMS dates are integers in SQLite, which sorts them before text
+            order = np.lexsort((times, 1 - lims, mrns))
+            sorted_mrns = mrns[order]
+            sorted_times = times[order]
+            sorted_lims = lims[order]
+            duplicate = np.zeros(count, dtype=bool)
+            duplicate[1:] = (
+                (sorted_mrns[1:] == sorted_mrns[:-1])
+                & (sorted_times[1:] == sorted_times[:-1])
+                & (sorted_lims[1:] == sorted_lims[:-1])
+            )
+            order = order[~duplicate]
+            starts = np.searchsorted(
+                sorted_mrns[~duplicate], np.arange(len(self.mrns) + 1)
+            )
+            for name, array in (("order", order), ("starts", starts)):
+                with open(self.file_path(f"{name}-{count}.npy"), "wb") as index:
+                    np.save(index, array.astype(np.int64))
+                    index.flush()
+                    os.fsync(index.fileno())
+            self.write_meta(count, count)
+            for name in os.listdir(self.path):
+                if name.startswith(("order-", "starts-")) and name not in (
+                    f"order-{count}.npy",
+                    f"starts-{count}.npy",
+                ):
+                    os.remove(self.file_path(name))
+            self.order = np.load(self.file_path(f"order-{count}.npy"), mmap_mode="r")
+            self.starts = np.load(self.file_path(f"starts-{count}.npy"), mmap_mode="r")
+            self.indexed_rows = count
+            self.unindexed = {}
+
+    def flush(self):
+        """
+        Write the mapped columns and the logs through to disk.
+        """
+        for column in self.columns.values():
+            column.flush()
+        for log in (self.mrn_log, self.patient_log, self.features_log):
+            log.flush()
+            os.fsync(log.fileno())
+
+    def write_meta(self, rows, indexed_rows):
+        """
+        Atomically record how many rows are stored and how many the index covers.
+        Rows past `rows` are ignored on the next start.
+        """
+        meta_path = self.file_path("meta.json")
+        with open(meta_path + ".tmp", "w") as meta:
+            json.dump({"rows": rows, "indexed_rows": indexed_rows}, meta)
+            meta.flush()
+            os.fsync(meta.fileno())
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def persist_db(self):
+        """
+        Make the rows appended so far durable. The index is rebuilt once
+        COLUMNAR_INDEX_INTERVAL rows have been appended since it was last built.
+        """
+        with self.lock:
+            if self.rows - self.indexed_rows >= COLUMNAR_INDEX_INTERVAL:
+                self.create_indexes()
+                return
+            self.flush()
+            self.write_meta(self.rows, self.indexed_rows)
+
+    def snapshot(self):
+        """
+        Index every row and compact the patients and features logs, so the next
+        start maps the files without scanning any of them.
+        """
+        with self.lock:
+            self.create_indexes()
+            self.patient_log.close()
+            self.patient_log = self.rewrite_log(
+                "patients.log",
+                (f"A\t{mrn}\t{age}\t{sex}" for mrn, (age, sex) in self.patients.items()),
+            )
+            self.features_log.close()
+            self.features_log = self.rewrite_log(
+                "features.log", (json.dumps(row) for row in self.features.values())
+            )
+
+    def rewrite_log(self, name, lines):
+        """
+        Atomically replace an append-only log with `lines`, and open it for
+        appending.
+        """
+        path = self.file_path(name)
+        with open(path + ".tmp", "w") as log:
+            for line in lines:
+                log.write(line + "\n")
+            log.flush()
+            os.fsync(log.fileno())
+        os.replace(path + ".tmp", path)
+        return open(path, "a")
+
+    def close(self):
+        """
+        Take a final snapshot and unmap the files.
+        """
+        with self.lock:
+            self.snapshot()
+            self.patient_log.close()
+            self.features_log.close()
+            self.mrn_log.close()
+            self.columns = {}
@@ -0,0 +1,82 @@
+import logging
+import threading
+import time
+from constants import COMPACTION_INTERVAL
+from prometheus_metrics import (
+    record_compaction,
+    set_summary_bytes,
+    increment_failure_counter,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Compactor:
+    """
+    Compacts the patient store every `interval` seconds from a background thread,
+    so the test results the features no longer need stop growing the store while
+    messages are being handled.
+    """
+
+    def __init__(
+        self,
+        db,
+        archived_counter,
+        reclaimed_counter,
+        summary_gauge,
+        failure_counter,
+        interval=COMPACTION_INTERVAL,
+    ):
+        self.db = db
+        self.archived_counter = archived_counter
+        self.reclaimed_counter = reclaimed_counter
+        # the summaries keep what the features need of the archived results
+        self.summary_gauge = summary_gauge
+        self.failure_counter = failure_counter
+        self.interval = interval
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="compactor", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.compact()
+
+    def compact(self):
+        """
+        Compact the store once.
+        Returns:
+            - archived {int}: the number of test results archived
+            - reclaimed {int}: the number of bytes reclaimed
+        """
+        start = time.perf_counter()
+        try:
+            archived, reclaimed = self.db.compact(stopping=self.stopping)
+            summary_bytes = self.db.summary_bytes()
+        except Exception:
+            increment_failure_counter(self.failure_counter)
+            logger.exception("There was an exception in the compaction..")
+            return 0, 0
+        record_compaction(
+            self.archived_counter, self.reclaimed_counter, archived, reclaimed
+        )
+        set_summary_bytes(self.summary_gauge, summary_bytes)
+        logger.info(
+            "Compaction archived %d test results and reclaimed %d bytes in %.2fs, "
+            "the feature summaries take %d bytes",
+            archived,
+            reclaimed,
+            time.perf_counter() - start,
+            summary_bytes,
+        )
+        return archived, reclaimed
+
+    def stop(self, timeout=None):
+        """
+        Stop the compaction, between two chunks if one is running.
+        """
+        self.stopping.set()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
@@ -0,0 +1,126 @@
+import numpy as np
+from joblib import load
+from constants import REVERSE_LABELS_MAP
+
+# sklearn marks leaves with this child index
+TREE_LEAF = -1
+
+
+class CompiledDecisionTree:
+    """
+    A fitted sklearn decision tree flattened into plain arrays, evaluated without
+    sklearn. Inputs are rounded to float32 and compared with the float64
+    thresholds, as sklearn does, so predictions are bit-identical to
+    `dt_model.predict`.
+    """
+
+    def __init__(
+        self, feature, threshold, children_left, children_right, leaf_labels,
+        missing_go_to_left,
+    ):
+        # numpy arrays for the batch path
+        self.feature = np.asarray(feature, dtype=np.intp)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.children_left = np.asarray(children_left, dtype=np.intp)
+        self.children_right = np.asarray(children_right, dtype=np.intp)
+        self.leaf_labels = np.asarray(leaf_labels)
+        self.missing_go_to_left = np.asarray(missing_go_to_left, dtype=bool)
+        self.max_depth = self._depth()
+        # one tuple per node for the single row path, which is faster on lists
+        self.nodes = list(
+            zip(
+                self.feature.tolist(),
+                self.threshold.tolist(),
+                self.children_left.tolist(),
+                self.children_right.tolist(),
+                self.missing_go_to_left.tolist(),
+                self.leaf_labels.tolist(),
+            )
+        )
+
+    @classmethod
+    def from_model(cls, dt_model):
+        """
+        Extract the arrays of a fitted DecisionTreeClassifier.
+        """
+        tree = dt_model.tree_
+        classes = dt_model.classes_.take(np.argmax(tree.value[:, 0, :], axis=1))
+        leaf_labels = [REVERSE_LABELS_MAP[item] for item in classes]
+        # only trees fitted with sklearn>=1.3 know where missing values go
+        missing_go_to_left = getattr(
+            tree, "missing_go_to_left", np.zeros(tree.node_count, dtype=bool)
+        )
+        return cls(
+            tree.feature,
+            tree.threshold,
+            tree.children_left,
+            tree.children_right,
+            leaf_labels,
+            missing_go_to_left,
+        )
+
+    def _depth(self):
+        depth = np.zeros(len(self.feature), dtype=np.intp)
+        for node in range(len(self.feature)):
+            if self.children_left[node] != TREE_LEAF:
+                depth[self.children_left[node]] = depth[node] + 1
+                depth[self.children_right[node]] = depth[node] + 1
+        return int(depth.max())
+
+    def predict_one(self, features):
+        """
+        Predict the label ('n'/'y') of a single row of features, in
+        FEATURES_COLUMNS order.
+        """
+        row = np.array(features, dtype=np.float32).tolist()
+        nodes = self.nodes
+        feature, threshold, left, right, missing_left, label = nodes[0]
+        while left != TREE_LEAF:
+            value = row[feature]
+            if value != value:
+                node = left if missing_left else right
+            elif value <= threshold:
+                node = left
+            else:
+                node = right
+            feature, threshold, left, right, missing_left, label = nodes[node]
+        return label
+
+    def predict(self, features):
+        """
+        Predict a single row of features. Returns the predicted labels, like
+        `predict_with_dt`.
+        """
+        return [self.predict_one(features)]
+
+    def predict_many(self, X):
+        """
+        Predict many rows of features at once, walking all of them down the tree one
+        level at a time.
+        Args:
+            - X {np.ndarray}: (n_rows, n_features) features in FEATURES_COLUMNS order
+        Returns:
+            - _ {np.ndarray}: the predicted label of every row
+        """
+        X = np.asarray(X, dtype=np.float32)
+        rows = np.arange(len(X))
+        node = np.zeros(len(X), dtype=np.intp)
+        for _ in range(self.max_depth):
+            left = self.children_left[node]
+            is_split = left != TREE_LEAF
+            value = X[rows, np.where(is_split, self.feature[node], 0)]
+            go_left = np.where(
+                np.isnan(value), self.missing_go_to_left[node], value <= self.threshold[node]
+            )
+            node = np.where(
+                is_split, np.where(go_left, left, self.children_right[node]), node
+            )
+        return self.leaf_labels[node]
+
+
+def load_compiled_tree(path):
+    """
+    Load a joblib DecisionTreeClassifier and compile it, so only the arrays are
+    kept for prediction.
+    """
+    return CompiledDecisionTree.from_model(load(path))
@@ -1,12 +1,32 @@
+import os
+
 # MLLP constants
 MLLP_START_CHAR = b"\x0b"
 MLLP_END_CHAR = b"\x1c\x0d"
 MLLP_END_OF_BLOCK = 0x1C
+# Initial size of the MLLP receive buffer, it grows to fit larger messages
+MLLP_BUFFER_SIZE = 4096
+
+# Creatinine result dates: from LIMS, and from history.csv
+LIMS_DATE_FORMAT = "%Y%m%d%H%M%S"
+HISTORY_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 # Path to load and store the trained Decision Tree model
 DT_MODEL_PATH = "dt_model.joblib"
-ON_DISK_DB_PATH = "/state/database.db"
-ON_DISK_PAGER_STACK_PATH = "/state/pager.pkl"
+# Directory of everything persisted across restarts, can be moved for benchmarks
+STATE_DIR = os.environ.get("STATE_DIR", "/state")
+ON_DISK_DB_PATH = os.path.join(STATE_DIR, "database.db")
+ON_DISK_JOURNAL_PATH = os.path.join(STATE_DIR, "journal.log")
+# Pages left by older versions, moved to the pager queue on startup
+ON_DISK_PAGER_STACK_PATH = os.path.join(STATE_DIR, "pager.pkl")
+ON_DISK_PAGER_QUEUE_PATH = os.path.join(STATE_DIR, "pager.db")
+# Raw messages are logged here before they are acknowledged
+ON_DISK_INBOUND_LOG_PATH = os.path.join(STATE_DIR, "inbound.log")
+ON_DISK_INBOUND_OFFSET_PATH = os.path.join(STATE_DIR, "inbound.offset")
+# Directory of the memory-mapped columnar history store
+ON_DISK_COLUMNAR_PATH = os.path.join(STATE_DIR, "columnar")
+# Predictions of the challenger models, next to the primary model's
+ON_DISK_SHADOW_PATH = os.path.join(STATE_DIR, "shadow.db")
 MLP_MODEL_PATH = "mlp_without_age_sex.pkl"
 
 # Map for AKI Label
@@ -27,5 +47,94 @@ FEATURES_COLUMNS = [
     "D",
 ]
 
+# Persistence: "backup" copies the whole database to disk after every message,
+# "journal" appends only the message's delta and snapshots periodically
+PERSISTENCE_MODES = ("backup", "journal")
+# Number of journal entries after which a full snapshot is taken in the background,
+# the number of seconds after which one is taken anyway if anything changed, and
+# the number of pages copied per step of a snapshot, between which the message
+# loop gets the connection
+JOURNAL_SNAPSHOT_INTERVAL = 1000
+SNAPSHOT_INTERVAL = 60
+SNAPSHOT_BACKUP_PAGES = 1024
+
+# Patient stores main.py can run on, picked with the STORAGE_BACKEND variable
+STORAGE_BACKENDS = ("sqlite", "columnar")
+
+# Columnar store: rows the column files are first sized for (they double when
+# full), and the number of rows appended after which the per-MRN index is rebuilt
+COLUMNAR_INITIAL_CAPACITY = 1 << 16
+COLUMNAR_INDEX_INTERVAL = 10000
+
+# Compaction: test results more than COMPACTION_AGE seconds older than their
+# patient's latest result are moved from the in-memory store to the on-disk
+# archive every COMPACTION_INTERVAL seconds, COMPACTION_CHUNK_SIZE patients at a time
+COMPACTION_AGE = 365 * 24 * 60 * 60
+COMPACTION_INTERVAL = 60 * 60
+COMPACTION_CHUNK_SIZE = 500
+
+# Port of the Prometheus metrics, shard processes use the ports after it
+METRICS_PORT = 8000
+
+# Pipeline: maximum number of items waiting in each stage, how often the scoring
+# stage persists while busy, the size above which the processed inbound log is
+# emptied and how long (in seconds) the reader waits for a message before checking
+# for a shutdown request
+PIPELINE_QUEUE_SIZE = 1000
+PIPELINE_PERSIST_INTERVAL = 100
+INBOUND_LOG_MAX_BYTES = 16 * 1024 * 1024
+FEED_POLL_INTERVAL = 1.0
+
+# Group commit: messages received back to back are logged with one fsync and
+# acknowledged with one write, up to GROUP_COMMIT_MAX_MESSAGES of them (at most
+# IOV_MAX). A message waits up to GROUP_COMMIT_WINDOW seconds for others to join
+# it; with 0 only the messages already received are grouped
+GROUP_COMMIT_MAX_MESSAGES = 64
+GROUP_COMMIT_WINDOW = float(os.environ.get("GROUP_COMMIT_WINDOW", "0"))
+
+# Pager: number of concurrent requests, request timeouts and retry backoff (in
+# seconds), and how long sent pages are remembered to drop duplicates
+PAGER_WORKERS = 4
+PAGER_CONNECT_TIMEOUT = 0.5
+PAGER_READ_TIMEOUT = 1.0
+PAGER_BACKOFF_BASE = 0.1
+PAGER_BACKOFF_CAP = 30.0
+PAGER_SENT_RETENTION = 7 * 24 * 60 * 60
+
+# Upper bounds (in seconds) of the latency histogram buckets, around the 3 second
+# budget of a message
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0,
+)
+# Share of the messages whose step breakdown is printed when they take longer
+# than TRACE_SLOW_SECONDS; 0 turns the tracer off
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0"))
+TRACE_SLOW_SECONDS = float(os.environ.get("TRACE_SLOW_SECONDS", "1.0"))
+
+# Logging: the lowest level written, and "text" or "json" lines
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text")
+
+# Shadow scoring: the challenger models scored alongside the decision tree, comma
+# separated (empty turns shadow scoring off), the number of feature vectors
+# waiting for them above which new ones are dropped, the number scored at once
+# and how long (in seconds) a vector waits for others to fill its batch, and how
+# long (in seconds) their predictions are kept, pruned every SHADOW_PRUNE_INTERVAL
+# seconds
+SHADOW_MODEL_PATHS = [
+    path for path in os.environ.get("SHADOW_MODELS", MLP_MODEL_PATH).split(",") if path
+]
+SHADOW_QUEUE_SIZE = 10000
+SHADOW_BATCH_SIZE = 64
+SHADOW_BATCH_WINDOW = 1.0
+SHADOW_RETENTION = 7 * 24 * 60 * 60
+SHADOW_PRUNE_INTERVAL = 60 * 60
+
+# Maximum number of patients whose creatinine features are kept in memory
+FEATURE_CACHE_CAPACITY = 10000
+# Number of results on each side of the median a feature summary keeps, the
+# others are counted and read again from the test results when needed
+SUMMARY_MEDIAN_WINDOW = 64
+
 DEFAULT_AGE = 35
 DEFAULT_SEX = "F"
@@ -0,0 +1,582 @@
+import bisect
+import datetime
+import heapq
+from array import array
+from collections import OrderedDict
+from itertools import accumulate
+from constants import FEATURE_CACHE_CAPACITY, SUMMARY_MEDIAN_WINDOW
+from utils import to_epoch_seconds, is_lims_date
+
+# Results at least this old count as previous values for the D value
+TWO_DAYS_IN_SECONDS = 2 * 24 * 60 * 60
+
+
+def reference_values(
+    creat_latest_result, time, latest_text_time, latest_integer_time, minimum, median
+):
+    """
+    The RV features as `RV_compute` computes them, from the latest result dates
+    per storage class and the lowest and median result. SQLite returns LIMS dates
+    (integers) before history.csv dates (text), so the last history row is the
+    latest text date when there is one.
+    Args:
+        - time {int}: the date of the latest result, in seconds since the epoch
+        - minimum {callable}: returns the lowest result
+        - median {callable}: returns the median result
+    """
+    if latest_text_time is not None:
+        d2 = latest_text_time
+    else:
+        d2 = latest_integer_time
+    difference = datetime.timedelta(seconds=d2 - time)
+    diff = abs(difference.seconds / 86400 + difference.days)
+    C1 = float(creat_latest_result)
+    if diff <= 7:
+        minimum_ = minimum()
+        return C1, minimum_, C1 / minimum_, 0, 0
+    elif diff <= 365:
+        median_ = median()
+        return C1, 0, 0, median_, C1 / median_
+    else:
+        return 0
+
+
+def keep_nearest(heap, window):
+    """
+    The `window` smallest values of a min-heap, as a heap, with the number of
+    the others and the smallest of them. The heap holds more than `window`.
+    """
+    values = heapq.nsmallest(window + 1, heap)
+    return values[:window], len(heap) - window, values[window]
+
+
+class PatientFeatureState:
+    """
+    The creatinine history of a single patient, kept in a form from which the D
+    and RV features can be computed without rescanning the history. Gives the same
+    outputs as `D_value_compute` and `RV_compute` on the rows returned by
+    `InMemoryDatabase.get_patient_history`.
+    """
+
+    def __init__(self):
+        # result dates in seconds since the epoch, sorted, with their results
+        self.times = []
+        self.results = []
+        # prefix_minimums[i] is the lowest result up to and including times[i]
+        self.prefix_minimums = []
+        # the lower half of the results as a max-heap, the upper half as a min-heap
+        self.lower_half = []
+        self.upper_half = []
+        # latest result dates per storage class, see `reference_values`
+        self.latest_text_time = None
+        self.latest_integer_time = None
+
+    def __len__(self):
+        return len(self.times)
+
+    def add_result(self, date, result):
+        """
+        Add a creatinine result to the state.
+        Args:
+            - date {str or int}: creatinine result date
+            - result {float}: creatinine result
+        """
+        self.add_time(to_epoch_seconds(date), is_lims_date(date), result)
+
+    def add_time(self, time, lims, result):
+        """
+        Add a creatinine result to the state, its date as stored.
+        Args:
+            - time {int}: creatinine result date in seconds since the epoch
+            - lims {int}: whether the date came from LIMS
+            - result {float}: creatinine result
+        """
+        result = float(result)
+        if lims:
+            if self.latest_integer_time is None or time > self.latest_integer_time:
+                self.latest_integer_time = time
+        elif self.latest_text_time is None or time > self.latest_text_time:
+            self.latest_text_time = time
+
+        # results mostly arrive in order, so this is usually an append
+        index = bisect.bisect_right(self.times, time)
+        self.times.insert(index, time)
+        self.results.insert(index, result)
+        del self.prefix_minimums[index:]
+        minimum = self.prefix_minimums[-1] if self.prefix_minimums else result
+        for value in self.results[index:]:
+            minimum = min(minimum, value)
+            self.prefix_minimums.append(minimum)
+
+        # keep the lower half the same size as the upper half or one larger
+        if self.lower_half and result > -self.lower_half[0]:
+            heapq.heappush(self.upper_half, result)
+        else:
+            heapq.heappush(self.lower_half, -result)
+        if len(self.lower_half) > len(self.upper_half) + 1:
+            heapq.heappush(self.upper_half, -heapq.heappop(self.lower_half))
+        elif len(self.upper_half) > len(self.lower_half):
+            heapq.heappush(self.lower_half, -heapq.heappop(self.upper_half))
+
+    def median(self):
+        """
+        The median of all the results, as computed by `statistics.median`.
+        """
+        if len(self.lower_half) > len(self.upper_half):
+            return -self.lower_half[0]
+        return (-self.lower_half[0] + self.upper_half[0]) / 2
+
+    def D_value(self, creat_latest_result, d1):
+        """
+        Same as `D_value_compute(creat_latest_result, d1, history)`.
+        Args:
+            - creat_latest_result {float}: the latest creatinine result
+            - d1 {str}: the date of the latest creatinine result
+        Returns:
+            - (D, change) {tuple}
+        """
+        return self.D_value_at(creat_latest_result, to_epoch_seconds(d1))
+
+    def D_value_at(self, creat_latest_result, time):
+        """
+        `D_value` for a date in seconds since the epoch.
+        """
+        cutoff = time - TWO_DAYS_IN_SECONDS
+        previous_values = bisect.bisect_right(self.times, cutoff)
+        change = previous_values > 1
+        if previous_values > 0:
+            minimum_previous_value = self.prefix_minimums[previous_values - 1]
+            return float(creat_latest_result) - minimum_previous_value, change
+        return 0, change
+
+    def RV_value(self, creat_latest_result, d1):
+        """
+        Same as `RV_compute(creat_latest_result, d1, history)`.
+        Args:
+            - creat_latest_result {float}: the latest creatinine result
+            - d1 {str}: the date of the latest creatinine result
+        Returns:
+            - (C1, RV1, RV1_ratio, RV2, RV2_ratio) {tuple}, or 0 if the last result
+              is more than a year away
+        """
+        return self.RV_value_at(creat_latest_result, to_epoch_seconds(d1))
+
+    def RV_value_at(self, creat_latest_result, time):
+        """
+        `RV_value` for a date in seconds since the epoch.
+        """
+        return reference_values(
+            creat_latest_result,
+            time,
+            self.latest_text_time,
+            self.latest_integer_time,
+            lambda: self.prefix_minimums[-1],
+            self.median,
+        )
+
+
+class FeatureSummary:
+    """
+    The part of a patient's creatinine history the D and RV features need,
+    small enough to be kept as a row of the features table: the last result and
+    its time, the latest dates per storage class, the lowest result, the results
+    around the median, and the results of the last 48 hours apart from the count
+    and lowest of the older ones. Gives the same outputs as
+    `PatientFeatureState`, and like it costs O(log n) per result.
+
+    Only the `window` results nearest the median are kept on each side of it,
+    the others are counted, so the summary does not grow with the history. When
+    the median moves past the results kept, they are read again with
+    `load_results`, which returns the (time, lims, result) rows of the patient as
+    `add_time` takes them. Without it every result is kept. A D value for a date
+    before the last result needs every result too, so it is computed from
+    `load_results` instead, when one is given.
+    """
+
+    def __init__(self, load_results=None, window=SUMMARY_MEDIAN_WINDOW):
+        self.load_results = load_results
+        self.window = window
+        self.count = 0
+        self.last_time = None
+        self.last_result = None
+        self.latest_text_time = None
+        self.latest_integer_time = None
+        self.minimum = None
+        # the lower half of the results as a max-heap, the upper half as a
+        # min-heap, without the results dropped from either: their number, and
+        # the one nearest the median
+        self.lower_half = []
+        self.upper_half = []
+        self.lower_dropped = 0
+        self.lower_bound = None
+        self.upper_dropped = 0
+        self.upper_bound = None
+        # set when the median moved past the results kept, until they are read again
+        self.stale = False
+        # results more than two days older than the last one
+        self.older_count = 0
+        self.older_minimum = None
+        # the other results sorted by time, with recent_minimums[i] the lowest
+        # result up to and including recent_results[i]
+        self.recent_times = []
+        self.recent_results = []
+        self.recent_minimums = []
+
+    def __len__(self):
+        return self.count
+
+    def add_result(self, date, result):
+        """
+        Add a creatinine result to the summary.
+        Args:
+            - date {str or int}: creatinine result date
+            - result {float}: creatinine result
+        """
+        self.add_time(to_epoch_seconds(date), is_lims_date(date), result)
+
+    def add_time(self, time, lims, result):
+        """
+        Add a creatinine result to the summary, its date as stored.
+        Args:
+            - time {int}: creatinine result date in seconds since the epoch
+            - lims {int}: whether the date came from LIMS
+            - result {float}: creatinine result
+        """
+        result = float(result)
+        if lims:
+            if self.latest_integer_time is None or time > self.latest_integer_time:
+                self.latest_integer_time = time
+        elif self.latest_text_time is None or time > self.latest_text_time:
+            self.latest_text_time = time
+        if self.minimum is None or result < self.minimum:
+            self.minimum = result
+        self.count += 1
+        if not self.stale:
+            self.add_to_median(result)
+
+        if self.last_time is None or time >= self.last_time:
+            self.last_time = time
+            self.last_result = result
+        # results mostly arrive in order, so this is usually an append
+        index = bisect.bisect_right(self.recent_times, time)
+        self.recent_times.insert(index, time)
+        self.recent_results.insert(index, result)
+        del self.recent_minimums[index:]
+        minimum = self.recent_minimums[-1] if self.recent_minimums else result
+        for value in self.recent_results[index:]:
+            minimum = min(minimum, value)
+            self.recent_minimums.append(minimum)
+        # move the results that are now two days older than the last one
+        cutoff = self.last_time - TWO_DAYS_IN_SECONDS
+        older = bisect.bisect_right(self.recent_times, cutoff)
+        if older:
+            self.older_count += older
+            minimum = self.recent_minimums[older - 1]
+            if self.older_minimum is None or minimum < self.older_minimum:
+                self.older_minimum = minimum
+            # the minimums left still count the moved results, which are in
+            # older_minimum anyway
+            del self.recent_times[:older]
+            del self.recent_results[:older]
+            del self.recent_minimums[:older]
+
+    def add_to_median(self, result):
+        """
+        Add a result to the halves, keeping the lower half the same size as the
+        upper half or one larger.
+        """
+        if self.lower_half:
+            lower_maximum = -self.lower_half[0]
+        else:
+            lower_maximum = self.lower_bound
+        if lower_maximum is not None and result > lower_maximum:
+            self.push_upper(result)
+        else:
+            self.push_lower(result)
+        lower_size = len(self.lower_half) + self.lower_dropped
+        upper_size = len(self.upper_half) + self.upper_dropped
+        if lower_size > upper_size + 1:
+            if not self.lower_half:
+                # the result to move was dropped
+                self.stale = True
+                return
+            self.push_upper(-heapq.heappop(self.lower_half))
+        elif upper_size > lower_size:
+            if not self.upper_half:
+                self.stale = True
+                return
+            self.push_lower(heapq.heappop(self.upper_half))
+        # dropped a window at a time, so sorting them stays O(log window) per result
+        if self.load_results is None:
+            return
+        if len(self.lower_half) > 2 * self.window:
+            self.lower_half, dropped, bound = keep_nearest(self.lower_half, self.window)
+            self.lower_dropped += dropped
+            self.lower_bound = -bound
+        if len(self.upper_half) > 2 * self.window:
+            self.upper_half, dropped, self.upper_bound = keep_nearest(
+                self.upper_half, self.window
+            )
+            self.upper_dropped += dropped
+
+    def push_lower(self, result):
+        if self.lower_dropped and result < self.lower_bound:
+            self.lower_dropped += 1
+        else:
+            heapq.heappush(self.lower_half, -result)
+
+    def push_upper(self, result):
+        if self.upper_dropped and result > self.upper_bound:
+            self.upper_dropped += 1
+        else:
+            heapq.heappush(self.upper_half, result)
+
+    def refill(self):
+        """
+        Read the results again and keep the `window` nearest the median on each
+        side of it.
+        """
+        results = sorted(result for _, _, result in self.load_results())
+        self.count = len(results)
+        # the size of the lower half
+        middle = (len(results) + 1) // 2
+        self.lower_dropped = max(middle - self.window, 0)
+        self.lower_half = [-result for result in reversed(results[self.lower_dropped : middle])]
+        self.lower_bound = results[self.lower_dropped - 1] if self.lower_dropped else None
+        end = min(middle + self.window, len(results))
+        self.upper_half = results[middle:end]
+        self.upper_dropped = len(results) - end
+        self.upper_bound = results[end] if self.upper_dropped else None
+        self.stale = False
+
+    def median(self):
+        """
+        The median of all the results, as computed by `statistics.median`.
+        """
+        if self.stale:
+            self.refill()
+        # the largest dropped result is the largest when none are kept
+        if self.lower_half:
+            lower_maximum = -self.lower_half[0]
+        else:
+            lower_maximum = self.lower_bound
+        lower_size = len(self.lower_half) + self.lower_dropped
+        if lower_size > len(self.upper_half) + self.upper_dropped:
+            return lower_maximum
+        if self.upper_half:
+            upper_minimum = self.upper_half[0]
+        else:
+            upper_minimum = self.upper_bound
+        return (lower_maximum + upper_minimum) / 2
+
+    def D_value(self, creat_latest_result, d1):
+        """
+        Same as `D_value_compute(creat_latest_result, d1, history)`.
+        Args:
+            - creat_latest_result {float}: the latest creatinine result
+            - d1 {str}: the date of the latest creatinine result
+        Returns:
+            - (D, change) {tuple}
+        """
+        return self.D_value_at(creat_latest_result, to_epoch_seconds(d1))
+
+    def D_value_at(self, creat_latest_result, time):
+        """
+        `D_value` for a date in seconds since the epoch.
+        """
+        if self.last_time is not None and time < self.last_time:
+            if self.load_results is not None:
+                state = PatientFeatureState()
+                for stored_time, lims, result in self.load_results():
+                    state.add_time(stored_time, lims, result)
+                return state.D_value_at(creat_latest_result, time)
+        cutoff = time - TWO_DAYS_IN_SECONDS
+        recent_values = bisect.bisect_right(self.recent_times, cutoff)
+        previous_values = self.older_count + recent_values
+        minimum_previous_value = self.older_minimum
+        if recent_values > 0:
+            minimum = self.recent_minimums[recent_values - 1]
+            if minimum_previous_value is None or minimum < minimum_previous_value:
+                minimum_previous_value = minimum
+        change = previous_values > 1
+        if previous_values > 0:
+            return float(creat_latest_result) - minimum_previous_value, change
+        return 0, change
+
+    def RV_value(self, creat_latest_result, d1):
+        """
+        Same as `RV_compute(creat_latest_result, d1, history)`.
+        Args:
+            - creat_latest_result {float}: the latest creatinine result
+            - d1 {str}: the date of the latest creatinine result
+        Returns:
+            - (C1, RV1, RV1_ratio, RV2, RV2_ratio) {tuple}, or 0 if the last result
+              is more than a year away
+        """
+        return self.RV_value_at(creat_latest_result, to_epoch_seconds(d1))
+
+    def RV_value_at(self, creat_latest_result, time):
+        """
+        `RV_value` for a date in seconds since the epoch.
+        """
+        return reference_values(
+            creat_latest_result,
+            time,
+            self.latest_text_time,
+            self.latest_integer_time,
+            lambda: self.minimum,
+            self.median,
+        )
+
+    def to_row(self):
+        """
+        The summary as the values of the SUMMARY_COLUMNS of the features table,
+        with at most `window` results on each side of the median, whether or not
+        the summary drops the others. The heaps are stored as they are, so they
+        are read back without sorting.
+        """
+        if self.stale:
+            self.refill()
+        lower_half, lower_dropped, lower_bound = (
+            self.lower_half,
+            self.lower_dropped,
+            self.lower_bound,
+        )
+        if len(lower_half) > self.window:
+            lower_half, dropped, bound = keep_nearest(lower_half, self.window)
+            lower_dropped += dropped
+            lower_bound = -bound
+        upper_half, upper_dropped, upper_bound = (
+            self.upper_half,
+            self.upper_dropped,
+            self.upper_bound,
+        )
+        if len(upper_half) > self.window:
+            upper_half, dropped, upper_bound = keep_nearest(upper_half, self.window)
+            upper_dropped += dropped
+        return (
+            self.last_time,
+            self.last_result,
+            self.latest_text_time,
+            self.latest_integer_time,
+            self.minimum,
+            self.older_count,
+            self.older_minimum,
+            array("q", self.recent_times).tobytes(),
+            array("d", self.recent_results).tobytes(),
+            lower_dropped,
+            lower_bound,
+            upper_dropped,
+            upper_bound,
+            array("d", upper_half).tobytes(),
+            array("d", lower_half).tobytes(),
+        )
+
+    @classmethod
+    def from_row(cls, row, load_results=None, window=SUMMARY_MEDIAN_WINDOW):
+        """
+        Read a summary back from the values of the SUMMARY_COLUMNS.
+        """
+        summary = cls(load_results, window)
+        (
+            summary.last_time,
+            summary.last_result,
+            summary.latest_text_time,
+            summary.latest_integer_time,
+            summary.minimum,
+            summary.older_count,
+            summary.older_minimum,
+            recent_times,
+            recent_results,
+            summary.lower_dropped,
+            summary.lower_bound,
+            summary.upper_dropped,
+            summary.upper_bound,
+            upper_half,
+            lower_half,
+        ) = row
+        summary.recent_times = array("q", recent_times).tolist()
+        summary.recent_results = array("d", recent_results).tolist()
+        summary.recent_minimums = list(accumulate(summary.recent_results, min))
+        summary.upper_half = array("d", upper_half).tolist()
+        summary.lower_half = array("d", lower_half).tolist()
+        summary.count = (
+            len(summary.lower_half)
+            + summary.lower_dropped
+            + len(summary.upper_half)
+            + summary.upper_dropped
+        )
+        return summary
+
+
+# Columns of the features table holding a `FeatureSummary`. The last one is
+# cleared when a patient's summary has to be built again from their results.
+SUMMARY_COLUMNS = (
+    "last_time",
+    "last_result",
+    "latest_text_time",
+    "latest_integer_time",
+    "minimum",
+    "older_count",
+    "older_minimum",
+    "recent_times",
+    "recent_results",
+    "lower_dropped",
+    "lower_bound",
+    "upper_dropped",
+    "upper_bound",
+    "upper_results",
+    "lower_results",
+)
+
+
+class FeatureCache:
+    """
+    Least recently used cache of feature states keyed by MRN, so that the
+    patients being scored skip the database. Discharged patients are the first
+    to be evicted.
+    """
+
+    def __init__(self, capacity=FEATURE_CACHE_CAPACITY):
+        self.capacity = capacity
+        self.states = OrderedDict()
+
+    def __len__(self):
+        return len(self.states)
+
+    def __contains__(self, mrn):
+        return mrn in self.states
+
+    def get(self, mrn, load_state):
+        """
+        Get the feature state of a patient.
+        Args:
+            - mrn {str}: Medical Record Number
+            - load_state {callable}: returns the patient's state from the
+              database, only called on a cache miss
+        """
+        state = self.states.get(mrn)
+        if state is not None:
+            self.states.move_to_end(mrn)
+            return state
+        state = load_state()
+        self.states[mrn] = state
+        while len(self.states) > self.capacity:
+            self.states.popitem(last=False)
+        return state
+
+    def discharge(self, mrn):
+        """
+        Mark the patient's state as the next one to evict.
+        """
+        if mrn in self.states:
+            self.states.move_to_end(mrn, last=False)
+
+    def drop(self, mrn):
+        """
+        Forget the state of a patient, to be loaded again when next needed.
+        """
+        self.states.pop(mrn, None)
+
+    def clear(self):
+        self.states.clear()
@@ -0,0 +1,36 @@
+"""
+Data built from history.csv, shared by the tests and the benchmarks.
+"""
+from datetime import datetime
+import numpy as np
+from batch_features import history_features
+from constants import FEATURES_COLUMNS
+from hl7_messages import admit_message, discharge_message, lims_message
+from utils import read_history_csv
+
+
+def history_feature_rows(path, seed=0):
+    """
+    Feature rows for every result in a history file with random ages and sexes.
+    """
+    features = history_features(read_history_csv(path))
+    rng = np.random.default_rng(seed)
+    features.insert(0, "sex", rng.integers(0, 2, len(features)))
+    features.insert(0, "age", rng.integers(18, 95, len(features)))
+    return features[FEATURES_COLUMNS]
+
+
+def synthetic_messages(path, count):
+    """
+    A stream of messages as the simulator sends them: every history result as an
+    ORU^R01, preceded by an ADT^A01 and followed by an ADT^A03 of its patient.
+    """
+    messages = []
+    for mrn, date, result in read_history_csv(path):
+        date = datetime.strptime(date, "%Y-%m-%d %H:%M:%S")
+        messages.append(admit_message(mrn, date, datetime(1984, 2, 3), "F"))
+        messages.append(lims_message(mrn, date, result))
+        messages.append(discharge_message(mrn, date))
+        if len(messages) >= count:
+            break
+    return messages[:count]
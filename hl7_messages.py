@@ -0,0 +1,27 @@
+"""
+HL7 messages as the simulator sends them, built for the tests, the fixtures and
+the benchmark workloads.
+"""
+
+MSH = "MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||{}||{}|||2.5"
+HL7_DATE_FORMAT = "%Y%m%d%H%M%S"
+
+
+def admit_message(mrn, date, date_of_birth, sex):
+    return (
+        f"{MSH.format(date.strftime(HL7_DATE_FORMAT), 'ADT^A01')}\r"
+        f"PID|1||{mrn}||JOHN SMITH||{date_of_birth.strftime('%Y%m%d')}|{sex}\r"
+        "NK1|1|JANE SMITH|PARTNER\r"
+    ).encode()
+
+
+def lims_message(mrn, date, result):
+    date = date.strftime(HL7_DATE_FORMAT)
+    return (
+        f"{MSH.format(date, 'ORU^R01')}\rPID|1||{mrn}\r"
+        f"OBR|1||||||{date}\rOBX|1|SN|CREATININE||{result}\r"
+    ).encode()
+
+
+def discharge_message(mrn, date):
+    return f"{MSH.format(date.strftime(HL7_DATE_FORMAT), 'ADT^A03')}\rPID|1||{mrn}\r".encode()
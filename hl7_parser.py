@@ -0,0 +1,105 @@
+from utils import parse_hl7_message, parse_system_message, calculate_age
+
+# MSH-9 of the messages we receive, and their category
+MESSAGE_TYPES = {
+    "ADT^A01": "PAS-admit",
+    "ADT^A03": "PAS-discharge",
+    "ORU^R01": "LIMS",
+}
+
+
+def parse_message(hl7_data):
+    """
+    Parses an HL7 message straight from its bytes, reading only the fields we use.
+    Gives the same result as `parse_system_message(parse_hl7_message(hl7_data))`,
+    which it falls back to for any message it does not expect.
+
+    Args:
+    - hl7_data (bytes): The HL7 message, without its MLLP framing.
+
+    Returns:
+    - The category of message, MRN, [AGE, SEX] if PAS category or [DATE_BLOOD_TEST, CREATININE_VALUE] if LIMS
+    """
+    try:
+        return parse_known_message(hl7_data)
+    except (ValueError, IndexError, KeyError):
+        return parse_system_message(parse_hl7_message(hl7_data))
+
+
+def parse_known_message(hl7_data):
+    """
+    Byte-level parser for ADT^A01, ADT^A03 and ORU^R01 messages: MSH-9 gives the
+    message type, then only PID-3/7/8, OBR-7 and OBX-5 are decoded.
+    Raises ValueError, IndexError or KeyError for anything else.
+    """
+    data = bytes(hl7_data)
+    view = memoryview(data)
+    segments = {}
+    for start, end in segment_bounds(data):
+        name = data[start : start + 3]
+        # the first segment of each kind, like the legacy parser
+        segments.setdefault(name, (start, end))
+
+    category = MESSAGE_TYPES[field(data, view, segments[b"MSH"], 8)]
+    pid = segments[b"PID"]
+    mrn = field(data, view, pid, 3)
+    if not mrn:
+        raise ValueError("PID-3 is empty")
+    if category == "PAS-admit":
+        date_of_birth = field(data, view, pid, 7)
+        return category, mrn, [calculate_age(date_of_birth), field(data, view, pid, 8)[0]]
+    if category == "PAS-discharge":
+        return category, mrn, ["", ""]
+    date = field(data, view, segments[b"OBR"], 7)
+    result = float(field(data, view, segments[b"OBX"], 5))
+    return category, mrn, [date, result]
+
+
+def message_mrn(hl7_data):
+    """
+    The MRN (PID-3) of a message, read without parsing the rest of it.
+    """
+    data = bytes(hl7_data)
+    for start, end in segment_bounds(data):
+        if data.startswith(b"PID", start, end):
+            mrn = field(data, memoryview(data), (start, end), 3)
+            if mrn:
+                return mrn
+            break
+    return parse_message(hl7_data)[1]
+
+
+def segment_bounds(data):
+    """
+    Yields the (start, end) offsets of every non-empty segment, which may end with
+    a carriage return or a new line.
+    """
+    position = 0
+    length = len(data)
+    while position < length:
+        end = data.find(b"\r", position)
+        if end < 0:
+            end = length
+        new_line = data.find(b"\n", position, end)
+        if new_line >= 0:
+            end = new_line
+        if end > position:
+            yield position, end
+        position = end + 1
+
+
+def field(data, view, bounds, index):
+    """
+    Decodes field `index` of the segment at `bounds`, counting the segment name as
+    field 0 like `str.split("|")`. Raises IndexError if the segment is too short.
+    """
+    start, end = bounds
+    for _ in range(index):
+        start = data.find(b"|", start, end)
+        if start < 0:
+            raise IndexError(f"segment has fewer than {index + 1} fields")
+        start += 1
+    stop = data.find(b"|", start, end)
+    if stop < 0:
+        stop = end
+    return str(view[start:stop], "utf-8")
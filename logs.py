@@ -0,0 +1,94 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+from constants import LOG_LEVEL, LOG_FORMAT
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(processName)s %(name)s: %(message)s"
+
+# the listener thread of `configure_logging`
+listener = None
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    Formats a record as a JSON object on one line.
+    """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "process": record.processName,
+            "thread": record.threadName,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+class LogQueueHandler(QueueHandler):
+    """
+    Puts records on the queue of the listener thread. Only the message is merged
+    with its arguments here, and only for enabled levels; the formatting and the
+    write happen on the listener thread.
+    """
+
+    def prepare(self, record):
+        # the arguments and the traceback may have changed by the time the
+        # listener gets the record
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure_logging(level=LOG_LEVEL, format=LOG_FORMAT, stream=None):
+    """
+    Route the records of every logger through a queue to a listener thread that
+    writes them to `stream` (stdout by default), so logging never waits on I/O.
+    Args:
+        - level {str or int}: the lowest level logged
+        - format {str}: "text" or "json"
+        - stream {file}: where to write the records
+    Returns:
+        - listener {QueueListener}: the listener thread
+    """
+    global listener
+    stop_logging()
+    handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+    if format == "json":
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, handler)
+    root = logging.getLogger()
+    for previous in root.handlers[:]:
+        root.removeHandler(previous)
+    root.addHandler(LogQueueHandler(records))
+    root.setLevel(level)
+    listener.start()
+    return listener
+
+
+@atexit.register
+def stop_logging():
+    """
+    Write the records still queued and stop the listener thread, e.g. before
+    `os._exit`; this also happens at exit.
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+    listener = None
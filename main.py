@@ -1,40 +1,48 @@
 #!/usr/bin/env python3
 
+import time
+
+# start of the process, before the slow imports, for the startup metrics
+PROCESS_STARTED = time.perf_counter()
+
+import logging
 import signal
-import pickle
 import argparse
 import threading
-from joblib import load
-from utils import (
-    process_mllp_message,
-    parse_hl7_message,
-    create_acknowledgement,
-    parse_system_message,
-    strip_url,
-    define_graceful_shutdown,
-)
-from memory_db import InMemoryDatabase
+from concurrent.futures import ThreadPoolExecutor
+from storage import open_database
+from compiled_tree import load_compiled_tree
+from pipeline import InboundLog, Stage, MLLPFeed
+from sharding import run_coordinator, shard_state_dir, ShardFeed
+from pager import Pager
+from tracing import Trace, Tracer
+from compaction import Compactor
+from shadow import ShadowScorer
+from logs import configure_logging, stop_logging
+from hl7_parser import parse_message
 from constants import (
     DT_MODEL_PATH,
-    FEATURES_COLUMNS,
-    ON_DISK_PAGER_STACK_PATH,
-    MLP_MODEL_PATH,
+    SHADOW_MODEL_PATHS,
     DEFAULT_AGE,
     DEFAULT_SEX,
+    PIPELINE_QUEUE_SIZE,
+    FEED_POLL_INTERVAL,
+    PIPELINE_PERSIST_INTERVAL,
+    METRICS_PORT,
+    LATENCY_BUCKETS,
+    ON_DISK_INBOUND_LOG_PATH,
+    ON_DISK_INBOUND_OFFSET_PATH,
+    ON_DISK_PAGER_QUEUE_PATH,
+    ON_DISK_PAGER_STACK_PATH,
+    ON_DISK_SHADOW_PATH,
 )
 from utils import (
-    D_value_compute,
-    RV_compute,
-    predict_with_dt,
     label_encode,
-    send_pager_request,
-    connect_to_mllp,
-    read_from_mllp,
-    predict_with_mlp,
+    to_epoch_seconds,
 )
 from prometheus_metrics import (
+    Health,
     start_metrics_server,
-    increment_socket_connections,
     increment_message_counter,
     increment_patient_admit_counter,
     increment_patient_discharge,
@@ -43,18 +51,31 @@ from prometheus_metrics import (
     increment_aki_counter,
     calculate_positive_aki_rate,
     increment_failure_counter,
-    calculate_latency_average,
     increment_latency_counter,
+    observe_stage_latency,
+    observe_step_latency,
 )
 from datetime import datetime
 import pandas as pd
 import numpy as np
 import os
 import sys
-import traceback
-from prometheus_client import start_http_server, Summary, Counter, Gauge
+from prometheus_client import start_http_server, Summary, Counter, Gauge, Histogram
 
-REQUEST_TIME = Summary("request_processing_seconds", "Time spent processing request")
+logger = logging.getLogger(__name__)
+
+REQUEST_TIME = Histogram(
+    "request_processing_seconds",
+    "Time from a message starting to arrive to it being scored",
+    ["message_type"],
+    buckets=LATENCY_BUCKETS,
+)
+STEP_LATENCY = Histogram(
+    "message_step_seconds",
+    "Time spent in each step of handling a message",
+    ["step", "message_type"],
+    buckets=LATENCY_BUCKETS,
+)
 SOCKET_RECONNECTIONS_COUNTER = Gauge(
     "socket_reconnections_total", "Total number of socket reconnections made"
 )
@@ -67,7 +88,6 @@ PATIENT_DISCHARGE_COUNTER = Counter(
     "total_discharged_patients", "Total number of discharged patients"
 )
 BLOOD_TEST_AVERAGE = Gauge("blood_test_average", "Average Value of blood test")
-LATENCY_AVERAGE = Gauge("latency_average", "Average Value of latency")
 FAILURE_COUNTER = Counter("total_failures", "Total number of failures occurred")
 LATENCY_EXCEEDS_COUNTER = Counter(
     "latency_exceeds_3_seconds_total",
@@ -78,260 +98,561 @@ TOTAL_POSITIVE_AKI = Counter(
     "total_positive_akis", "Total number of positive AKI instances detected"
 )
 AKI_POSITIVE_RATE = Gauge("positive_AKI_rate", "Positive AKI rate")
+STAGE_QUEUE_DEPTH = Gauge(
+    "pipeline_queue_depth", "Number of items waiting in a pipeline stage", ["stage"]
+)
+STAGE_LATENCY = Summary(
+    "pipeline_stage_latency_seconds",
+    "Time from an item being queued for a pipeline stage to it being handled",
+    ["stage"],
+)
+SNAPSHOT_DURATION = Summary(
+    "snapshot_duration_seconds", "Time taken by a snapshot of the patient store"
+)
+SNAPSHOT_STALENESS = Gauge(
+    "snapshot_staleness_seconds",
+    "Age of the oldest change to the patient store not in a snapshot yet",
+)
+STARTUP_READY_SECONDS = Gauge(
+    "startup_ready_seconds",
+    "Time from the process starting to its store and models being loaded",
+)
+STARTUP_FIRST_ACK_SECONDS = Gauge(
+    "startup_first_ack_seconds",
+    "Time from the process starting to its first message being acknowledged",
+)
+# served on the metrics port as /live and /ready
+HEALTH = Health()
+COMPACTION_ARCHIVED_COUNTER = Counter(
+    "compaction_archived_results_total",
+    "Number of test results moved to the archive by the compaction",
+)
+COMPACTION_RECLAIMED_COUNTER = Counter(
+    "compaction_reclaimed_bytes_total",
+    "Number of bytes of the patient store reclaimed by the compaction",
+)
+FEATURE_SUMMARY_BYTES = Gauge(
+    "feature_summary_bytes",
+    "Number of bytes of the feature summaries in the patient store, as of the last compaction",
+)
+SHADOW_PREDICTIONS_COUNTER = Counter(
+    "shadow_predictions_total",
+    "Number of feature vectors scored by a challenger model",
+    ["model"],
+)
+SHADOW_DISAGREEMENTS_COUNTER = Counter(
+    "shadow_disagreements_total",
+    "Number of predictions of a challenger model that differ from the decision tree's",
+    ["model", "primary", "challenger"],
+)
+SHADOW_AGREEMENT_RATE = Gauge(
+    "shadow_agreement_rate",
+    "Share of the predictions of a challenger model that match the decision tree's",
+    ["model"],
+)
+SHADOW_INFERENCE_SECONDS = Histogram(
+    "shadow_inference_seconds",
+    "Time a challenger model took to predict a batch of feature vectors",
+    ["model"],
+    buckets=LATENCY_BUCKETS,
+)
+SHADOW_DROPPED_COUNTER = Counter(
+    "shadow_dropped_total",
+    "Number of feature vectors dropped as the challenger models fell behind",
+)
+
+
+def state_path(state_dir, path):
+    """
+    Where the file of `path`, one of the ON_DISK paths in STATE_DIR, is kept: in
+    `state_dir` if one is given.
+    """
+    if state_dir is None:
+        return path
+    return os.path.join(state_dir, os.path.basename(path))
 
 
 def start_server(
-    history_load_path, mllp_address, pager_address, pager_stack, debug=False
+    history_load_path,
+    mllp_address,
+    pager_address,
+    debug=False,
+    persistence_mode="journal",
+    feed=None,
+    shard=None,
+    storage_backend="sqlite",
+    state_dir=None,
 ):
     """
     Starts the TCP server to listen for incoming MLLP messages on the specified port.
+    A shard process gets its messages from the coordinator's `feed` instead, and
+    only holds the patients of its `shard`, an (index, count) pair, keeping its
+    state in `state_dir` rather than STATE_DIR. Patients are kept in the store of
+    `storage_backend`, one of STORAGE_BACKENDS.
+
+    Messages go through three stages: the main thread reads them, logs them to disk
+    and acknowledges them, the scoring stage updates the database and predicts AKI
+    in arrival order, and the pager sends the pages from its own workers, so a
+    slow pager never holds up reading or scoring.
+
+    The database and the models are loaded in the background while messages are
+    already read and acknowledged; the scoring stage starts, and HEALTH turns
+    ready, once they are loaded.
     """
     if debug:
         latencies = []  # to measure latency
         outputs = []  # to measure f3 score
-        count = 0
-    mllp_host, mllp_port = strip_url(mllp_address)
-
-    # Initialise the in-memory database
-    db = InMemoryDatabase(history_load_path)  # this also loads the previous history
+    count = 0
 
-    if db.database_loaded() == True:
-        print("Database loaded correctly")
-    else:
-        print("Database not loaded properly")
-
-    assert db != None, "In-memory Database is not initialised properly..."
+    # set by `warm_up`
+    db = None
+    dt_predictor = None
+    shadow = None
     # Variables to keep track of the total sum and count of blood test values
     total_blood_sum = 0.0
     count_blood = 0
     aki_count = 0
-    latency_time = 0
-    # Start the server
-    sock = connect_to_mllp(mllp_host, mllp_port)
-    increment_socket_connections(SOCKET_RECONNECTIONS_COUNTER)
+    count_mlp = 0
+    # sequence number of the last message scored, and of the last one persisted
+    last_scored = 0
+    last_persisted = 0
+
+    # messages are logged here before they are acknowledged
+    inbound_log = InboundLog(
+        state_path(state_dir, ON_DISK_INBOUND_LOG_PATH),
+        state_path(state_dir, ON_DISK_INBOUND_OFFSET_PATH),
+    )
 
-    # store the current socket for connection management
-    current_socket = {"sock": sock}
+    # every message's steps go to STEP_LATENCY, the slow ones can be dumped
+    tracer = Tracer(STEP_LATENCY, REQUEST_TIME)
+
+    def persist():
+        """
+        Persist the database and mark the messages scored so far as processed.
+        """
+        nonlocal last_persisted
+        if last_scored == last_persisted:
+            return
+        start = time.perf_counter()
+        db.persist_db()
+        inbound_log.commit(last_scored)
+        last_persisted = last_scored
+        # covers all the messages scored since the last time
+        observe_step_latency(
+            STEP_LATENCY, "persist", "batch", time.perf_counter() - start
+        )
+
+    def score(item):
+        nonlocal total_blood_sum, count_blood, aki_count, count_mlp
+        nonlocal last_scored, count
+        seq, hl7_data, received_at, trace = item
+        with trace.step("parse"):
+            category, mrn, data = parse_message(
+                hl7_data
+            )  # category is type of system message and data consists of age sex if PAS admit or date of blood test and creatanine result
+        logger.debug("Parsed values: %s %s %s", category, mrn, data)
+        increment_message_counter(MESSAGE_COUNTER)
+        if category == "PAS-admit":
+            increment_patient_admit_counter(PATIENT_ADMIT_COUNTER)
+            logger.debug("PAS-Admit: Inserting %s into db...", mrn)
+            with trace.step("store"):
+                db.insert_patient(mrn, int(data[0]), str(data[1]))
+                # check if patient was inserted correctly
+                if not db.get_patient(mrn):
+                    logger.warning("Failed to insert patient %s, trying once more", mrn)
+                    # and try again
+                    db.insert_patient(mrn, int(data[0]), str(data[1]))
+        elif category == "PAS-discharge":
+            increment_patient_discharge(PATIENT_DISCHARGE_COUNTER)
+            logger.debug("PAS-discharge: Discharging %s ...", mrn)
+            with trace.step("store"):
+                db.discharge_patient(mrn)
+                # check if patient was discharged correctly
+                if db.get_patient(mrn):
+                    logger.warning(
+                        "Failed to discharge patient %s, trying once more", mrn
+                    )
+                    # and try again
+                    db.discharge_patient(mrn)
+        elif category == "LIMS":
+            # latency is measured from when the message was read off the socket
+            start_time = received_at
+            logger.debug("Message from LIMS! Retreiving Patient History...")
+            with trace.step("lookup"):
+                patient = db.get_patient(mrn)
+                # only admitted patients have a usable history
+                if patient:
+                    feature_state = db.get_feature_state(mrn)
+
+            # prometheus related upates
+            total_blood_sum = total_blood_sum + data[1]
+            count_blood = count_blood + 1
+            process_blood_test(total_blood_sum, count_blood, BLOOD_TEST_AVERAGE)
+            increment_blood_test_counter(TOTAL_BLOOD_TESTS)
+
+            if patient and len(feature_state) != 0:
+                logger.debug("Patient History found!")
+                if debug:
+                    count = count + 1
+                latest_creatine_result = data[1]
+                latest_creatine_date = data[0]
+                with trace.step("features"):
+                    # parsed once for both features
+                    latest_time = to_epoch_seconds(latest_creatine_date)
+                    D, change_ = feature_state.D_value_at(
+                        latest_creatine_result, latest_time
+                    )
+                    reference_values = feature_state.RV_value_at(
+                        latest_creatine_result, latest_time
+                    )
+                    # no result within a year: no reference values, as in batch_features
+                    if reference_values == 0:
+                        reference_values = (0, 0, 0, 0, 0)
+                    C1, RV1, RV1_ratio, RV2, RV2_ratio = reference_values
+                    features = [
+                        patient[1],
+                        label_encode(patient[2]),
+                        C1,
+                        RV1,
+                        RV1_ratio,
+                        RV2,
+                        RV2_ratio,
+                        change_,
+                        D,
+                    ]
+                logger.debug("Features created, calling DT!")
+                with trace.step("predict"):
+                    aki = dt_predictor.predict(features)
+            elif patient:
+                logger.debug("Patient History doesn't exist...")
+                latest_creatine_result = data[1]
+                latest_creatine_date = data[0]
+                D = 0
+                change_ = 0
+                C1 = latest_creatine_result
+                RV1 = 0
+                RV1_ratio = 0
+                RV2 = 0
+                RV2_ratio = 0
+                features = [
+                    patient[1],
+                    label_encode(patient[2]),
+                    C1,
+                    RV1,
+                    RV1_ratio,
+                    RV2,
+                    RV2_ratio,
+                    change_,
+                    D,
+                ]
+                logger.debug("Features created, calling DT!")
+                with trace.step("predict"):
+                    aki = dt_predictor.predict(features)
 
-    # register signals for graceful shutdown
-    signal.signal(
-        signal.SIGINT, define_graceful_shutdown(db, current_socket, pager_stack)
+            else:
+                # This ideally shouldn't happen -
+                count_mlp = count_mlp + 1
+                logger.warning(
+                    "No such patient %s in the patients table. Inserting with default values...",
+                    mrn,
+                )
+
+                # insert the patient into the DB - with default values to avoid this flow the next time we get a test result for this patient
+                with trace.step("store"):
+                    db.insert_patient(mrn, DEFAULT_AGE, DEFAULT_SEX)
+                logger.info("Inserted new patient with MRN: %s!", mrn)
+                # Predict NO AKI for the current LIMS message.
+                aki = ["n"]
+
+            # the features row keeps the last features scored and their
+            # prediction, stored with the test result
+            scored_features = None
+            if patient:
+                # the challengers see the same features, in the background
+                if shadow is not None:
+                    shadow.submit(mrn, latest_creatine_date, features, aki[0])
+                scored_features = dict(
+                    age=patient[1],
+                    sex=patient[2],
+                    C1=C1,
+                    RV1=RV1,
+                    RV1_ratio=RV1_ratio,
+                    RV2=RV2,
+                    RV2_ratio=RV2_ratio,
+                    has_changed_48h=int(change_),
+                    D=D,
+                    aki=aki[0],
+                )
+
+            # If predicted AKI, queue the page; it is sent in the background
+            if aki[0] == "y":
+                with trace.step("page"):
+                    pager.page(mrn, latest_creatine_date)
+
+                if debug:
+                    outputs.append((mrn, latest_creatine_date))
+
+                # prometheus related
+                increment_aki_counter(TOTAL_POSITIVE_AKI)
+                aki_count = aki_count + 1
+                calculate_positive_aki_rate(count_blood, aki_count, AKI_POSITIVE_RATE)
+
+            end_time = datetime.now()
+            latency = end_time - start_time
+            if latency.total_seconds() > 3:
+                increment_latency_counter(LATENCY_EXCEEDS_COUNTER)
+            # insert the current test result into the DB
+            with trace.step("store"):
+                db.insert_test_result(mrn, data[0], data[1], scored_features)
+
+                # check if test result was inserted correctly
+                if not db.get_test_result(mrn, data[0]):
+                    logger.warning(
+                        "Failed to insert test result for %s on %s, trying once more",
+                        mrn,
+                        data[0],
+                    )
+                    # and try again
+                    db.insert_test_result(mrn, data[0], data[1], scored_features)
+
+            if debug:
+                latencies.append(latency)
+        tracer.finish(trace, category, f"{mrn} (#{seq})")
+        last_scored = seq
+        # persist when the stage runs dry, and regularly while it is busy
+        if last_scored - last_persisted >= PIPELINE_PERSIST_INTERVAL:
+            persist()
+
+    # pages not sent before the last shutdown are sent again on start
+    pager = Pager(
+        pager_address,
+        STAGE_QUEUE_DEPTH,
+        STAGE_LATENCY,
+        FAILURE_COUNTER,
+        queue_path=state_path(state_dir, ON_DISK_PAGER_QUEUE_PATH),
+        send_histogram=STEP_LATENCY,
+        stack_path=state_path(state_dir, ON_DISK_PAGER_STACK_PATH),
     )
-    signal.signal(
-        signal.SIGTERM, define_graceful_shutdown(db, current_socket, pager_stack)
+    pager.start()
+
+    # a single scoring worker keeps the messages, and so each MRN, in order
+    scoring_stage = Stage(
+        "scoring",
+        score,
+        PIPELINE_QUEUE_SIZE,
+        STAGE_QUEUE_DEPTH,
+        STAGE_LATENCY,
+        FAILURE_COUNTER,
+        on_idle=persist,
     )
+    stages = [scoring_stage]
+    # set once the process starts shutting down, so the warm-up starts nothing
+    stopping = threading.Event()
+    # held by the warm-up while it checks `stopping` and starts the stages, and by
+    # the shutdown while it stops them, so the stages it stops are all started
+    lifecycle = threading.Lock()
+
+    def warm_up():
+        """
+        Load the database and the models in parallel, then start the stages.
+        """
+        nonlocal db, dt_predictor, shadow
+        loading_shadow = None
+        try:
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                # challengers are scored in their own process, which starts and
+                # loads them alongside the database
+                if SHADOW_MODEL_PATHS:
+                    loading_shadow = executor.submit(
+                        ShadowScorer,
+                        SHADOW_MODEL_PATHS,
+                        SHADOW_PREDICTIONS_COUNTER,
+                        SHADOW_DISAGREEMENTS_COUNTER,
+                        SHADOW_AGREEMENT_RATE,
+                        SHADOW_INFERENCE_SECONDS,
+                        SHADOW_DROPPED_COUNTER,
+                        FAILURE_COUNTER,
+                        path=state_path(state_dir, ON_DISK_SHADOW_PATH),
+                    )
+                # this also loads the previous history
+                loading_db = executor.submit(
+                    open_database,
+                    storage_backend,
+                    history_load_path,
+                    persistence_mode,
+                    shard,
+                    state_dir,
+                )
+                loading_tree = executor.submit(load_compiled_tree, DT_MODEL_PATH)
+                dt_predictor = loading_tree.result()
+                loaded = loading_db.result()
+        except Exception:
+            # acknowledged messages are in the inbound log for the next start,
+            # which does not help this process: it cannot score anything
+            logger.exception(
+                "The database or the models could not be loaded, exiting.."
+            )
+            # os._exit skips the atexit hooks that write the queued records
+            stop_logging()
+            os._exit(1)
+        if loading_shadow is not None:
+            try:
+                shadow = loading_shadow.result()
+            except Exception:
+                # the decision tree does not need them
+                increment_failure_counter(FAILURE_COUNTER)
+                logger.exception("Shadow scoring could not be started..")
+
+        if loaded.database_loaded() == True:
+            logger.info("Database loaded correctly")
+        else:
+            logger.error("Database not loaded properly")
+        assert dt_predictor != None, "Model is not loaded properly..."
+        if loaded.snapshotter is not None:
+            loaded.snapshotter.export(SNAPSHOT_DURATION, SNAPSHOT_STALENESS)
+
+        with lifecycle:
+            if stopping.is_set():
+                # the shutdown is past the stages and the store: nothing has
+                # been scored, so there is nothing to persist
+                loaded.close()
+                if shadow is not None:
+                    shadow.stop()
+                return
+            db = loaded
+            # old test results are compacted in the background, and the compactor
+            # is stopped with the stages so it is done before the store is closed
+            if db.stores_summaries:
+                compactor = Compactor(
+                    db,
+                    COMPACTION_ARCHIVED_COUNTER,
+                    COMPACTION_RECLAIMED_COUNTER,
+                    FEATURE_SUMMARY_BYTES,
+                    FAILURE_COUNTER,
+                )
+                stages.append(compactor)
+            # stopped after the scoring stage that feeds it
+            if shadow is not None:
+                stages.append(shadow)
+            for stage in stages:
+                stage.start()
+        HEALTH.checks.append(scoring_stage.thread.is_alive)
+        HEALTH.ready.set()
+        ready_seconds = time.perf_counter() - PROCESS_STARTED
+        STARTUP_READY_SECONDS.set(ready_seconds)
+        logger.info("Ready %.2fs after the process started", ready_seconds)
+
+    def graceful_shutdown(signum, frame):
+        # the main loop shuts down: the handler may interrupt it anywhere, even
+        # holding the journal or a queue lock
+        stopping.set()
+
+    # register signals for graceful shutdown
+    signal.signal(signal.SIGINT, graceful_shutdown)
+    signal.signal(signal.SIGTERM, graceful_shutdown)
+
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
 
-    # Load the model once for use through out
-    dt_model = load(DT_MODEL_PATH)
-    assert dt_model != None, "Model is not loaded properly..."
-    mlp_model = load(MLP_MODEL_PATH)
-    assert mlp_model != None, "MLP Model is not loaded properly..."
+    # messages acknowledged but not processed before the last shutdown; the
+    # scoring stage holds them until the warm-up starts it
+    pending = inbound_log.pending()
+    if pending:
+        logger.info("Replaying %d messages from the inbound log...", len(pending))
+    for seq, hl7_data in pending:
+        scoring_stage.put((seq, hl7_data, datetime.now(), Trace()))
 
+    # Start the server
+    if feed is None:
+        feed = MLLPFeed(mllp_address, SOCKET_RECONNECTIONS_COUNTER, FAILURE_COUNTER)
+
+    acknowledged = False
     try:
-        count_mlp = 0
-        while True:
-            data, need_to_reconnect = read_from_mllp(sock)
-
-            if need_to_reconnect:
-                sock = connect_to_mllp(mllp_host, mllp_port)
-                # update the current socket for connection management - handle restart and reconnection
-                current_socket["sock"] = sock
-                increment_socket_connections(SOCKET_RECONNECTIONS_COUNTER)
-
-            if data:
-                hl7_data = process_mllp_message(data)
-            else:
-                hl7_data = None
-                print("No data received.")
-
-            if hl7_data:
-                message = parse_hl7_message(hl7_data)
-
-                category, mrn, data = parse_system_message(
-                    message
-                )  # category is type of system message and data consists of age sex if PAS admit or date of blood test and creatanine result
-                print("Parsed values: ", category, mrn, data)
-                increment_message_counter(MESSAGE_COUNTER)
-                if category == "PAS-admit":
-                    increment_patient_admit_counter(PATIENT_ADMIT_COUNTER)
-                    # print('Patient {} inserted'.format(mrn))
-                    print(f"PAS-Admit: Inserting {mrn} into db...")
-                    db.insert_patient(mrn, int(data[0]), str(data[1]))
-                    # check if patient was inserted correctly
-                    if not db.get_patient(mrn):
-                        print(f"Failed to insert patient {mrn}, trying once more")
-                        # and try again
-                        db.insert_patient(mrn, int(data[0]), str(data[1]))
-                elif category == "PAS-discharge":
-                    increment_patient_discharge(PATIENT_DISCHARGE_COUNTER)
-                    print(f"PAS-discharge: Discharging {mrn} ...")
-                    db.discharge_patient(mrn)
-                    # check if patient was discharged correctly
-                    if db.get_patient(mrn):
-                        print(f"Failed to discharge patient {mrn}, trying once more")
-                        # and try again
-                        db.discharge_patient(mrn)
-                elif category == "LIMS":
-                    start_time = datetime.now()
-                    print("Message from LIMS! Retreiving Patient History...")
-                    patient_history = db.get_patient_history(str(mrn))
-
-                    # prometheus related upates
-                    total_blood_sum = total_blood_sum + data[1]
-                    count_blood = count_blood + 1
-                    process_blood_test(total_blood_sum, count_blood, BLOOD_TEST_AVERAGE)
-                    increment_blood_test_counter(TOTAL_BLOOD_TESTS)
-
-                    if len(patient_history) != 0:
-                        print("Patient History found!")
-                        if debug:
-                            count = count + 1
-                        latest_creatine_result = data[1]
-                        latest_creatine_date = data[0]
-                        D, change_ = D_value_compute(
-                            latest_creatine_result,
-                            latest_creatine_date,
-                            patient_history,
-                        )
-                        C1, RV1, RV1_ratio, RV2, RV2_ratio = RV_compute(
-                            latest_creatine_result,
-                            latest_creatine_date,
-                            patient_history,
-                        )
-                        features = [
-                            patient_history[0][1],
-                            label_encode(patient_history[0][2]),
-                            C1,
-                            RV1,
-                            RV1_ratio,
-                            RV2,
-                            RV2_ratio,
-                            change_,
-                            D,
-                        ]
-                        print("Features created...")
-                        input = pd.DataFrame([features], columns=FEATURES_COLUMNS)
-                        print("Calling DT!")
-                        aki = predict_with_dt(dt_model, input)
-                    elif (
-                        patient_history == None or len(patient_history) == 0
-                    ) and db.get_patient(mrn):
-                        print("Patient History doesn't exist...")
-                        latest_creatine_result = data[1]
-                        latest_creatine_date = data[0]
-                        D = 0
-                        change_ = 0
-                        C1 = latest_creatine_result
-                        RV1 = 0
-                        RV1_ratio = 0
-                        RV2 = 0
-                        RV2_ratio = 0
-                        features = [
-                            db.get_patient(mrn)[1],
-                            label_encode(db.get_patient(mrn)[2]),
-                            C1,
-                            RV1,
-                            RV1_ratio,
-                            RV2,
-                            RV2_ratio,
-                            change_,
-                            D,
-                        ]
-                        print("Features created...")
-                        input = pd.DataFrame([features], columns=FEATURES_COLUMNS)
-                        print("Calling DT!")
-                        aki = predict_with_dt(dt_model, input)
-
-                    else:
-                        # This ideally shouldn't happen -
-                        count_mlp = count_mlp + 1
-                        print(
-                            "No such patient in the patients table. Inserting with default values..."
-                        )
-
-                        # insert the patient into the DB - with default values to avoid this flow the next time we get a test result for this patient
-                        db.insert_patient(mrn, DEFAULT_AGE, DEFAULT_SEX)
-                        print(f"Inserted new patient with MRN: {mrn}!")
-                        # Predict NO AKI for the current LIMS message.
-                        aki = ["n"]
-
-                    # If predicted AKI, send the Pager request
-                    # and update the pager stack
-                    if aki[0] == "y":
-                        pager_stack = send_pager_request(
-                            mrn, latest_creatine_date, pager_address, pager_stack
-                        )
-
-                        if debug:
-                            outputs.append((mrn, latest_creatine_date))
-
-                        # prometheus related
-                        increment_aki_counter(TOTAL_POSITIVE_AKI)
-                        aki_count = aki_count + 1
-                        calculate_positive_aki_rate(
-                            count_blood, aki_count, AKI_POSITIVE_RATE
-                        )
-
-                    end_time = datetime.now()
-                    latency = end_time - start_time
-                    if latency.total_seconds() > 3:
-                        increment_latency_counter(LATENCY_EXCEEDS_COUNTER)
-                    latency_time = latency_time + latency.total_seconds()
-                    calculate_latency_average(
-                        latency_time, count_blood, LATENCY_AVERAGE
+        while not stopping.is_set():
+            # wake up regularly to notice a shutdown request
+            if not feed.poll(FEED_POLL_INTERVAL):
+                continue
+            # the messages received back to back are made durable with one fsync
+            # and acknowledged with one write
+            received = []
+            for hl7_data, frame_started in feed.read_messages():
+                if not hl7_data:
+                    logger.warning("No valid MLLP message received.")
+                    continue
+                trace = Trace(frame_started)
+                trace.add("read", time.perf_counter() - trace.started)
+                received.append((hl7_data, trace))
+            if received:
+                received_at = datetime.now()
+                # the messages are safe on disk before they are acknowledged
+                log_started = time.perf_counter()
+                seqs = [inbound_log.append(hl7_data) for hl7_data, _ in received]
+                inbound_log.sync()
+                ack_started = time.perf_counter()
+                feed.acknowledge(len(received))
+                ack_finished = time.perf_counter()
+                for _, trace in received:
+                    trace.add("log", ack_started - log_started)
+                    trace.add("ack", ack_finished - ack_started)
+                if not acknowledged:
+                    acknowledged = True
+                    first_ack_seconds = time.perf_counter() - PROCESS_STARTED
+                    STARTUP_FIRST_ACK_SECONDS.set(first_ack_seconds)
+                    logger.info(
+                        "First message acknowledged %.2fs after the process started",
+                        first_ack_seconds,
                     )
-                    # insert the current test result into the DB
-                    db.insert_test_result(mrn, data[0], data[1])
-
-                    if debug:
-                        latency = end_time - start_time
-                        latencies.append(latency)
-
-                    # check if test result was inserted correctly
-                    if not db.get_test_result(mrn, data[0]):
-                        print(
-                            f"Failed to insert test result for {mrn} on {data[0]}, trying once more"
-                        )
-                        # and try again
-                        db.insert_test_result(mrn, data[0], data[1])
-                # after every message persist the data
-                db.persist_db()
-                # ack the message
-                print("Sending ACK message...")
-                ack_message = create_acknowledgement()
-                sock.sendall(ack_message)
-                print("-" * 80)
-            else:
-                print("No valid MLLP message received.")
-    except Exception as e:
+                observe_stage_latency(
+                    STAGE_LATENCY,
+                    "reader",
+                    (datetime.now() - received_at).total_seconds(),
+                )
+                # blocks while the scoring stage is full, once it is started
+                for seq, (hl7_data, trace) in zip(seqs, received):
+                    scoring_stage.put((seq, hl7_data, received_at, trace))
+    except EOFError:
+        # a shard's coordinator closed the feed
+        logger.info("Feed closed, shutting down..")
+    except Exception:
         increment_failure_counter(FAILURE_COUNTER)
-        print("There was an exception in the main loop..")
-        traceback.print_exc()
-        sys.stderr.write(str(e))
+        logger.exception("There was an exception in the main loop..")
     finally:
-        # perform any cleanup or data persistance tasks
-        # (this is done when we encounter an exception or if the
-        # program finishes its flow normally - so it is separate from the
-        # graceful shutdown)
-        try:
-            db.persist_db()
-            db.close()
-            print("Database persisted")
-            print("Number of times MLP condition satisfied:", count_mlp)
-        except:
-            print("Database has already been persisted and closed.")
+        # perform any cleanup or data persistance tasks, once, whether a signal
+        # asked for the shutdown, the feed closed or the main loop failed
+        if stopping.is_set():
+            logger.info("Graceful shutdown procedure started.")
+        stopping.set()
+        # the warm-up either started the stages and published the store before
+        # this, or it starts neither
+        with lifecycle:
+            for stage in stages:
+                stage.stop()
+        if db is None:
+            # before the warm-up is done nothing has been scored, and the messages
+            # acknowledged so far are replayed from the inbound log on the next start
+            logger.info("Shutting down before the warm-up finished.")
+            inbound_log.close()
+        else:
+            try:
+                persist()
+                inbound_log.close()
+                db.persist_db()
+                db.close()
+                logger.info("Database persisted")
+                logger.info("Number of times MLP condition satisfied: %d", count_mlp)
+            except:
+                logger.info("Database has already been persisted and closed.")
 
         try:
-            current_socket["sock"].close()
-            print("MLLP connection closed")
+            feed.close()
+            logger.info("MLLP connection closed")
         except:
-            print("MLLP connection has already been closed.")
+            logger.info("MLLP connection has already been closed.")
 
-        with open(ON_DISK_PAGER_STACK_PATH, "wb") as file:
-            pickle.dump(pager_stack, file)
+        pager.stop()
+        logger.info("Pager stopped")
 
     if debug:
-        print("Patients with Historical Data", count)
+        logger.info("Patients with Historical Data %d", count)
 
         # Calculate latency metrics
         mean_latency = np.mean(latencies)
@@ -347,11 +668,49 @@ def start_server(
             "Maximum": max_latency,
             "99% Efficiency": percentile_99,
         }
-        print(metrics)
+        logger.info("Latency metrics: %s", metrics)
 
         df = pd.DataFrame(outputs, columns=["mrn", "date"])
         df["date"] = pd.to_datetime(df["date"]).dt.strftime("%Y-%m-%d %H:%M:%S")
-        df.to_csv("aki_predicted.csv", index=False)
+        if shard is None:
+            df.to_csv("aki_predicted.csv", index=False)
+        else:
+            df.to_csv(f"aki_predicted-{shard[0]}.csv", index=False)
+
+
+def run_shard(
+    index,
+    count,
+    connection,
+    history_load_path,
+    pager_address,
+    debug,
+    persistence_mode,
+    storage_backend,
+):
+    """
+    Entry point of a shard process: runs the pipeline on the messages the
+    coordinator routes to it, with its state in its own directory, exporting its
+    metrics on its own port.
+    """
+    # a spawned process starts without the coordinator's logging
+    configure_logging()
+    metrics_thread = threading.Thread(
+        target=start_metrics_server, args=(METRICS_PORT + 1 + index, HEALTH)
+    )
+    metrics_thread.daemon = True
+    metrics_thread.start()
+    start_server(
+        history_load_path,
+        None,
+        pager_address,
+        debug=debug,
+        persistence_mode=persistence_mode,
+        feed=ShardFeed(connection),
+        shard=(index, count),
+        storage_backend=storage_backend,
+        state_dir=shard_state_dir(index),
+    )
 
 
 def main():
@@ -368,20 +727,41 @@ def main():
         type=str,
         help="Where to load the history.csv file from",
     )
+    configure_logging()
     # Start the metrics server in a background thread
-    metrics_thread = threading.Thread(target=start_metrics_server, args=(8000,))
+    metrics_thread = threading.Thread(
+        target=start_metrics_server, args=(METRICS_PORT, HEALTH)
+    )
     metrics_thread.daemon = True
     metrics_thread.start()
     HISTORY_PATH = os.environ.get("HISTORY_PATH", "data/history.csv")
     MLLP_LINK = os.environ.get("MLLP_ADDRESS", "0.0.0.0:8440")
     PAGER_LINK = os.environ.get("PAGER_ADDRESS", "0.0.0.0:8441")
+    PERSISTENCE_MODE = os.environ.get("PERSISTENCE_MODE", "journal")
+    STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite")
+    # several comma separated MLLP addresses, or more than one shard, run the
+    # sharded coordinator
+    SHARDS = int(os.environ.get("SHARDS", "1"))
     flags = parser.parse_args()
-    pager_stack = []
-    if os.path.exists(ON_DISK_PAGER_STACK_PATH):
-        with open(ON_DISK_PAGER_STACK_PATH, "rb") as file:
-            pager_stack = pickle.load(file)
+    mllp_addresses = MLLP_LINK.split(",")
+    if SHARDS > 1 or len(mllp_addresses) > 1:
+        run_coordinator(
+            mllp_addresses,
+            SHARDS,
+            run_shard,
+            (HISTORY_PATH, PAGER_LINK, flags.debug, PERSISTENCE_MODE, STORAGE_BACKEND),
+            SOCKET_RECONNECTIONS_COUNTER,
+            FAILURE_COUNTER,
+            HEALTH,
+        )
+        return
     start_server(
-        HISTORY_PATH, MLLP_LINK, PAGER_LINK, pager_stack=pager_stack, debug=flags.debug
+        HISTORY_PATH,
+        MLLP_LINK,
+        PAGER_LINK,
+        debug=flags.debug,
+        persistence_mode=PERSISTENCE_MODE,
+        storage_backend=STORAGE_BACKEND,
     )
 
 
@@ -1,26 +1,99 @@
+import logging
 import sqlite3
-from constants import ON_DISK_DB_PATH
+from constants import (
+    ON_DISK_DB_PATH,
+    ON_DISK_JOURNAL_PATH,
+    PERSISTENCE_MODES,
+    SNAPSHOT_BACKUP_PAGES,
+    COMPACTION_AGE,
+    COMPACTION_CHUNK_SIZE,
+)
 import os
-from utils import populate_test_results_table, populate_patients_table
+from utils import (
+    populate_test_results_table,
+    populate_patients_table,
+    to_epoch_seconds,
+    is_lims_date,
+    encode_date,
+    decode_date,
+)
+from feature_cache import FeatureCache, FeatureSummary, SUMMARY_COLUMNS
+from itertools import groupby
+from storage import Storage
+from snapshotter import Snapshotter
 import threading
+import time
 
+logger = logging.getLogger(__name__)
 
-class InMemoryDatabase:
-    def __init__(self, history_load_path):
+# The id of an MRN in the mrns table, test_results refers to patients by it
+MRN_ID = "(SELECT id FROM mrns WHERE mrn = ?)"
+
+# Stores a patient's FeatureSummary in their row of the features table
+SAVE_FEATURE_SUMMARY = f"""
+    INSERT INTO features (mrn, {", ".join(SUMMARY_COLUMNS)})
+    VALUES (?{", ?" * len(SUMMARY_COLUMNS)})
+    ON CONFLICT (mrn) DO UPDATE SET
+        {", ".join(f"{column} = excluded.{column}" for column in SUMMARY_COLUMNS)}
+"""
+
+
+class InMemoryDatabase(Storage):
+    def __init__(
+        self, history_load_path, persistence_mode="backup", shard=None, state_dir=None
+    ):
+        assert (
+            persistence_mode in PERSISTENCE_MODES
+        ), f"Unknown persistence mode: {persistence_mode}"
+        self.persistence_mode = persistence_mode
+        # the snapshot and journal live in STATE_DIR unless told otherwise
+        if state_dir is None:
+            self.db_path = ON_DISK_DB_PATH
+            self.journal_path = ON_DISK_JOURNAL_PATH
+        else:
+            self.db_path = os.path.join(state_dir, "database.db")
+            self.journal_path = os.path.join(state_dir, "journal.log")
+        # compacted test results are archived next to the snapshot
+        self.archive_path = os.path.join(os.path.dirname(self.db_path), "archive.db")
+        # (index, count) when this database only holds the patients of one shard
+        self.shard = shard
         self.on_disk_db_lock = threading.Lock()
         self.disk_db_being_accessed = False
         self.discharged_patient_mrns = {}
-        self.connection = sqlite3.connect(":memory:")
+        # the journal is only written once the database has been loaded
+        self.journal = None
+        self.journal_lock = threading.Lock()
+        # entries appended since the journal was last made durable
+        self.journal_entries = 0
+        self.feature_cache = FeatureCache()
+        # held around every write and its commit, and while a feature summary
+        # is read, updated and stored: the compaction writes through the same
+        # connection from its own thread, and a commit there would otherwise
+        # commit a half-finished write of the message loop, or the other way round
+        self.write_lock = threading.RLock()
+        # snapshots are taken from a background thread in journal mode
+        self.connection = sqlite3.connect(":memory:", check_same_thread=False)
+        # lets the compaction hand the pages it frees back
+        self.connection.execute("PRAGMA auto_vacuum = INCREMENTAL")
         self.initialise_tables()
-        self.load_db(history_load_path)
+        changed_entries = self.load_db(history_load_path)
         # make sure we always have a db file
-        if not os.path.exists(ON_DISK_DB_PATH):
+        if not os.path.exists(self.db_path):
             # create the directories if they don't already exist
             os.makedirs(
-                "/".join(ON_DISK_DB_PATH.split("/")[:-1]), mode=0o700, exist_ok=True
+                "/".join(self.db_path.split("/")[:-1]), mode=0o700, exist_ok=True
             )
             # persist the database on-disk
-            self.persist_db()
+            self.snapshot()
+        elif changed_entries > 0:
+            # fold the replayed journal, or the migrated results, into a fresh snapshot
+            self.snapshot()
+        self.attach_archive()
+        # in journal mode snapshots are taken in the background
+        self.snapshotter = Snapshotter(self.snapshot)
+        if self.persistence_mode == "journal":
+            self.journal = open(self.journal_path, "a")
+            self.snapshotter.start()
 
     def initialise_tables(self):
         """
@@ -33,13 +106,23 @@ class InMemoryDatabase:
                 sex TEXT
             );
         """
+        # MRNs are interned, so a test result refers to its patient by id
+        create_mrns = """
+            CREATE TABLE mrns (
+                id INTEGER PRIMARY KEY,
+                mrn TEXT UNIQUE
+            );
+        """
+        # dates are stored as seconds since the epoch and whether they came
+        # from LIMS, see `encode_date`; the (mrn_id, time, lims) index is built
+        # by `create_indexes` once the history has been bulk loaded
         create_test_results = """
             CREATE TABLE test_results (
-                mrn TEXT,   
-                date DATETIME,
-                result DECIMAL,
-                PRIMARY KEY (mrn, date),
-                FOREIGN KEY (mrn) REFERENCES patients (mrn)
+                mrn_id INTEGER,
+                time INTEGER,
+                lims INTEGER,
+                result REAL,
+                FOREIGN KEY (mrn_id) REFERENCES mrns (id)
             );
         """
         create_patient_features = """
@@ -54,14 +137,159 @@ class InMemoryDatabase:
                 RV2_ratio DECIMAL,
                 has_changed_48h INTEGER,
                 D DECIMAL,
-                aki TEXT
+                aki TEXT,
+                last_time INTEGER,
+                last_result DECIMAL,
+                latest_text_time INTEGER,
+                latest_integer_time INTEGER,
+                minimum DECIMAL,
+                older_count INTEGER,
+                older_minimum DECIMAL,
+                recent_times BLOB,
+                recent_results BLOB,
+                lower_dropped INTEGER,
+                lower_bound DECIMAL,
+                upper_dropped INTEGER,
+                upper_bound DECIMAL,
+                upper_results BLOB,
+                lower_results BLOB
             );
         """
         # create the tables
         self.connection.execute(create_patients)
+        self.connection.execute(create_mrns)
         self.connection.execute(create_test_results)
         self.connection.execute(create_patient_features)
 
+    def migrate_features_table(self):
+        """
+        Add the feature summary columns to a features table loaded from a
+        snapshot taken before they existed, and drop the sorted results of the
+        summaries from before the median was kept in two heaps. Those summaries
+        are built again when next needed.
+        """
+        columns = [
+            row[1] for row in self.connection.execute("PRAGMA table_info(features)")
+        ]
+        for column in SUMMARY_COLUMNS:
+            if column not in columns:
+                self.connection.execute(f"ALTER TABLE features ADD COLUMN {column}")
+        if "results" in columns:
+            self.connection.execute("ALTER TABLE features DROP COLUMN results")
+        self.connection.commit()
+
+    def migrate_test_results(self, schema="main"):
+        """
+        Convert the test_results table of a snapshot, or of an archive, from
+        before MRNs were interned and dates stored as integers. The dates are
+        converted once here, rather than whenever they are read.
+        Args:
+            - schema {str}: "main" or "archive"
+        Returns:
+            - migrated {int}: the number of test results converted
+        """
+        columns = [
+            row[1]
+            for row in self.connection.execute(f"PRAGMA {schema}.table_info(test_results)")
+        ]
+        if "date" not in columns:
+            return 0
+        self.connection.create_function(
+            "epoch_seconds", 1, to_epoch_seconds, deterministic=True
+        )
+        self.connection.create_function(
+            "is_lims_date", 1, lambda date: int(is_lims_date(date)), deterministic=True
+        )
+        with self.connection:
+            self.connection.execute(
+                f"ALTER TABLE {schema}.test_results RENAME TO text_test_results"
+            )
+            if schema == "main":
+                self.connection.execute(
+                    "CREATE TABLE IF NOT EXISTS mrns (id INTEGER PRIMARY KEY, mrn TEXT UNIQUE)"
+                )
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO mrns (mrn) SELECT DISTINCT mrn FROM text_test_results"
+                )
+                self.connection.execute(
+                    """
+                    CREATE TABLE test_results (
+                        mrn_id INTEGER, time INTEGER, lims INTEGER, result REAL
+                    )
+                    """
+                )
+                cursor = self.connection.execute(
+                    """
+                    INSERT INTO test_results (mrn_id, time, lims, result)
+                    SELECT mrns.id, epoch_seconds(date), is_lims_date(date), result
+                    FROM text_test_results JOIN mrns ON mrns.mrn = text_test_results.mrn
+                    """
+                )
+            else:
+                self.create_archive_table()
+                cursor = self.connection.execute(
+                    """
+                    INSERT OR IGNORE INTO archive.test_results (mrn, time, lims, result)
+                    SELECT mrn, epoch_seconds(date), is_lims_date(date), result
+                    FROM archive.text_test_results
+                    """
+                )
+            self.connection.execute(f"DROP TABLE {schema}.text_test_results")
+        if schema == "main":
+            self.create_indexes()
+        logger.info(
+            "Migrated %d %s test results to interned MRNs and integer dates.",
+            cursor.rowcount,
+            schema,
+        )
+        return cursor.rowcount
+
+    def attach_archive(self):
+        """
+        Attach the on-disk archive of compacted test results as the `archive`
+        schema of the connection, creating it on the first start. Archived
+        results keep their MRN as text, as the ids of the in-memory database
+        are only durable once in a snapshot.
+        """
+        self.connection.commit()
+        self.connection.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+        self.migrate_test_results("archive")
+        self.create_archive_table()
+        self.connection.commit()
+
+    def create_archive_table(self):
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS archive.test_results (
+                mrn TEXT,
+                time INTEGER,
+                lims INTEGER,
+                result REAL
+            )
+            """
+        )
+        self.connection.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS archive.test_results_key ON test_results (mrn, time, lims)"
+        )
+
+    def create_indexes(self):
+        """
+        Build the unique (mrn_id, time, lims) index on test_results. Duplicate
+        rows loaded before the index existed are dropped first, keeping the first
+        one loaded.
+        """
+        self.connection.execute(
+            """
+            DELETE FROM test_results WHERE rowid NOT IN (
+                SELECT MIN(rowid) FROM test_results GROUP BY mrn_id, time, lims
+            )
+            """
+        )
+        self.connection.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS test_results_key ON test_results (mrn_id, time, lims)"
+        )
+        self.connection.commit()
+
     def insert_patient_features(
         self, mrn, age, sex, c1, rv1, rv1_r, rv2, rv2_r, change, D, aki=None
     ):
@@ -87,13 +315,17 @@ class InMemoryDatabase:
                 (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
         """
         # execute the query
-        try:
-            self.connection.execute(
-                query, (mrn, age, sex, c1, rv1, rv1_r, rv2, rv2_r, change, D, aki)
-            )
-            self.connection.commit()
-        except sqlite3.IntegrityError:
-            print(f"The features for patient {mrn} are already in the features table!")
+        with self.write_lock:
+            try:
+                self.connection.execute(
+                    query, (mrn, age, sex, c1, rv1, rv1_r, rv2, rv2_r, change, D, aki)
+                )
+                self.connection.commit()
+            except sqlite3.IntegrityError:
+                logger.warning(
+                    "The features for patient %s are already in the features table!",
+                    mrn,
+                )
 
     def insert_patient(self, mrn, age, sex, update_disk_db=True):
         """
@@ -109,16 +341,18 @@ class InMemoryDatabase:
             VALUES 
                 (?, ?, ?)
         """
-        # in case the patient was discharged before
-        if mrn in self.discharged_patient_mrns:
-            self.discharged_patient_mrns[mrn] = False
-        # execute the query
-        try:
-            self.connection.execute(query, (mrn, age, sex))
-            self.connection.commit()
+        with self.write_lock:
+            # in case the patient was discharged before
+            if mrn in self.discharged_patient_mrns:
+                self.discharged_patient_mrns[mrn] = False
+            # execute the query
+            try:
+                self.connection.execute(query, (mrn, age, sex))
+                self.connection.commit()
+                self.append_to_journal("A", mrn, age, sex)
 
-        except sqlite3.IntegrityError:
-            print(f"Patient {mrn} is already in the patients table!")
+            except sqlite3.IntegrityError:
+                logger.warning("Patient %s is already in the patients table!", mrn)
 
         # if update_disk_db:
         #     disk_conn = sqlite3.connect(ON_DISK_DB_PATH)
@@ -126,29 +360,94 @@ class InMemoryDatabase:
         #     disk_conn.commit()
         #     disk_conn.close()
 
-    def insert_test_result(self, mrn, date, result):
+    def insert_test_result(self, mrn, date, result, features=None):
         """
-        Insert the patient info from PAS into the in-memory database.
+        Insert a test result into the in-memory database, with the patient's
+        feature summary and, when given, the features the result was scored
+        with, in a single transaction.
         Args:
             - mrn {str}: Medical Record Number of the patient
             - date {datetime}: creatinine result date
             - result {float}: creatinine result
+            - features {dict}: columns of the features row to update, see
+              `update_patient_features`
         """
-        query = """
+        query = f"""
             INSERT INTO test_results 
-                (mrn, date, result) 
+                (mrn_id, time, lims, result) 
             VALUES 
-                (?, ?, ?)
+                ({MRN_ID}, ?, ?, ?)
         """
+        # the date is converted once, here
+        time_, lims = encode_date(date)
 
-        # execute the query
-        try:
-            self.connection.execute(query, (mrn, date, result))
-            self.connection.commit()
-        except sqlite3.IntegrityError:
-            print(
-                f"Test result on date-time: {date} for: {mrn} is already in the test_results table!"
-            )
+        with self.write_lock:
+            # the summary is loaded before the result is in test_results
+            summary = self.get_feature_state(mrn)
+            # execute the query
+            try:
+                with self.connection:
+                    self.connection.execute(
+                        "INSERT OR IGNORE INTO mrns (mrn) VALUES (?)", (mrn,)
+                    )
+                    self.connection.execute(query, (mrn, time_, lims, result))
+                    summary.add_time(time_, lims, result)
+                    self.save_feature_summary(mrn, summary)
+                    if features:
+                        self.write_patient_features(mrn, features)
+            except sqlite3.IntegrityError:
+                logger.warning(
+                    "Test result on date-time: %s for: %s is already in the test_results table!",
+                    date,
+                    mrn,
+                )
+                return
+            except Exception:
+                # the cached summary has the result that was rolled back
+                self.feature_cache.drop(mrn)
+                raise
+            self.append_to_journal("R", mrn, date, result)
+
+    def insert_test_results(self, rows):
+        """
+        Insert many test results in a single transaction. Rows that are already
+        in the table are skipped. MRNs are interned and dates converted as the
+        rows stream in.
+        Args:
+            - rows {iterable}: (mrn, date, result) tuples, can be a generator
+        Returns:
+            - inserted {int}: the number of rows inserted
+        """
+        query = """
+            INSERT OR IGNORE INTO test_results 
+                (mrn_id, time, lims, result) 
+            VALUES 
+                (?, ?, ?, ?)
+        """
+
+        def encoded_rows():
+            for mrn, date, result in rows:
+                mrn_id = mrn_ids.get(mrn)
+                if mrn_id is None:
+                    mrn_id = mrn_ids[mrn] = next_id + len(new_mrns)
+                    new_mrns.append((mrn_id, mrn))
+                yield (mrn_id,) + encode_date(date) + (result,)
+
+        with self.write_lock:
+            mrn_ids = dict(self.connection.execute("SELECT mrn, id FROM mrns"))
+            next_id = self.connection.execute(
+                "SELECT COALESCE(MAX(id), 0) + 1 FROM mrns"
+            ).fetchone()[0]
+            new_mrns = []
+            with self.connection:
+                cursor = self.connection.executemany(query, encoded_rows())
+                self.connection.executemany(
+                    "INSERT INTO mrns (id, mrn) VALUES (?, ?)", new_mrns
+                )
+                # summaries are built again from test_results when next needed
+                self.connection.execute("UPDATE features SET lower_results = NULL")
+            self.feature_cache.clear()
+        return cursor.rowcount
 
     def get_patient_features(self, mrn):
         """
@@ -157,9 +456,222 @@ class InMemoryDatabase:
             - mrn {str}: Medical Record Number
         """
         cursor = self.connection.cursor()
-        cursor.execute("SELECT * FROM features WHERE mrn = ?", (mrn,))
+        cursor.execute(
+            """
+            SELECT
+                mrn, age, sex, C1, RV1, RV1_ratio, RV2, RV2_ratio, has_changed_48h, D, aki
+            FROM features WHERE mrn = ?
+            """,
+            (mrn,),
+        )
         return cursor.fetchone()
 
+    def get_feature_state(self, mrn):
+        """
+        Get the feature summary of a patient, from the cache or else from
+        `load_feature_summary`.
+        Args:
+            - mrn {str}: Medical Record Number
+        Returns:
+            - _ {FeatureSummary}: the summary, empty if there are no results
+        """
+        return self.feature_cache.get(mrn, lambda: self.load_feature_summary(mrn))
+
+    def load_feature_summary(self, mrn):
+        """
+        Read the feature summary of a patient from their row of the features
+        table, or build it from their test results and store it there if the row
+        has none.
+        Args:
+            - mrn {str}: Medical Record Number
+        Returns:
+            - summary {FeatureSummary}: the summary, empty if there are no results
+        """
+
+        def load_results():
+            return self.get_result_times(mrn)
+
+        with self.write_lock:
+            cursor = self.connection.cursor()
+            cursor.execute(
+                f"SELECT {', '.join(SUMMARY_COLUMNS)} FROM features WHERE mrn = ?",
+                (mrn,),
+            )
+            row = cursor.fetchone()
+            # the summary is dropped when results are added behind its back
+            if row is not None and row[-1] is not None:
+                return FeatureSummary.from_row(row, load_results)
+            summary = FeatureSummary(load_results)
+            for time_, lims, result in load_results():
+                summary.add_time(time_, lims, result)
+            with self.connection:
+                self.save_feature_summary(mrn, summary)
+            return summary
+
+    def get_result_times(self, mrn):
+        """
+        Query the (time, lims, result) test results of a patient as stored, the
+        archived ones included. A result both archived and in test_results, as
+        left by a crash during a compaction, is only returned once.
+        Args:
+            - mrn {str}: Medical Record Number
+        """
+        cursor = self.connection.cursor()
+        cursor.execute(
+            f"""
+            SELECT time, lims, result FROM test_results WHERE mrn_id = {MRN_ID}
+            UNION
+            SELECT time, lims, result FROM archive.test_results WHERE mrn = ?
+            """,
+            (mrn, mrn),
+        )
+        return cursor.fetchall()
+
+    def get_all_test_results(self, mrn):
+        """
+        Query the (date, result) test results of a patient, the archived ones
+        included, see `get_result_times`.
+        Args:
+            - mrn {str}: Medical Record Number
+        """
+        return [
+            (decode_date(time_, lims), result)
+            for time_, lims, result in self.get_result_times(mrn)
+        ]
+
+    def save_feature_summary(self, mrn, summary):
+        """
+        Store the feature summary of a patient in their row of the features
+        table, without committing, with the write lock held.
+        Args:
+            - mrn {str}: Medical Record Number
+            - summary {FeatureSummary}: the patient's summary
+        """
+        self.connection.execute(SAVE_FEATURE_SUMMARY, (mrn,) + summary.to_row())
+
+    def rebuild_features(self):
+        """
+        Regenerate the feature summary of every patient with test results from
+        the test_results table and the archive, in bulk.
+        Returns:
+            - rebuilt {int}: the number of summaries written
+        """
+        with self.write_lock:
+            cursor = self.connection.cursor()
+            cursor.execute(
+                """
+                SELECT mrns.mrn, time, lims, result
+                FROM test_results JOIN mrns ON mrns.id = test_results.mrn_id
+                UNION
+                SELECT mrn, time, lims, result FROM archive.test_results
+                ORDER BY 1
+                """
+            )
+            rows = []
+            for mrn, results in groupby(cursor, key=lambda row: row[0]):
+                summary = FeatureSummary()
+                for _, time_, lims, result in results:
+                    summary.add_time(time_, lims, result)
+                rows.append((mrn,) + summary.to_row())
+            with self.connection:
+                self.connection.execute("UPDATE features SET lower_results = NULL")
+                self.connection.executemany(SAVE_FEATURE_SUMMARY, rows)
+            self.feature_cache.clear()
+        return len(rows)
+
+    def compact(self, age=COMPACTION_AGE, stopping=None):
+        """
+        Move the test results more than `age` seconds older than their patient's
+        latest result from test_results to the archive. The features only need
+        the aggregates of those results, which the patient's feature summary
+        keeps, so the summary is stored before they move. It holds the results
+        nearest the median and counts the others, so it does not grow with what
+        is archived. Patients are compacted COMPACTION_CHUNK_SIZE at a time, so
+        the message loop gets the connection in between.
+        Args:
+            - age {int}: age in seconds, relative to the patient's latest result
+            - stopping {threading.Event}: stops the compaction between two chunks once set
+        Returns:
+            - archived {int}: the number of test results archived
+            - reclaimed {int}: the number of bytes the in-memory database no
+              longer holds, net of the summaries stored for the move
+        """
+        cursor = self.connection.cursor()
+        cursor.execute("SELECT DISTINCT mrn_id FROM test_results")
+        mrn_ids = [row[0] for row in cursor]
+        archived = 0
+        reclaimed = 0
+        for start in range(0, len(mrn_ids), COMPACTION_CHUNK_SIZE):
+            if stopping is not None and stopping.is_set():
+                break
+            chunk = mrn_ids[start : start + COMPACTION_CHUNK_SIZE]
+            # the rows read, the summaries stored and the move are one step for
+            # the message loop, which writes through the same connection
+            with self.write_lock:
+                used_bytes = self.used_bytes()
+                cursor.execute(
+                    f"""
+                    SELECT mrns.mrn, test_results.rowid, time, lims, result
+                    FROM test_results JOIN mrns ON mrns.id = test_results.mrn_id
+                    WHERE mrn_id IN ({", ".join("?" * len(chunk))}) ORDER BY mrn_id
+                    """,
+                    chunk,
+                )
+                old_rows = []
+                for mrn, rows in groupby(cursor.fetchall(), key=lambda row: row[0]):
+                    rows = list(rows)
+                    cutoff = max(row[2] for row in rows) - age
+                    moved = [row for row in rows if row[2] < cutoff]
+                    if moved:
+                        self.load_feature_summary(mrn)
+                        old_rows.extend(moved)
+                if not old_rows:
+                    continue
+                with self.connection:
+                    self.connection.executemany(
+                        "INSERT OR IGNORE INTO archive.test_results (mrn, time, lims, result) VALUES (?, ?, ?, ?)",
+                        [
+                            (mrn, time_, lims, result)
+                            for mrn, _, time_, lims, result in old_rows
+                        ],
+                    )
+                    self.connection.executemany(
+                        "DELETE FROM test_results WHERE rowid = ?",
+                        [(rowid,) for _, rowid, _, _, _ in old_rows],
+                    )
+                reclaimed += used_bytes - self.used_bytes()
+            archived += len(old_rows)
+        # hands the freed pages back, a no-op on snapshots taken before
+        # incremental vacuuming was turned on. executescript commits first
+        with self.write_lock:
+            self.connection.executescript("PRAGMA main.incremental_vacuum")
+        return archived, reclaimed
+
+    def summary_bytes(self):
+        """
+        The number of bytes of the arrays of the feature summaries in the
+        features table.
+        """
+        return self.connection.execute(
+            """
+            SELECT
+                COALESCE(SUM(length(recent_times)), 0)
+                + COALESCE(SUM(length(recent_results)), 0)
+                + COALESCE(SUM(length(upper_results)), 0)
+                + COALESCE(SUM(length(lower_results)), 0)
+            FROM features
+            """
+        ).fetchone()[0]
+
+    def used_bytes(self):
+        """
+        The number of bytes of the in-memory database holding data.
+        """
+        page_size = self.connection.execute("PRAGMA main.page_size").fetchone()[0]
+        pages = self.connection.execute("PRAGMA main.page_count").fetchone()[0]
+        free_pages = self.connection.execute("PRAGMA main.freelist_count").fetchone()[0]
+        return (pages - free_pages) * page_size
+
     def database_loaded(self):
         """
         Query the patients table to check if it is currently loaded
@@ -189,11 +701,19 @@ class InMemoryDatabase:
             - mrn {str}: Medical Record Number
             - date {str}: The date and time of the test
         """
+        try:
+            time_, lims = encode_date(date)
+        except ValueError:
+            return None
         cursor = self.connection.cursor()
         cursor.execute(
-            "SELECT * FROM test_results WHERE mrn = ? AND date = ?", (mrn, date)
+            f"SELECT result FROM test_results WHERE mrn_id = {MRN_ID} AND time = ? AND lims = ?",
+            (mrn, time_, lims),
         )
-        return cursor.fetchone()
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return (mrn, decode_date(time_, lims), row[0])
 
     def get_test_results(self, mrn):
         """
@@ -202,8 +722,18 @@ class InMemoryDatabase:
             - mrn {str}: Medical Record Number
         """
         cursor = self.connection.cursor()
-        cursor.execute("SELECT * FROM test_results WHERE mrn = ?", (mrn,))
-        return cursor.fetchall()
+        # LIMS dates first, as when they were stored as integers before text
+        cursor.execute(
+            f"""
+            SELECT time, lims, result FROM test_results WHERE mrn_id = {MRN_ID}
+            ORDER BY lims DESC, time
+            """,
+            (mrn,),
+        )
+        return [
+            (mrn, decode_date(time_, lims), result)
+            for time_, lims, result in cursor.fetchall()
+        ]
 
     def get_patient_history(self, mrn):
         """
@@ -218,19 +748,28 @@ class InMemoryDatabase:
                 patients.mrn,
                 patients.age,
                 patients.sex,
-                test_results.date,
+                test_results.time,
+                test_results.lims,
                 test_results.result
             FROM
                 patients
+            JOIN
+                mrns
+            ON
+                mrns.mrn = patients.mrn
             JOIN
                 test_results 
             ON
-                patients.mrn = test_results.mrn
+                test_results.mrn_id = mrns.id
             WHERE patients.mrn = ?
+            ORDER BY test_results.lims DESC, test_results.time
         """
         cursor = self.connection.cursor()
         cursor.execute(query, (mrn,))
-        return cursor.fetchall()
+        return [
+            (mrn, age, sex, decode_date(time_, lims), result)
+            for mrn, age, sex, time_, lims, result in cursor.fetchall()
+        ]
 
     def discharge_patient(self, mrn):
         """
@@ -239,80 +778,224 @@ class InMemoryDatabase:
         Args:
             - mrn {str}: Medical Record Number
         """
-        # save to queue for on-disk sync
-        self.discharged_patient_mrns[mrn] = True
-        # delete from in-memory
-        self.connection.execute("DELETE FROM patients WHERE mrn = ?", (mrn,))
-        self.connection.commit()
+        with self.write_lock:
+            # save to queue for on-disk sync
+            self.discharged_patient_mrns[mrn] = True
+            # delete from in-memory
+            self.connection.execute("DELETE FROM patients WHERE mrn = ?", (mrn,))
+            self.connection.commit()
+            self.append_to_journal("D", mrn)
+        self.feature_cache.discharge(mrn)
 
     def execute_queued_operations(self, disk_connection):
         """
         Perform any queued operations on the on-disk database.
         """
         # delete the discharged patients
-        print("Started executing queued operations.")
-        for mrn in self.discharged_patient_mrns:
-            if self.discharged_patient_mrns[mrn]:
+        logger.debug("Started executing queued operations.")
+        # swap the queue out, as snapshots may run alongside the message loop
+        with self.write_lock:
+            queued, self.discharged_patient_mrns = self.discharged_patient_mrns, {}
+        for mrn, discharged in queued.items():
+            if discharged:
                 disk_connection.execute("DELETE FROM patients WHERE mrn = ?", (mrn,))
         disk_connection.commit()
-        print("Finished commiting queued operations.")
-        self.discharged_patient_mrns.clear()
+        logger.debug("Finished commiting queued operations.")
+
+    def yield_writes(self):
+        """
+        Let the message loop write between two steps of a snapshot, which holds
+        the write lock otherwise.
+        """
+        self.write_lock.release()
+        time.sleep(0)
+        self.write_lock.acquire()
 
     def update_patient_features(self, mrn, **kwargs):
         """
-        Update patient information based on the provided keyword arguments.
+        Update patient information based on the provided keyword arguments,
+        inserting a row for a patient who has none.
         Args:
             - mrn {str}: Medical Record Number of the patient to update
             - **kwargs {dict}: Where key=column, value=new value
         """
+        with self.write_lock, self.connection:
+            self.write_patient_features(mrn, kwargs)
+
+    def write_patient_features(self, mrn, columns):
+        """
+        Update the features row of a patient, without committing.
+        Args:
+            - mrn {str}: Medical Record Number of the patient to update
+            - columns {dict}: Where key=column, value=new value
+        """
         # construct the SET part of the SQL query based on the given args
-        set_clause = ", ".join([f"{key} = ?" for key in kwargs])
-        query = f"UPDATE features SET {set_clause} WHERE mrn = ?"
+        set_clause = ", ".join([f"{key} = excluded.{key}" for key in columns])
+        query = f"""
+            INSERT INTO features (mrn, {", ".join(columns)})
+            VALUES (?{", ?" * len(columns)})
+            ON CONFLICT (mrn) DO UPDATE SET {set_clause}
+        """
         # prepare the values for the placeholders in the SQL statement
-        values = list(kwargs.values()) + [mrn]
+        values = [mrn] + list(columns.values())
         # execute the query
         self.connection.execute(query, values)
-        self.connection.commit()
 
-    def persist_db(self):
+    def append_to_journal(self, operation, *values):
         """
-        Persist the in-memory database to disk.
+        Append a single delta to the on-disk journal. Entries are only made durable
+        by `persist_db`, and replaying them is idempotent.
         Args:
-            - disk_db_path {str}: the path to the database
+            - operation {str}: 'A' (admit), 'D' (discharge) or 'R' (test result)
+            - values {tuple}: the values the operation was applied with
+        """
+        if self.journal is None:
+            return
+        with self.journal_lock:
+            self.journal.write("\t".join([operation] + [str(v) for v in values]) + "\n")
+            self.journal_entries += 1
+
+    def replay_journal(self, journal_path):
         """
-        # backs up and closes the connection
+        Apply the deltas recorded in a journal file to the in-memory database.
+        Args:
+            - journal_path {str}: path to the journal file
+        Returns:
+            - replayed {int}: the number of entries applied
+        """
+        replayed = 0
+        with open(journal_path) as journal:
+            for line in journal:
+                # a torn write from a crash leaves the last line incomplete
+                if not line.endswith("\n"):
+                    break
+                entry = line[:-1].split("\t")
+                if entry[0] == "A":
+                    self.connection.execute(
+                        "INSERT OR IGNORE INTO patients (mrn, age, sex) VALUES (?, ?, ?)",
+                        (entry[1], int(entry[2]), entry[3]),
+                    )
+                elif entry[0] == "D":
+                    self.connection.execute(
+                        "DELETE FROM patients WHERE mrn = ?", (entry[1],)
+                    )
+                elif entry[0] == "R":
+                    self.connection.execute(
+                        "INSERT OR IGNORE INTO mrns (mrn) VALUES (?)", (entry[1],)
+                    )
+                    self.connection.execute(
+                        f"INSERT OR IGNORE INTO test_results (mrn_id, time, lims, result) VALUES ({MRN_ID}, ?, ?, ?)",
+                        (entry[1],) + encode_date(entry[2]) + (float(entry[3]),),
+                    )
+                    # the snapshot's summary may not have the result yet
+                    self.connection.execute(
+                        "UPDATE features SET lower_results = NULL WHERE mrn = ?",
+                        (entry[1],),
+                    )
+                replayed += 1
         self.connection.commit()
-        with self.on_disk_db_lock:
-            self.disk_db_being_accessed = True
-            print("Lock acquired in persist_db.")
-            with sqlite3.connect(ON_DISK_DB_PATH) as disk_connection:
-                self.connection.backup(disk_connection)
-                self.execute_queued_operations(disk_connection)
+        self.feature_cache.clear()
+        return replayed
+
+    def persist_db(self):
+        """
+        Persist the in-memory database to disk. In backup mode the whole database
+        is copied, in journal mode only the pending journal entries are flushed and
+        the snapshotter takes a full snapshot in the background once enough of
+        them are.
+        """
+        if self.persistence_mode == "backup":
+            self.snapshotter.take_snapshot()
+            return
+        with self.journal_lock:
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            entries = self.journal_entries
+            self.journal_entries = 0
+        self.snapshotter.changed(entries)
+
+    def snapshot(self):
+        """
+        Copy the whole in-memory database to disk and drop the journal entries the
+        copy now covers.
+        """
+        rotated_journal_path = self.journal_path + ".old"
+        with self.journal_lock:
+            # start a new journal so entries written during the copy are kept. If
+            # an older rotated journal is still around the previous snapshot did
+            # not finish, so keep appending to the current one instead.
+            if self.journal is not None and not os.path.exists(rotated_journal_path):
+                self.journal.close()
+                os.replace(self.journal_path, rotated_journal_path)
+                self.journal = open(self.journal_path, "a")
+        # a step of the copy must not see a half-finished write of the message loop
+        with self.write_lock:
+            # backs up and closes the connection
+            self.connection.commit()
+            with self.on_disk_db_lock:
+                self.disk_db_being_accessed = True
+                logger.debug("Lock acquired in persist_db.")
+                with sqlite3.connect(self.db_path) as disk_connection:
+                    # copied a few pages at a time, yielding to the message loop in
+                    # between; changes it makes through this connection are copied too
+                    self.connection.backup(
+                        disk_connection,
+                        pages=SNAPSHOT_BACKUP_PAGES,
+                        progress=lambda status, remaining, total: self.yield_writes(),
+                    )
+                    self.execute_queued_operations(disk_connection)
         self.disk_db_being_accessed = False
-        print("Lock released in persist_db.")
+        logger.debug("Lock released in persist_db.")
+        # everything journaled so far is now part of the snapshot
+        if os.path.exists(rotated_journal_path):
+            os.remove(rotated_journal_path)
+        if self.journal is None and os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
 
     def load_db(self, history_load_path):
         """
-        Load the on-disk database into the in-memory database.
+        Load the on-disk database into the in-memory database and replay any
+        journal entries written since the last snapshot. A snapshot from before
+        MRNs were interned is migrated.
+        Returns:
+            - changed {int}: the number of journal entries replayed and results migrated
         """
+        migrated = 0
         # if on-disk db doesn't exist, use the csv file
-        if not os.path.exists(ON_DISK_DB_PATH):
-            print("Loading the history.csv file in memory.")
-            populate_test_results_table(self, history_load_path)
+        if not os.path.exists(self.db_path):
+            logger.info("Loading the history.csv file in memory.")
+            populate_test_results_table(self, history_load_path, self.shard)
+            self.create_indexes()
             # populate_patients_table(self, 'processed_history.csv')
         else:
             # load the on-disk db into the in-memory one
             with self.on_disk_db_lock:
                 self.disk_db_being_accessed = True
-                print("Lock acquired in load_db.")
-                with sqlite3.connect(ON_DISK_DB_PATH) as disk_connection:
-                    print("Loading the on-disk database in memory.")
+                logger.debug("Lock acquired in load_db.")
+                with sqlite3.connect(self.db_path) as disk_connection:
+                    logger.info("Loading the on-disk database in memory.")
                     disk_connection.backup(self.connection)
             self.disk_db_being_accessed = False
-            print("Lock released in load_db.")
+            logger.debug("Lock released in load_db.")
+            self.migrate_features_table()
+            migrated = self.migrate_test_results()
+        # the rotated journal is older than the current one
+        replayed = 0
+        for journal_path in [self.journal_path + ".old", self.journal_path]:
+            if os.path.exists(journal_path):
+                logger.info("Replaying the journal %s.", journal_path)
+                replayed += self.replay_journal(journal_path)
+        return replayed + migrated
 
     def close(self):
         """
-        Close the database connection.
+        Close the database connection. In journal mode a final snapshot is taken
+        so the journal does not need to be replayed on the next start.
         """
+        self.snapshotter.stop()
+        if self.journal is not None:
+            self.snapshot()
+            self.journal.close()
+            self.journal = None
+            os.remove(self.journal_path)
         self.connection.close()
@@ -0,0 +1,292 @@
+import heapq
+import logging
+import os
+import pickle
+import random
+import sqlite3
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from constants import (
+    ON_DISK_PAGER_QUEUE_PATH,
+    ON_DISK_PAGER_STACK_PATH,
+    PAGER_WORKERS,
+    PAGER_CONNECT_TIMEOUT,
+    PAGER_READ_TIMEOUT,
+    PAGER_BACKOFF_BASE,
+    PAGER_BACKOFF_CAP,
+    PAGER_SENT_RETENTION,
+)
+from prometheus_metrics import (
+    set_queue_depth,
+    observe_stage_latency,
+    increment_failure_counter,
+    observe_step_latency,
+)
+from utils import strip_url
+
+logger = logging.getLogger(__name__)
+
+
+class PagerQueue:
+    """
+    Durable queue of the pages to send, in SQLite. A page is identified by its
+    (mrn, date), so the same page is only ever queued once, even when the message
+    that raised it is replayed. Sent pages are kept for PAGER_SENT_RETENTION
+    seconds to remember that they were sent.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # a queued page is fsynced before the message that raised it is marked
+        # processed in the inbound log, so it survives a power loss too; pages are
+        # rare enough for an fsync each
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                mrn TEXT NOT NULL,
+                date TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                queued_at REAL NOT NULL,
+                sent_at REAL,
+                PRIMARY KEY (mrn, date)
+            )
+            """
+        )
+        self.connection.commit()
+
+    def add(self, mrn, date):
+        """
+        Queue a page. Returns False if the page was already queued or sent.
+        """
+        with self.lock, self.connection:
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO pages (mrn, date, queued_at) VALUES (?, ?, ?)",
+                (str(mrn), str(date), time.time()),
+            )
+        return cursor.rowcount == 1
+
+    def mark_sent(self, mrn, date):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE pages SET sent_at = ?, attempts = attempts + 1 WHERE mrn = ? AND date = ?",
+                (time.time(), mrn, date),
+            )
+
+    def mark_failed(self, mrn, date):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE pages SET attempts = attempts + 1 WHERE mrn = ? AND date = ?",
+                (mrn, date),
+            )
+
+    def unsent(self):
+        """
+        The (mrn, date, attempts) of every page not sent yet, oldest first.
+        """
+        with self.lock:
+            return self.connection.execute(
+                "SELECT mrn, date, attempts FROM pages WHERE sent_at IS NULL ORDER BY queued_at"
+            ).fetchall()
+
+    def prune(self):
+        """
+        Forget the pages sent more than PAGER_SENT_RETENTION seconds ago.
+        """
+        with self.lock, self.connection:
+            self.connection.execute(
+                "DELETE FROM pages WHERE sent_at < ?",
+                (time.time() - PAGER_SENT_RETENTION,),
+            )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def backoff_delay(attempts):
+    """
+    Full jitter exponential backoff: a random delay up to
+    PAGER_BACKOFF_BASE * 2 ** attempts, capped at PAGER_BACKOFF_CAP seconds.
+    """
+    return random.uniform(0, min(PAGER_BACKOFF_CAP, PAGER_BACKOFF_BASE * 2**attempts))
+
+
+class Pager:
+    """
+    Sends pages from a pool of worker threads sharing a keep-alive HTTP session.
+    Pages are written to the durable PagerQueue before `page` returns, and failed
+    pages are retried with jittered backoff until they are sent, across restarts.
+    """
+
+    def __init__(
+        self,
+        pager_address,
+        queue_depth_gauge,
+        latency_summary,
+        failure_counter,
+        queue_path=None,
+        workers=PAGER_WORKERS,
+        send_histogram=None,
+        stack_path=None,
+    ):
+        pager_host, pager_port = strip_url(pager_address)
+        self.url = f"http://{pager_host}:{pager_port}/page"
+        self.timeout = (PAGER_CONNECT_TIMEOUT, PAGER_READ_TIMEOUT)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount("http://", adapter)
+        self.queue_depth_gauge = queue_depth_gauge
+        self.latency_summary = latency_summary
+        self.failure_counter = failure_counter
+        # observes the time taken by every request to the pager
+        self.send_histogram = send_histogram
+
+        self.queue = PagerQueue(queue_path or ON_DISK_PAGER_QUEUE_PATH)
+        self.queue.prune()
+        self.migrate_pager_stack(stack_path or ON_DISK_PAGER_STACK_PATH)
+        # (due time, tie breaker, mrn, date, attempts, queued at) of the pages to send
+        self.heap = []
+        self.counter = 0
+        self.condition = threading.Condition()
+        self.stopping = False
+        for mrn, date, attempts in self.queue.unsent():
+            self.schedule(mrn, date, attempts, time.monotonic(), time.perf_counter())
+        self.threads = [
+            threading.Thread(target=self.run, name=f"pager-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def migrate_pager_stack(self, path):
+        """
+        Move the pages left in the pickled pager stack of older versions to the
+        durable queue.
+        """
+        if not os.path.exists(path):
+            return
+        with open(path, "rb") as file:
+            pager_stack = pickle.load(file)
+        for mrn, date in pager_stack:
+            self.queue.add(mrn, date)
+        os.remove(path)
+        logger.info("Migrated %d pages from the pager stack.", len(pager_stack))
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def page(self, mrn, date):
+        """
+        Queue a page for the patient's test result. The page is durable when this
+        returns and is sent in the background; a page already queued or sent is
+        ignored.
+        """
+        if not self.queue.add(mrn, date):
+            logger.debug("Page for %s on %s was already queued.", mrn, date)
+            return
+        self.schedule(str(mrn), str(date), 0, time.monotonic(), time.perf_counter())
+
+    def schedule(self, mrn, date, attempts, due, queued_at):
+        with self.condition:
+            self.counter += 1
+            heapq.heappush(self.heap, (due, self.counter, mrn, date, attempts, queued_at))
+            set_queue_depth(self.queue_depth_gauge, "paging", len(self.heap))
+            self.condition.notify()
+
+    def next_page(self):
+        """
+        Wait for the next page that is due. Returns None once stopping.
+        """
+        with self.condition:
+            while not self.stopping:
+                if self.heap:
+                    wait = self.heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        page = heapq.heappop(self.heap)
+                        set_queue_depth(self.queue_depth_gauge, "paging", len(self.heap))
+                        return page
+                    self.condition.wait(wait)
+                else:
+                    self.condition.wait()
+            return None
+
+    def send(self, mrn, date):
+        """
+        Send a single page. Returns whether the pager accepted it.
+        """
+        try:
+            response = self.session.post(
+                self.url,
+                data=f"{mrn},{date}".encode("utf-8"),
+                headers={"Content-Type": "text/plain"},
+                timeout=self.timeout,
+            )
+        except requests.RequestException as e:
+            logger.warning("Page for %s failed: %s", mrn, e)
+            return False
+        if response.status_code != 200:
+            logger.warning(
+                "Page for %s failed, status code: %s, message: %s",
+                mrn,
+                response.status_code,
+                response.text,
+            )
+            return False
+        return True
+
+    def run(self):
+        while True:
+            page = self.next_page()
+            if page is None:
+                return
+            _, _, mrn, date, attempts, queued_at = page
+            try:
+                send_started = time.perf_counter()
+                sent = self.send(mrn, date)
+                if self.send_histogram is not None:
+                    observe_step_latency(
+                        self.send_histogram,
+                        "page_send",
+                        "LIMS",
+                        time.perf_counter() - send_started,
+                    )
+                if sent:
+                    self.queue.mark_sent(mrn, date)
+                    observe_stage_latency(
+                        self.latency_summary, "paging", time.perf_counter() - queued_at
+                    )
+                    logger.info("Page for %s on %s sent.", mrn, date)
+                    continue
+                self.queue.mark_failed(mrn, date)
+            except Exception:
+                logger.exception("There was an exception sending the page for %s..", mrn)
+            increment_failure_counter(self.failure_counter)
+            delay = backoff_delay(attempts)
+            logger.warning("Retrying page for %s in %.2f seconds...", mrn, delay)
+            self.schedule(mrn, date, attempts + 1, time.monotonic() + delay, queued_at)
+
+    def pending(self):
+        """
+        Number of pages waiting to be sent.
+        """
+        with self.condition:
+            return len(self.heap)
+
+    def stop(self, timeout=None):
+        """
+        Stop the workers after the pages being sent. Pages not sent stay in the
+        durable queue for the next start.
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for thread in self.threads:
+            if thread.is_alive():
+                thread.join(timeout)
+        self.session.close()
+        self.queue.close()
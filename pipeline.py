@@ -0,0 +1,299 @@
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+from constants import (
+    ON_DISK_INBOUND_LOG_PATH,
+    ON_DISK_INBOUND_OFFSET_PATH,
+    INBOUND_LOG_MAX_BYTES,
+    GROUP_COMMIT_MAX_MESSAGES,
+    GROUP_COMMIT_WINDOW,
+)
+from prometheus_metrics import (
+    set_queue_depth,
+    observe_stage_latency,
+    increment_failure_counter,
+    increment_socket_connections,
+)
+from utils import MLLPReader, connect_to_mllp, create_acknowledgement, strip_url
+
+logger = logging.getLogger(__name__)
+
+# Every record of the inbound log is a sequence number and a length, then the message
+RECORD_HEADER = struct.Struct(">QI")
+OFFSET = struct.Struct(">Q")
+
+
+class InboundLog:
+    """
+    Append-only on-disk log of the raw HL7 messages received. A message can be
+    acknowledged as soon as it is in the log and synced, and processed later; the
+    sequence number of the last processed message is recorded with `commit`, and
+    messages after it are handed back by `pending` on the next start.
+    """
+
+    def __init__(self, path=None, offset_path=None):
+        self.lock = threading.Lock()
+        self.path = path or ON_DISK_INBOUND_LOG_PATH
+        offset_path = offset_path or ON_DISK_INBOUND_OFFSET_PATH
+        os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+        self.offset_fd = os.open(offset_path, os.O_RDWR | os.O_CREAT, 0o600)
+        offset = os.pread(self.offset_fd, OFFSET.size, 0)
+        self.committed = OFFSET.unpack(offset)[0] if len(offset) == OFFSET.size else 0
+        records = self.read_records()
+        self.pending_records = [(seq, message) for seq, message in records if seq > self.committed]
+        last_seq = records[-1][0] if records else 0
+        self.next_seq = max(last_seq, self.committed) + 1
+        self.file = open(self.path, "ab")
+
+    def read_records(self):
+        """
+        Read every complete record of the log, dropping a torn record at the end.
+        """
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, "rb") as file:
+            data = file.read()
+        records = []
+        position = 0
+        while position + RECORD_HEADER.size <= len(data):
+            seq, length = RECORD_HEADER.unpack_from(data, position)
+            end = position + RECORD_HEADER.size + length
+            if end > len(data):
+                break
+            records.append((seq, data[position + RECORD_HEADER.size : end]))
+            position = end
+        if position < len(data):
+            logger.warning(
+                "Dropping %d bytes of a torn inbound log record.", len(data) - position
+            )
+            os.truncate(self.path, position)
+        return records
+
+    def pending(self):
+        """
+        The (seq, message) records that were logged but not processed before the
+        last shutdown, in order.
+        """
+        records, self.pending_records = self.pending_records, []
+        return records
+
+    def append(self, message):
+        """
+        Append a message to the log. It is only durable once `sync` returns.
+        Returns:
+            - seq {int}: the sequence number of the message
+        """
+        with self.lock:
+            seq = self.next_seq
+            self.next_seq += 1
+            self.file.write(RECORD_HEADER.pack(seq, len(message)))
+            self.file.write(message)
+        return seq
+
+    def sync(self):
+        """
+        Flush the appended messages to disk.
+        """
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def commit(self, seq):
+        """
+        Record that every message up to `seq` has been processed and persisted. The
+        offset is not synced: if it is lost the messages after the previous one are
+        processed again, which is idempotent. The log is emptied once it is large
+        and fully processed.
+        """
+        os.pwrite(self.offset_fd, OFFSET.pack(seq), 0)
+        self.committed = seq
+        with self.lock:
+            if seq == self.next_seq - 1 and self.file.tell() > INBOUND_LOG_MAX_BYTES:
+                self.file.flush()
+                self.file.truncate(0)
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.sync()
+        self.file.close()
+        os.close(self.offset_fd)
+
+
+# Put on a stage's queue to stop its worker once the items before it are handled
+STOP = object()
+
+
+class Stage:
+    """
+    A pipeline stage: a worker thread handling the items of a bounded queue in
+    order. `put` blocks while the queue is full, which pushes back on the stage
+    feeding it; until the stage is started the items are held without a bound, so
+    the stage feeding it does not wait on the warm-up. `on_idle` is called whenever
+    the queue has been drained and when the stage stops.
+    """
+
+    def __init__(
+        self,
+        name,
+        handle,
+        maxsize,
+        queue_depth_gauge,
+        latency_summary,
+        failure_counter,
+        on_idle=None,
+    ):
+        self.name = name
+        self.handle = handle
+        self.on_idle = on_idle
+        self.queue = queue.Queue(maxsize)
+        # items put before the stage started, guarded by the lock
+        self.waiting = []
+        self.started = False
+        self.lock = threading.Lock()
+        self.queue_depth_gauge = queue_depth_gauge
+        self.latency_summary = latency_summary
+        self.failure_counter = failure_counter
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+
+    def start(self):
+        """
+        Start the worker, then hand it the items put so far, in order: those put
+        meanwhile are held until the earlier ones are queued.
+        """
+        self.thread.start()
+        while True:
+            with self.lock:
+                waiting, self.waiting = self.waiting, []
+                if not waiting:
+                    self.started = True
+                    return
+            for entry in waiting:
+                self.queue.put(entry)
+
+    def put(self, item):
+        """
+        Queue an item for the stage, waiting while the queue is full once the
+        stage is started.
+        """
+        entry = (time.perf_counter(), item)
+        with self.lock:
+            if not self.started:
+                self.waiting.append(entry)
+                set_queue_depth(self.queue_depth_gauge, self.name, len(self.waiting))
+                return
+        self.queue.put(entry)
+        set_queue_depth(self.queue_depth_gauge, self.name, self.queue.qsize())
+
+    def is_idle(self):
+        return self.queue.empty() and not self.waiting
+
+    def run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is STOP:
+                self.idle()
+                return
+            queued_at, item = entry
+            try:
+                self.handle(item)
+            except Exception:
+                # one bad message must not stop the pipeline
+                increment_failure_counter(self.failure_counter)
+                logger.exception("There was an exception in the %s stage..", self.name)
+            observe_stage_latency(
+                self.latency_summary, self.name, time.perf_counter() - queued_at
+            )
+            set_queue_depth(self.queue_depth_gauge, self.name, self.queue.qsize())
+            if self.queue.empty():
+                self.idle()
+
+    def idle(self):
+        if self.on_idle is None:
+            return
+        try:
+            self.on_idle()
+        except Exception:
+            increment_failure_counter(self.failure_counter)
+            logger.exception("There was an exception when the %s stage ran dry..", self.name)
+
+    def stop(self, timeout=None):
+        """
+        Stop the worker once the items already queued have been handled.
+        """
+        if not self.thread.is_alive():
+            return
+        self.queue.put(STOP)
+        self.thread.join(timeout)
+
+
+class MLLPFeed:
+    """
+    A feed of messages from an MLLP server, reconnecting whenever the connection
+    drops. Feeds hand out one message at a time and `acknowledge` the last one;
+    `frame_started` is the perf_counter time the last one started arriving. For a
+    group commit, `read_messages` hands out the messages received back to back
+    with the time each started arriving, and `acknowledge(count)` acknowledges
+    that many of them.
+    """
+
+    def __init__(self, mllp_address, reconnections_gauge, failure_counter=None):
+        self.host, self.port = strip_url(mllp_address)
+        self.reconnections_gauge = reconnections_gauge
+        self.failure_counter = failure_counter
+        self.sock = None
+        self.connect()
+
+    def connect(self):
+        # the previous socket may still be open when reconnecting after an error
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = connect_to_mllp(self.host, self.port)
+        self.reader = MLLPReader(self.sock, failure_counter=self.failure_counter)
+        increment_socket_connections(self.reconnections_gauge)
+
+    def read_message(self):
+        """
+        Returns the next message, or None if nothing valid was received.
+        """
+        hl7_data, need_to_reconnect = self.reader.read_message()
+        if need_to_reconnect:
+            self.connect()
+        return hl7_data
+
+    def read_messages(
+        self, max_count=GROUP_COMMIT_MAX_MESSAGES, window=GROUP_COMMIT_WINDOW
+    ):
+        """
+        Returns the next messages as (message, frame_started) tuples, see
+        `MLLPReader.read_messages`.
+        """
+        messages, need_to_reconnect = self.reader.read_messages(max_count, window)
+        if need_to_reconnect:
+            self.connect()
+        return messages
+
+    def poll(self, timeout):
+        """
+        Returns whether a complete message is buffered, or more data arrives
+        within `timeout` seconds.
+        """
+        return self.reader.poll(timeout)
+
+    @property
+    def frame_started(self):
+        return self.reader.message_started
+
+    def acknowledge(self, count=1):
+        logger.debug("Sending %d ACK messages...", count)
+        framed_ack = create_acknowledgement()
+        # one system call for the whole group, without joining the ACKs first
+        sent = self.sock.sendmsg([framed_ack] * count)
+        if sent < len(framed_ack) * count:
+            self.sock.sendall((framed_ack * count)[sent:])
+
+    def close(self):
+        self.sock.close()
@@ -1,10 +1,65 @@
+import threading
+from http.server import ThreadingHTTPServer
 from prometheus_client import start_http_server, Summary, Counter
+from prometheus_client.exposition import MetricsHandler
 
-def start_metrics_server(port=8000):
+
+class Health:
+    """
+    Liveness and readiness of a detector process. It is ready once `ready` is set,
+    i.e. once its store and models are loaded, and live while every check added
+    to `checks` passes.
+    """
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.checks = []
+
+    def is_live(self):
+        return all(check() for check in self.checks)
+
+    def is_ready(self):
+        return self.ready.is_set() and self.is_live()
+
+
+class HealthHandler(MetricsHandler):
     """
-    Starts a background thread to serve Prometheus metrics.
+    Serves the /live and /ready endpoints of `health`, and the metrics on every
+    other path.
     """
-    start_http_server(port)
+
+    health = None
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/live":
+            self.respond_health(self.health.is_live())
+        elif path == "/ready":
+            self.respond_health(self.health.is_ready())
+        else:
+            super().do_GET()
+
+    def respond_health(self, healthy):
+        body = b"ok" if healthy else b"not ok"
+        self.send_response(200 if healthy else 503)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_metrics_server(port=8000, health=None):
+    """
+    Starts a background thread to serve Prometheus metrics, along with the /live
+    and /ready endpoints of `health` when one is given.
+    """
+    if health is None:
+        start_http_server(port)
+        return
+    handler = type("HealthHandler", (HealthHandler,), {"health": health})
+    server = ThreadingHTTPServer(("", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
 
 def increment_socket_connections(SOCKET_CONNECTIONS_COUNTER):
     """
@@ -62,15 +117,85 @@ def calculate_positive_aki_rate(total_messages, positive_aki, aki_positive_gauge
     rate = positive_aki / total_messages
     aki_positive_gauge.set(rate)
 
-def calculate_latency_average(total_sum, count_blood, latency_gauge):
+def increment_latency_counter(LATENCY_MISS_COUNTER):
     """
-    Calculates the average latency
+    Increments the total number of instances where latency was greater than 3s.
     """
-    rate = total_sum / count_blood
-    latency_gauge.set(rate)
+    LATENCY_MISS_COUNTER.inc()
 
-def increment_latency_counter(LATENCY_MISS_COUNTER):
+def set_queue_depth(QUEUE_DEPTH_GAUGE, stage, depth):
     """
-    Increments the total number of instances where latency was greater than 3s.
+    Sets the number of items waiting in a pipeline stage.
+    """
+    QUEUE_DEPTH_GAUGE.labels(stage=stage).set(depth)
+
+def observe_stage_latency(STAGE_LATENCY_SUMMARY, stage, seconds):
+    """
+    Records the time an item spent in a pipeline stage.
+    """
+    STAGE_LATENCY_SUMMARY.labels(stage=stage).observe(seconds)
+
+def record_compaction(ARCHIVED_COUNTER, RECLAIMED_COUNTER, archived, reclaimed):
+    """
+    Records the test results a compaction archived and the bytes it reclaimed.
+    """
+    ARCHIVED_COUNTER.inc(archived)
+    RECLAIMED_COUNTER.inc(max(reclaimed, 0))
+
+def set_summary_bytes(SUMMARY_BYTES_GAUGE, size):
+    """
+    Sets the number of bytes the feature summaries take in the patient store.
+    """
+    SUMMARY_BYTES_GAUGE.set(size)
+
+def observe_snapshot_duration(SNAPSHOT_DURATION_SUMMARY, seconds):
+    """
+    Records the time a snapshot of the patient store took.
+    """
+    SNAPSHOT_DURATION_SUMMARY.observe(seconds)
+
+def track_snapshot_staleness(SNAPSHOT_STALENESS_GAUGE, staleness):
+    """
+    Reports the age of the oldest change not in a snapshot yet, computed by
+    `staleness` whenever the metrics are scraped.
+    """
+    SNAPSHOT_STALENESS_GAUGE.set_function(staleness)
+
+def observe_step_latency(STEP_HISTOGRAM, step, message_type, seconds):
+    """
+    Records the time a step of handling a message took.
+    """
+    STEP_HISTOGRAM.labels(step=step, message_type=message_type).observe(seconds)
+
+def observe_message_latency(MESSAGE_HISTOGRAM, message_type, seconds):
+    """
+    Records the time from a message arriving to it being handled.
+    """
+    MESSAGE_HISTOGRAM.labels(message_type=message_type).observe(seconds)
+
+def record_shadow_predictions(
+    PREDICTIONS_COUNTER, DISAGREEMENTS_COUNTER, AGREEMENT_GAUGE, model, scored, disagreements, agreement_rate
+):
+    """
+    Records a batch of a challenger's predictions: how many it made, how many
+    disagreed with the primary model, by (primary, challenger) labels, and the
+    share it agreed with so far.
+    """
+    PREDICTIONS_COUNTER.labels(model=model).inc(scored)
+    for (primary, challenger), count in disagreements.items():
+        DISAGREEMENTS_COUNTER.labels(
+            model=model, primary=primary, challenger=challenger
+        ).inc(count)
+    AGREEMENT_GAUGE.labels(model=model).set(agreement_rate)
+
+def observe_shadow_inference(INFERENCE_HISTOGRAM, model, seconds):
+    """
+    Records the time a challenger took to predict a batch.
+    """
+    INFERENCE_HISTOGRAM.labels(model=model).observe(seconds)
+
+def increment_shadow_dropped(DROPPED_COUNTER):
+    """
+    Increments the number of feature vectors dropped before the challengers saw them.
     """
-    LATENCY_MISS_COUNTER.inc()
\ No newline at end of file
+    DROPPED_COUNTER.inc()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Regenerates the feature summaries of the features table from the test results in
+bulk, e.g. after a change to how they are computed. Run it on the detector's
+state while the detector is stopped:
+
+    STATE_DIR=/state STORAGE_BACKEND=sqlite ./rebuild_features.py
+
+A sharded detector keeps a store per shard, under STATE_DIR/shard-<index>: the
+store of every shard found under the state directory is rebuilt.
+"""
+import argparse
+import os
+import re
+import time
+from constants import STATE_DIR
+from sharding import shard_state_dir
+from storage import open_database, storage_class
+
+
+def stores(state_dir):
+    """
+    The (state_dir, shard) of every store under a state directory: one per
+    shard of a sharded detector, or the one of a detector that is not sharded.
+    """
+    indexes = sorted(
+        int(match.group(1))
+        for match in map(re.compile(r"shard-(\d+)").fullmatch, os.listdir(state_dir))
+        if match
+    )
+    if not indexes:
+        return [(state_dir, None)]
+    return [
+        (shard_state_dir(index, state_dir), (index, len(indexes))) for index in indexes
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--history",
+        default=os.environ.get("HISTORY_PATH", "data/history.csv"),
+        help="history.csv, only loaded if the store does not exist yet",
+    )
+    parser.add_argument(
+        "--backend", default=os.environ.get("STORAGE_BACKEND", "sqlite")
+    )
+    parser.add_argument(
+        "--persistence-mode", default=os.environ.get("PERSISTENCE_MODE", "journal")
+    )
+    parser.add_argument(
+        "--state-dir",
+        default=STATE_DIR,
+        help="the detector's state directory, with a directory per shard if sharded",
+    )
+    flags = parser.parse_args()
+    if not storage_class(flags.backend).stores_summaries:
+        parser.error(
+            f"the {flags.backend} backend does not store feature summaries to rebuild"
+        )
+    if not os.path.isdir(flags.state_dir):
+        parser.error(f"no state directory at {flags.state_dir}")
+
+    for state_dir, shard in stores(flags.state_dir):
+        db = open_database(
+            flags.backend, flags.history, flags.persistence_mode, shard, state_dir
+        )
+        start_time = time.perf_counter()
+        rebuilt = db.rebuild_features()
+        print(
+            f"Rebuilt the feature summaries of {rebuilt} patients in {state_dir} in "
+            f"{time.perf_counter() - start_time:.2f}s"
+        )
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,298 @@
+import collections
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import numpy as np
+import pandas as pd
+from joblib import load
+from constants import (
+    FEATURES_COLUMNS,
+    ON_DISK_SHADOW_PATH,
+    SHADOW_QUEUE_SIZE,
+    SHADOW_BATCH_SIZE,
+    SHADOW_BATCH_WINDOW,
+    SHADOW_RETENTION,
+    SHADOW_PRUNE_INTERVAL,
+)
+from prometheus_metrics import (
+    increment_failure_counter,
+    increment_shadow_dropped,
+    observe_shadow_inference,
+    record_shadow_predictions,
+)
+from utils import predict_with_mlp
+
+logger = logging.getLogger(__name__)
+
+# Names challengers were fitted with for some of the FEATURES_COLUMNS
+FEATURE_ALIASES = {"C_value": "C1", "D_value": "D", "RV12_ratio": "RV2_ratio"}
+
+# Put on the queue to stop the dispatcher once the vectors before it are scored
+STOP = object()
+
+# (name, model, feature names, columns) of the challengers of a worker process,
+# loaded once when it starts
+challengers = []
+
+
+def model_name(path):
+    """
+    The name a challenger is reported under: its file name without the extension.
+    """
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def load_challengers(paths):
+    """
+    Load the challenger models of a worker process. A challenger fitted on a
+    DataFrame takes the features it was fitted with, any other one all the
+    FEATURES_COLUMNS.
+    """
+    # the detector stops its worker itself on ^C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # and is scheduled first when they share a CPU: an idle-class process does not
+    # even finish its time slice when the detector wakes up
+    if hasattr(os, "SCHED_IDLE"):
+        os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+    else:
+        os.nice(19)
+    for path in paths:
+        model = load(path)
+        names = getattr(model, "feature_names_in_", None)
+        features = FEATURES_COLUMNS if names is None else list(names)
+        unknown = [
+            name for name in features if FEATURE_ALIASES.get(name, name) not in FEATURES_COLUMNS
+        ]
+        if unknown or len(features) != model.n_features_in_:
+            raise ValueError(f"{path}: cannot map the features {unknown or features}")
+        columns = [FEATURES_COLUMNS.index(FEATURE_ALIASES.get(name, name)) for name in features]
+        challengers.append((model_name(path), model, names, columns))
+
+
+def predict_challengers(rows):
+    """
+    Predict feature vectors with every challenger of the worker process.
+    Args:
+        - rows {list}: feature vectors in FEATURES_COLUMNS order
+    Returns:
+        - predictions {list}: (name, labels, seconds) of every challenger
+    """
+    X = np.asarray(rows, dtype=np.float64)
+    predictions = []
+    for name, model, names, columns in challengers:
+        started = time.perf_counter()
+        data = X[:, columns]
+        if names is not None:
+            # or sklearn warns about every batch
+            data = pd.DataFrame(data, columns=names)
+        labels = predict_with_mlp(model, data)
+        predictions.append((name, labels, time.perf_counter() - started))
+    return predictions
+
+
+class ShadowScorer:
+    """
+    Scores the feature vectors of the decision tree with challenger models, off the
+    scoring path. `submit` only queues a vector, and drops it when `queue_size`
+    are already waiting, so the challengers never hold up a decision or an ACK. A
+    dispatcher thread hands the vectors in batches to a worker process holding the
+    challengers, so their inference does not hold the detector's GIL either, then
+    records every prediction next to the decision tree's in SQLite and exports
+    how often they disagree. A vector waits up to `batch_window` seconds for
+    others, as the cost of a batch is mostly fixed; the worker process runs at the
+    lowest priority.
+    """
+
+    def __init__(
+        self,
+        model_paths,
+        predictions_counter,
+        disagreements_counter,
+        agreement_gauge,
+        inference_histogram,
+        dropped_counter,
+        failure_counter,
+        path=None,
+        queue_size=SHADOW_QUEUE_SIZE,
+        batch_size=SHADOW_BATCH_SIZE,
+        batch_window=SHADOW_BATCH_WINDOW,
+    ):
+        self.model_paths = list(model_paths)
+        self.predictions_counter = predictions_counter
+        self.disagreements_counter = disagreements_counter
+        self.agreement_gauge = agreement_gauge
+        self.inference_histogram = inference_histogram
+        self.dropped_counter = dropped_counter
+        self.failure_counter = failure_counter
+        self.queue = queue.Queue(queue_size)
+        self.batch_size = batch_size
+        self.batch_window = batch_window
+        # per challenger, the vectors scored and the ones it agreed on
+        self.scored = collections.Counter()
+        self.agreed = collections.Counter()
+        # set if the worker process cannot run the challengers
+        self.broken = False
+        self.stopped = False
+
+        path = path or ON_DISK_SHADOW_PATH
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # predictions lost in a crash are not worth an fsync per batch
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS predictions (
+                mrn TEXT NOT NULL,
+                date TEXT NOT NULL,
+                model TEXT NOT NULL,
+                primary_label TEXT NOT NULL,
+                challenger_label TEXT NOT NULL,
+                scored_at REAL NOT NULL
+            )
+            """
+        )
+        self.connection.commit()
+        self.prune()
+        self.pool = ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=load_challengers,
+            initargs=(self.model_paths,),
+        )
+        # the worker process starts and loads the challengers now, not with the
+        # first vector
+        self.pool.submit(predict_challengers, [])
+        self.thread = threading.Thread(target=self.run, name="shadow", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, mrn, date, features, label):
+        """
+        Queue the features the decision tree predicted `label` for, to be scored
+        by the challengers. Never waits: the vector is dropped if the queue is
+        full.
+        Returns:
+            - queued {bool}: whether the vector was queued
+        """
+        if self.broken:
+            return False
+        try:
+            self.queue.put_nowait((str(mrn), str(date), list(features), label))
+        except queue.Full:
+            increment_shadow_dropped(self.dropped_counter)
+            return False
+        return True
+
+    def run(self):
+        last_pruned = time.monotonic()
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.batch_size and batch[-1] is not STOP:
+                try:
+                    batch.append(
+                        self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                    )
+                except queue.Empty:
+                    break
+            items = [item for item in batch if item is not STOP]
+            if items and not self.broken:
+                self.score(items)
+            if len(items) < len(batch):
+                return
+            if time.monotonic() - last_pruned > SHADOW_PRUNE_INTERVAL:
+                self.prune()
+                last_pruned = time.monotonic()
+
+    def score(self, items):
+        """
+        Score a batch of queued vectors with every challenger and record the
+        predictions.
+        """
+        try:
+            predictions = self.pool.submit(
+                predict_challengers, [features for _, _, features, _ in items]
+            ).result()
+        except BrokenProcessPool:
+            self.broken = True
+            increment_failure_counter(self.failure_counter)
+            logger.exception("The challenger models cannot be run, shadow scoring stopped..")
+            return
+        except Exception:
+            increment_failure_counter(self.failure_counter)
+            logger.exception("There was an exception scoring with the challenger models..")
+            return
+        scored_at = time.time()
+        rows = []
+        for name, labels, seconds in predictions:
+            observe_shadow_inference(self.inference_histogram, name, seconds)
+            disagreements = collections.Counter()
+            for (mrn, date, _, primary), label in zip(items, labels):
+                rows.append((mrn, date, name, primary, label, scored_at))
+                if label != primary:
+                    disagreements[(primary, label)] += 1
+            self.scored[name] += len(items)
+            self.agreed[name] += len(items) - sum(disagreements.values())
+            record_shadow_predictions(
+                self.predictions_counter,
+                self.disagreements_counter,
+                self.agreement_gauge,
+                name,
+                len(items),
+                disagreements,
+                self.agreed[name] / self.scored[name],
+            )
+        with self.connection:
+            self.connection.executemany(
+                "INSERT INTO predictions VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def prune(self):
+        """
+        Forget the predictions made more than SHADOW_RETENTION seconds ago.
+        """
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM predictions WHERE scored_at < ?",
+                (time.time() - SHADOW_RETENTION,),
+            )
+
+    def agreement(self):
+        """
+        The share of the vectors scored so far each challenger agreed on.
+        """
+        return {name: self.agreed[name] / self.scored[name] for name in self.scored}
+
+    def stop(self, timeout=None):
+        """
+        Stop once the vectors already queued are scored, then stop the worker
+        process.
+        """
+        if self.stopped:
+            return
+        self.stopped = True
+        if self.thread.is_alive():
+            try:
+                self.queue.put(STOP, timeout=timeout)
+            except queue.Full:
+                pass
+            self.thread.join(timeout)
+        self.pool.shutdown(cancel_futures=True)
+        if not self.thread.is_alive():
+            self.connection.close()
+        for name, rate in self.agreement().items():
+            logger.info(
+                "Challenger %s agreed with the decision tree on %.2f%% of %d results.",
+                name,
+                rate * 100,
+                self.scored[name],
+            )
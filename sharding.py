@@ -0,0 +1,256 @@
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from constants import STATE_DIR, GROUP_COMMIT_MAX_MESSAGES, GROUP_COMMIT_WINDOW
+from hl7_parser import message_mrn
+from pipeline import MLLPFeed
+from prometheus_metrics import increment_failure_counter
+from utils import shard_of
+
+logger = logging.getLogger(__name__)
+
+# What a shard answers once a message is durably in its inbound log
+SHARD_ACK = b"A"
+
+
+class ShardFeed:
+    """
+    The feed of a shard process: the messages routed to it by the coordinator,
+    over a pipe. Acknowledging tells the coordinator the message is durable, so it
+    can be acknowledged upstream. `read_message` raises EOFError once the
+    coordinator has closed the pipe. The coordinator sends the messages of a group
+    it read upstream together, `read_messages` hands them out together.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.frame_started = None
+
+    def read_message(self):
+        hl7_data = self.connection.recv_bytes()
+        # messages come over the pipe whole
+        self.frame_started = time.perf_counter()
+        return hl7_data
+
+    def read_messages(
+        self, max_count=GROUP_COMMIT_MAX_MESSAGES, window=GROUP_COMMIT_WINDOW
+    ):
+        """
+        Returns the next messages as (message, frame_started) tuples, the first
+        one and the ones sent within `window` seconds after it.
+        """
+        messages = [(self.read_message(), self.frame_started)]
+        deadline = time.perf_counter() + window
+        try:
+            while len(messages) < max_count and self.connection.poll(
+                max(deadline - time.perf_counter(), 0)
+            ):
+                messages.append((self.read_message(), self.frame_started))
+        except EOFError:
+            # raised again by the next read
+            pass
+        return messages
+
+    def poll(self, timeout):
+        """
+        Returns whether a message, or the end of the feed, arrives within
+        `timeout` seconds.
+        """
+        return self.connection.poll(timeout)
+
+    def acknowledge(self, count=1):
+        self.connection.send_bytes(SHARD_ACK * count)
+
+    def close(self):
+        self.connection.close()
+
+
+class Shard:
+    """
+    The coordinator's end of a shard: its process and the pipe to it. Only one
+    group of messages is in flight on the pipe at a time: `submit` holds the pipe
+    until `collect` has the group's acknowledgements.
+    """
+
+    def __init__(self, index, count, worker, args, context):
+        self.index = index
+        self.lock = threading.Lock()
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(
+            target=worker,
+            args=(index, count, child_connection) + tuple(args),
+            name=f"shard-{index}",
+        )
+        self.process.start()
+        child_connection.close()
+
+    def send(self, hl7_data):
+        """
+        Hand a message to the shard and wait until it is durably logged there.
+        """
+        self.send_messages([hl7_data])
+
+    def send_messages(self, messages):
+        """
+        Hand messages to the shard and wait until they are all durably logged
+        there. The shard acknowledges the ones it logged together at once.
+        """
+        self.submit(messages)
+        self.collect(len(messages))
+
+    def submit(self, messages):
+        """
+        Hand messages to the shard without waiting for them to be logged, so the
+        other shards can be handed theirs meanwhile. Must be followed by `collect`.
+        """
+        self.lock.acquire()
+        try:
+            for hl7_data in messages:
+                self.connection.send_bytes(hl7_data)
+        except BaseException:
+            self.lock.release()
+            raise
+
+    def collect(self, count):
+        """
+        Wait until the `count` messages submitted are all durably logged. The
+        shard acknowledges the ones it logged together at once.
+        """
+        try:
+            acknowledged = 0
+            while acknowledged < count:
+                ack = self.connection.recv_bytes()
+                if not ack or ack != SHARD_ACK * len(ack):
+                    raise ConnectionError(f"Shard {self.index} did not acknowledge")
+                acknowledged += len(ack)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def shard_state_dir(index, state_dir=STATE_DIR):
+    """
+    The directory a shard keeps its state in, apart from the other shards.
+    """
+    return os.path.join(state_dir, f"shard-{index}")
+
+
+def forward(feed, shards, stopping, failure_counter):
+    """
+    Reads messages from an upstream feed, routes each to the shard owning its MRN
+    and acknowledges it upstream once that shard has it on disk. Messages of a
+    patient always go to the same shard, in the order they arrive. The messages
+    read together are sent to each shard together and acknowledged together, once
+    every shard has logged its part: the shards log them in parallel.
+    """
+    while not stopping.is_set():
+        try:
+            routed = {}
+            for hl7_data, _ in feed.read_messages():
+                if not hl7_data:
+                    continue
+                try:
+                    index = shard_of(message_mrn(hl7_data), len(shards))
+                except Exception:
+                    # the shard reports the message as failed when it parses it
+                    index = 0
+                routed.setdefault(index, []).append(hl7_data)
+            if not routed:
+                continue
+            # in the order of the shards, so the feeds sharing them cannot deadlock
+            submitted = []
+            try:
+                for index in sorted(routed):
+                    shards[index].submit(routed[index])
+                    submitted.append(index)
+            finally:
+                # every shard submitted to is released, even if another failed
+                errors = []
+                for index in submitted:
+                    try:
+                        shards[index].collect(len(routed[index]))
+                    except Exception as error:
+                        errors.append(error)
+                if errors:
+                    raise errors[0]
+            feed.acknowledge(sum(len(messages) for messages in routed.values()))
+        except Exception:
+            if stopping.is_set():
+                return
+            increment_failure_counter(failure_counter)
+            logger.exception("There was an exception forwarding a message..")
+            # the messages were not acknowledged, upstream sends them again
+            feed.connect()
+
+
+def run_coordinator(
+    mllp_addresses,
+    shard_count,
+    worker,
+    worker_args,
+    reconnections_gauge,
+    failure_counter,
+    health=None,
+):
+    """
+    Starts `shard_count` processes running `worker(index, count, connection,
+    *worker_args)`, then forwards the messages of every MLLP feed to them until a
+    shard exits or the coordinator is asked to stop. The coordinator's `health` is
+    ready once it forwards, and live while every shard is; the shards report their
+    own readiness on their metrics ports.
+    """
+    context = multiprocessing.get_context("spawn")
+    shards = [
+        Shard(index, shard_count, worker, worker_args, context)
+        for index in range(shard_count)
+    ]
+    stopping = threading.Event()
+    feeds = []
+
+    def shutdown(signum, frame):
+        logger.info("Graceful shutdown procedure started.")
+        stopping.set()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    for address in mllp_addresses:
+        feed = MLLPFeed(address, reconnections_gauge, failure_counter)
+        feeds.append(feed)
+        threading.Thread(
+            target=forward,
+            args=(feed, shards, stopping, failure_counter),
+            name=f"feed-{address}",
+            daemon=True,
+        ).start()
+    if health is not None:
+        health.checks.append(lambda: all(shard.process.is_alive() for shard in shards))
+        health.ready.set()
+
+    # wake up regularly to notice a shard dying or a shutdown request
+    while not stopping.is_set():
+        if any(not shard.process.is_alive() for shard in shards):
+            logger.warning("A shard exited, shutting down..")
+            stopping.set()
+            break
+        stopping.wait(1)
+
+    for feed in feeds:
+        try:
+            feed.close()
+        except OSError:
+            pass
+    # closing the pipes lets the shards drain, persist and exit
+    for shard in shards:
+        shard.close()
+    for shard in shards:
+        shard.process.join()
+        logger.info("Shard %d exited with code %s", shard.index, shard.process.exitcode)
+    sys.exit(0 if all(shard.process.exitcode == 0 for shard in shards) else 1)
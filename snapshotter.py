@@ -0,0 +1,125 @@
+import logging
+import threading
+import time
+from constants import JOURNAL_SNAPSHOT_INTERVAL, SNAPSHOT_INTERVAL
+from prometheus_metrics import observe_snapshot_duration, track_snapshot_staleness
+
+logger = logging.getLogger(__name__)
+
+
+class Snapshotter:
+    """
+    Takes the snapshots of a store from a background thread, once `changes` changes
+    have been made durable since the last one or `interval` seconds after the
+    first of them, so the message loop never waits for a snapshot.
+    """
+
+    def __init__(
+        self, snapshot, changes=JOURNAL_SNAPSHOT_INTERVAL, interval=SNAPSHOT_INTERVAL
+    ):
+        self.snapshot = snapshot
+        self.changes = changes
+        self.interval = interval
+        self.condition = threading.Condition()
+        # changes not in a snapshot yet, and when the first of them was made
+        self.pending = 0
+        self.pending_since = None
+        self.stopping = False
+        self.duration_summary = None
+        self.thread = threading.Thread(target=self.run, name="snapshotter", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def export(self, duration_summary, staleness_gauge):
+        """
+        Export the duration of the snapshots and their staleness, the age of the
+        oldest change not in a snapshot yet, as Prometheus metrics.
+        """
+        self.duration_summary = duration_summary
+        track_snapshot_staleness(staleness_gauge, self.staleness)
+
+    def staleness(self):
+        pending_since = self.pending_since
+        if pending_since is None:
+            return 0.0
+        return time.monotonic() - pending_since
+
+    def changed(self, count=1):
+        """
+        Record changes made durable, waking the thread if a snapshot is due.
+        """
+        if count == 0:
+            return
+        with self.condition:
+            self.pending += count
+            if self.pending_since is None:
+                # the thread starts waiting for the interval to pass
+                self.pending_since = time.monotonic()
+                self.condition.notify()
+            elif self.pending >= self.changes:
+                self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopping and not self.is_due():
+                    if self.pending_since is None:
+                        self.condition.wait()
+                    else:
+                        self.condition.wait(
+                            self.pending_since + self.interval - time.monotonic()
+                        )
+                if self.stopping:
+                    return
+            try:
+                self.take_snapshot()
+            except Exception:
+                logger.exception("There was an exception in the snapshotter..")
+                # try again after a while rather than in a tight loop
+                with self.condition:
+                    if not self.stopping:
+                        self.condition.wait(self.interval)
+
+    def is_due(self):
+        if self.pending_since is None:
+            return False
+        return (
+            self.pending >= self.changes
+            or time.monotonic() - self.pending_since >= self.interval
+        )
+
+    def take_snapshot(self):
+        """
+        Take a snapshot now, from the calling thread.
+        """
+        with self.condition:
+            # changes made from here on may not be in the snapshot
+            pending, pending_since = self.pending, self.pending_since
+            self.pending = 0
+            self.pending_since = None
+        start = time.perf_counter()
+        try:
+            self.snapshot()
+        except Exception:
+            with self.condition:
+                self.pending += pending
+                if pending_since is not None:
+                    self.pending_since = min(
+                        pending_since, self.pending_since or pending_since
+                    )
+            raise
+        if self.duration_summary is not None:
+            observe_snapshot_duration(
+                self.duration_summary, time.perf_counter() - start
+            )
+
+    def stop(self, timeout=None):
+        """
+        Stop the thread, after the snapshot being taken if there is one.
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread.is_alive():
+            self.thread.join(timeout)
@@ -0,0 +1,183 @@
+from abc import ABC, abstractmethod
+from constants import STORAGE_BACKENDS, COMPACTION_AGE
+
+
+class Storage(ABC):
+    """
+    What the pipeline needs from a patient store. Backends take
+    `(history_load_path, persistence_mode, shard=None, state_dir=None)`: they load
+    history.csv on their first start, or what they persisted under `state_dir`
+    (STATE_DIR by default) afterwards, and only keep the patients of `shard`, an
+    (index, count) pair, when one is given.
+
+    Admissions, discharges and test results are durable once `persist_db`
+    returns, and survive a crash after it. Dates are stored as whole seconds since
+    the epoch, and handed back as they came in: LIMS dates as integers,
+    history.csv dates as text.
+    """
+
+    # the Snapshotter of backends that snapshot in the background
+    snapshotter = None
+    # whether the feature summaries are stored with the test results, for
+    # `compact` and `rebuild_features` to work on
+    stores_summaries = True
+
+    @abstractmethod
+    def insert_patient(self, mrn, age, sex, update_disk_db=True):
+        """
+        Admit a patient, unless they are already admitted.
+        """
+
+    @abstractmethod
+    def get_patient(self, mrn):
+        """
+        The (mrn, age, sex) of an admitted patient, or None.
+        """
+
+    @abstractmethod
+    def discharge_patient(self, mrn):
+        """
+        Discharge a patient, keeping their test results.
+        """
+
+    @abstractmethod
+    def insert_test_result(self, mrn, date, result, features=None):
+        """
+        Store a test result, unless the patient already has one at that date,
+        together with the features it was scored with when given: a dict of the
+        columns `update_patient_features` takes.
+        """
+
+    @abstractmethod
+    def insert_test_results(self, rows):
+        """
+        Store many (mrn, date, result) rows at once, skipping the ones already
+        stored, and return how many were stored.
+        """
+
+    @abstractmethod
+    def get_test_result(self, mrn, date):
+        """
+        The (mrn, date, result) of a patient's test result at a date, or None.
+        """
+
+    @abstractmethod
+    def get_test_results(self, mrn):
+        """
+        The (mrn, date, result) test results of a patient, except the ones
+        `compact` archived.
+        """
+
+    @abstractmethod
+    def get_patient_history(self, mrn):
+        """
+        The (mrn, age, sex, date, result) records of an admitted patient.
+        """
+
+    @abstractmethod
+    def get_feature_state(self, mrn):
+        """
+        The `FeatureSummary` of a patient's test results, kept up to date as
+        results are inserted.
+        """
+
+    @abstractmethod
+    def rebuild_features(self):
+        """
+        Regenerate the stored feature summaries from the test results, and
+        return how many were written.
+        """
+
+    @abstractmethod
+    def compact(self, age=COMPACTION_AGE, stopping=None):
+        """
+        Move the test results more than `age` seconds older than their patient's
+        latest result out of the store's hot data, keeping what the features
+        need of them, until done or the `stopping` event is set. Returns the
+        number of results moved and of bytes reclaimed.
+        """
+
+    @abstractmethod
+    def summary_bytes(self):
+        """
+        The number of bytes the stored feature summaries take in the store's
+        hot data.
+        """
+
+    @abstractmethod
+    def insert_patient_features(
+        self, mrn, age, sex, c1, rv1, rv1_r, rv2, rv2_r, change, D, aki=None
+    ):
+        """
+        Store the features of a patient, unless they are already stored.
+        """
+
+    @abstractmethod
+    def get_patient_features(self, mrn):
+        """
+        The features row of a patient, in the column order of
+        `insert_patient_features`, or None. The row holds the last features
+        scored for the patient and their prediction.
+        """
+
+    @abstractmethod
+    def update_patient_features(self, mrn, **kwargs):
+        """
+        Update some of the features of a patient, by column name, storing a row
+        for them if they have none. The row is kept when the store is reopened.
+        """
+
+    @abstractmethod
+    def database_loaded(self):
+        """
+        Whether any test results are stored.
+        """
+
+    @abstractmethod
+    def persist_db(self):
+        """
+        Make every change so far durable.
+        """
+
+    @abstractmethod
+    def snapshot(self):
+        """
+        Write out the whole store, so the next start does not replay anything.
+        """
+
+    @abstractmethod
+    def close(self):
+        """
+        Persist the store and release it.
+        """
+
+
+def open_database(
+    backend, history_load_path, persistence_mode="backup", shard=None, state_dir=None
+):
+    """
+    Open the patient store of a backend.
+    Args:
+        - backend {str}: one of STORAGE_BACKENDS
+        - history_load_path {str}: history.csv, loaded on the first start
+        - persistence_mode {str}: one of PERSISTENCE_MODES
+        - shard {tuple}: (index, count) to only hold the patients of one shard
+        - state_dir {str}: where to persist the store, STATE_DIR by default
+    """
+    database = storage_class(backend)
+    return database(history_load_path, persistence_mode, shard, state_dir)
+
+
+def storage_class(backend):
+    """
+    The Storage subclass of a backend, one of STORAGE_BACKENDS.
+    """
+    assert backend in STORAGE_BACKENDS, f"Unknown storage backend: {backend}"
+    # the backends import this module for the base class
+    if backend == "sqlite":
+        from memory_db import InMemoryDatabase
+
+        return InMemoryDatabase
+    from columnar_db import ColumnarDatabase
+
+    return ColumnarDatabase
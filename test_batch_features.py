@@ -0,0 +1,82 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+import numpy as np
+from batch_features import compute_features_batch, to_datetime64, BATCH_FEATURES_COLUMNS
+from utils import D_value_compute, RV_compute, read_history_csv
+
+
+class TestBatchFeatures(unittest.TestCase):
+    def setUp(self):
+        """
+        Splits history.csv into stored results and LIMS events: the last results
+        of every patient, plus a few synthetic ones, are replayed as events.
+        """
+        rng = random.Random(11)
+        rows = {}
+        for mrn, date, result in read_history_csv('data/history.csv'):
+            rows.setdefault(mrn, []).append((date, result))
+        self.history = []
+        self.events = []
+        for mrn in sorted(rows)[:400]:
+            results = sorted(rows[mrn])
+            split = rng.randint(0, len(results))
+            self.history += [(mrn, date, result) for date, result in results[:split]]
+            for date, result in results[split:]:
+                lims_date = datetime.strptime(date, '%Y-%m-%d %H:%M:%S').strftime('%Y%m%d%H%M%S')
+                self.events.append((mrn, lims_date, result))
+            date = datetime.strptime(results[-1][0], '%Y-%m-%d %H:%M:%S')
+            for _ in range(2):
+                date += timedelta(hours=rng.choice([1, 47, 48, 49, 24 * 9, 24 * 400]))
+                self.events.append((mrn, date.strftime('%Y%m%d%H%M%S'), round(rng.uniform(40, 200), 2)))
+
+
+    def scalar_features(self):
+        """
+        Features from the scalar functions, replaying the events in order.
+        """
+        previous = {}
+        for mrn, date, result in self.history:
+            previous.setdefault(mrn, []).append((mrn, 40, 'f', date, result))
+        expected = []
+        for mrn, date, result in self.events:
+            history = previous.setdefault(mrn, [])
+            if history:
+                D, change = D_value_compute(result, date, history)
+                rv = RV_compute(result, date, history)
+                rv = (0, 0, 0, 0, 0) if rv == 0 else rv
+                expected.append(list(rv) + [change, D])
+            else:
+                expected.append([result, 0, 0, 0, 0, False, 0])
+            # SQLite hands LIMS dates back as integers
+            history.append((mrn, 40, 'f', int(date), result))
+        return expected
+
+
+    def test_batch_matches_scalar_functions(self):
+        event_mrns, event_dates, event_results = zip(*self.events)
+        history_mrns, history_dates, history_results = zip(*self.history)
+        features = compute_features_batch(
+            np.array(event_mrns),
+            to_datetime64(event_dates),
+            np.array(event_results),
+            np.array(history_mrns),
+            to_datetime64(history_dates),
+            np.array(history_results),
+        )
+        self.assertEqual(list(features.columns), BATCH_FEATURES_COLUMNS)
+        expected = self.scalar_features()
+        self.assertEqual(len(features), len(expected))
+        for i, row in enumerate(features.itertuples(index=False)):
+            with self.subTest(event=self.events[i]):
+                self.assertEqual(list(row), expected[i])
+
+
+    def test_to_datetime64_accepts_both_formats(self):
+        dates = to_datetime64(['2024-01-01 06:12:00', '20240101061200', 20240102000000])
+        self.assertEqual(dates[0], dates[1])
+        self.assertEqual(dates[2], np.datetime64('2024-01-02T00:00:00'))
+
+
+if __name__ == '__main__':
+    unittest.main()
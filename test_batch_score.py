@@ -0,0 +1,108 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+import pandas as pd
+from batch_score import batch_score, f3_score
+from benchmarks.workload import generate_workload, write_history_csv
+from compiled_tree import load_compiled_tree
+from constants import DEFAULT_AGE, DEFAULT_SEX
+from hl7_messages import admit_message, discharge_message, lims_message
+from hl7_parser import parse_message
+from memory_db import InMemoryDatabase
+from utils import label_encode, to_epoch_seconds
+
+
+class TestBatchScore(unittest.TestCase):
+    def setUp(self):
+        """
+        Writes the history of a synthetic stream to a temporary directory.
+        """
+        self.state_dir = tempfile.TemporaryDirectory()
+        history, self.stream, self.labels = generate_workload(
+            patients=100, messages=1500, aki_prevalence=0.5, seed=5
+        )
+        self.history_path = os.path.join(self.state_dir.name, 'history.csv')
+        write_history_csv(self.history_path, history)
+
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+
+    def live_predictions(self):
+        """
+        The predictions of the live loop, scoring the stream one message at a time
+        against the database as main.score does.
+        """
+        db = InMemoryDatabase(self.history_path, 'journal', state_dir=os.path.join(self.state_dir.name, 'state'))
+        tree = load_compiled_tree('dt_model.joblib')
+        predictions = []
+        for hl7_data in self.stream:
+            category, mrn, data = parse_message(hl7_data)
+            if category == 'PAS-admit':
+                db.insert_patient(mrn, int(data[0]), str(data[1]))
+            elif category == 'PAS-discharge':
+                db.discharge_patient(mrn)
+            else:
+                patient = db.get_patient(mrn)
+                state = db.get_feature_state(mrn)
+                if not patient:
+                    db.insert_patient(mrn, DEFAULT_AGE, DEFAULT_SEX)
+                    aki = 'n'
+                elif len(state):
+                    time = to_epoch_seconds(data[0])
+                    D, change = state.D_value_at(data[1], time)
+                    reference_values = state.RV_value_at(data[1], time)
+                    reference_values = (0, 0, 0, 0, 0) if reference_values == 0 else reference_values
+                    features = [patient[1], label_encode(patient[2]), *reference_values, change, D]
+                    aki = tree.predict(features)[0]
+                else:
+                    features = [patient[1], label_encode(patient[2]), data[1], 0, 0, 0, 0, 0, 0]
+                    aki = tree.predict(features)[0]
+                predictions.append((mrn, data[0], aki))
+                db.insert_test_result(mrn, data[0], data[1])
+        db.close()
+        return predictions
+
+
+    def test_predictions_match_the_live_loop(self):
+        predictions, failed = batch_score(self.stream, self.history_path, 'dt_model.joblib', 1)
+        self.assertEqual(failed, 0)
+        self.assertEqual(list(zip(predictions['mrn'], predictions['date'], predictions['aki'])), self.live_predictions())
+        # partitions only change where the patients are scored
+        partitioned, _ = batch_score(self.stream, self.history_path, 'dt_model.joblib', 3)
+        pd.testing.assert_frame_equal(predictions, partitioned)
+
+
+    def test_results_of_patients_not_admitted_are_negative(self):
+        date = datetime(2024, 6, 1, 10)
+        stream = [
+            lims_message('0012352', date, 300.0),
+            discharge_message('0012352', date),
+            admit_message('0012352', date, datetime(1990, 1, 1), 'M'),
+            lims_message('0012352', date.replace(hour=11), 310.0),
+            discharge_message('0012352', date),
+            lims_message('0012352', date.replace(hour=12), 320.0),
+            b'not an HL7 message',
+        ]
+        predictions, failed = batch_score(stream, self.history_path, 'dt_model.joblib', 1)
+        self.assertEqual(failed, 1)
+        self.assertEqual((predictions['aki'][0], predictions['aki'][2]), ('n', 'n'))
+        age = int(parse_message(stream[2])[2][0])
+        self.assertEqual(list(predictions['age']), [DEFAULT_AGE, age, DEFAULT_AGE])
+        # every result counts towards the features of the next one
+        self.assertEqual(list(predictions['C1']), [300.0, 310.0, 320.0])
+        self.assertEqual(list(predictions['RV1']), [0.0, 300.0, 300.0])
+
+
+    def test_f3_weighs_recall(self):
+        labels = {('1', '20240601100000'), ('2', '20240601100000')}
+        self.assertEqual(f3_score(set(), labels)['f3'], 0.0)
+        score = f3_score({('1', '20240601100000')}, labels)
+        self.assertEqual((score['precision'], score['recall']), (1.0, 0.5))
+        self.assertAlmostEqual(score['f3'], 10 * 0.5 / 9.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
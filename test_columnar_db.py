@@ -0,0 +1,82 @@
+import random
+import tempfile
+import unittest
+import numpy as np
+from columnar_db import ColumnarDatabase
+from memory_db import InMemoryDatabase
+
+
+class TestColumnarDatabase(unittest.TestCase):
+    def setUp(self):
+        """
+        Loads history.csv into both stores, in a temporary directory.
+        """
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.sqlite = InMemoryDatabase('data/history.csv', 'journal', state_dir=self.state_dir.name)
+        self.db = ColumnarDatabase('data/history.csv', 'journal', state_dir=self.state_dir.name)
+        self.mrns = [row[0] for row in self.sqlite.connection.execute(
+            'SELECT mrn FROM mrns ORDER BY mrn'
+        )]
+
+
+    def tearDown(self):
+        self.sqlite.close()
+        if self.db.columns:
+            self.db.close()
+        self.state_dir.cleanup()
+
+
+    def test_history_and_features_match_the_sqlite_store(self):
+        rng = random.Random(3)
+        for mrn in self.mrns[:200]:
+            for db in (self.sqlite, self.db):
+                db.insert_patient(mrn, 40, 'f')
+            for _ in range(3):
+                date = '2024%02d%02d%02d0000' % (rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23))
+                result = round(rng.uniform(40, 200), 2)
+                expected, actual = (db.get_feature_state(mrn) for db in (self.sqlite, self.db))
+                with self.subTest(mrn=mrn, date=date):
+                    self.assertEqual(actual.D_value(result, date), expected.D_value(result, date))
+                    self.assertEqual(actual.RV_value(result, date), expected.RV_value(result, date))
+                for db in (self.sqlite, self.db):
+                    db.insert_test_result(mrn, date, result)
+            self.assertEqual(self.db.get_patient_history(mrn), self.sqlite.get_patient_history(mrn))
+        self.assertEqual(
+            self.db.get_test_result('822825', '2024-01-01 06:12:00'), ('822825', '2024-01-01 06:12:00', 68.58)
+        )
+
+
+    def test_duplicate_results_are_skipped(self):
+        inserted = self.db.insert_test_results(
+            [('822825', '2024-01-01 06:12:00', 1.0), ('0012352', '20240924153600', 109.43)]
+        )
+        self.assertEqual(inserted, 1)
+        self.db.insert_test_result('0012352', '20240924153600', 1.0)
+        self.assertEqual(self.db.get_test_results('0012352'), [('0012352', 20240924153600, 109.43)])
+        self.assertEqual(self.db.get_test_result('822825', '2024-01-01 06:12:00')[2], 68.58)
+
+
+    def test_persisted_rows_are_mapped_after_a_crash(self):
+        self.db.insert_patient('0012352', 29, 'f')
+        self.db.insert_patient('65289', 56, 'f')
+        self.db.discharge_patient('65289')
+        self.db.insert_test_result('0012352', '20240924153600', 109.43)
+        self.db.persist_db()
+        # never persisted, so lost with the crash
+        self.db.insert_test_result('0012352', '20240925153600', 99.0)
+        self.db.patient_log.close()
+        self.db.mrn_log.close()
+        self.db.columns = {}
+
+        recovered = ColumnarDatabase('data/history.csv', 'journal', state_dir=self.state_dir.name)
+        self.assertIsInstance(recovered.columns['result'], np.memmap)
+        self.assertEqual(recovered.get_patient('0012352'), ('0012352', 29, 'f'))
+        self.assertIsNone(recovered.get_patient('65289'))
+        self.assertEqual(recovered.get_test_results('0012352'), [('0012352', 20240924153600, 109.43)])
+        for mrn in self.mrns[:100]:
+            self.assertEqual(recovered.get_test_results(mrn), self.sqlite.get_test_results(mrn))
+        recovered.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
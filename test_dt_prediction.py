@@ -0,0 +1,47 @@
+import unittest
+import numpy as np
+import pandas as pd
+from joblib import load
+from compiled_tree import CompiledDecisionTree
+from constants import DT_MODEL_PATH, FEATURES_COLUMNS
+from fixtures import history_feature_rows
+from utils import predict_with_dt
+
+
+class TestDecisionTreePrediction(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dt_model = load(DT_MODEL_PATH)
+        cls.features = history_feature_rows('data/history.csv')
+        cls.expected = predict_with_dt(cls.dt_model, cls.features)
+
+
+    def test_compiled_tree_matches_model(self):
+        compiled = CompiledDecisionTree.from_model(self.dt_model)
+        predictions = [compiled.predict(row)[0] for row in self.features.values.tolist()]
+        self.assertEqual(predictions, self.expected)
+        # both labels are exercised
+        self.assertEqual(set(predictions), {'n', 'y'})
+        self.assertEqual(compiled.predict_many(self.features.values).tolist(), self.expected)
+
+
+    def test_compiled_tree_matches_model_on_random_rows(self):
+        # rows spread around the thresholds reach every leaf of the tree
+        rng = np.random.default_rng(3)
+        tree = self.dt_model.tree_
+        splits = tree.feature >= 0
+        rows = np.empty((20000, tree.n_features))
+        for column in range(tree.n_features):
+            thresholds = tree.threshold[splits & (tree.feature == column)]
+            if len(thresholds) == 0:
+                thresholds = np.array([0.0])
+            rows[:, column] = rng.choice(thresholds, len(rows)) + rng.normal(0, 1e-3, len(rows))
+        rows[::7] = np.float32(rows[::7])
+        expected = predict_with_dt(self.dt_model, pd.DataFrame(rows, columns=FEATURES_COLUMNS))
+        compiled = CompiledDecisionTree.from_model(self.dt_model)
+        self.assertEqual(compiled.predict_many(rows).tolist(), expected)
+        self.assertEqual([compiled.predict_one(row) for row in rows.tolist()], expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import os
+import random
+import statistics
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from memory_db import InMemoryDatabase
+from feature_cache import FeatureCache, FeatureSummary, PatientFeatureState
+from utils import D_value_compute, RV_compute
+
+
+class TestFeatureCache(unittest.TestCase):
+    def setUp(self):
+        """
+        Loads history.csv into a database stored in a temporary directory.
+        """
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.paths = patch.multiple(
+            'memory_db',
+            ON_DISK_DB_PATH=os.path.join(self.state_dir.name, 'database.db'),
+            ON_DISK_JOURNAL_PATH=os.path.join(self.state_dir.name, 'journal.log'),
+        )
+        self.paths.start()
+        self.db = InMemoryDatabase('data/history.csv')
+
+
+    def tearDown(self):
+        self.db.close()
+        self.paths.stop()
+        self.state_dir.cleanup()
+
+
+    def assert_same_features(self, mrn, result, date):
+        history = self.db.get_patient_history(mrn)
+        state = self.db.get_feature_state(mrn)
+        self.assertEqual(len(state), len(history))
+        self.assertEqual(state.D_value(result, date), D_value_compute(result, date, history))
+        self.assertEqual(state.RV_value(result, date), RV_compute(result, date, history))
+
+
+    def test_features_match_the_history_scan(self):
+        rng = random.Random(7)
+        mrns = [row[0] for row in self.db.connection.execute(
+            'SELECT mrn FROM mrns ORDER BY mrn LIMIT 200'
+        )]
+        for mrn in mrns:
+            self.db.insert_patient(mrn, 40, 'f')
+            date = datetime(2024, 3, 1)
+            # a few LIMS results, some close together and some far apart
+            for _ in range(4):
+                date += timedelta(hours=rng.choice([1, 20, 47, 48, 49, 24 * 6, 24 * 9, 24 * 200]))
+                lims_date = date.strftime('%Y%m%d%H%M%S')
+                result = round(rng.uniform(40, 200), 2)
+                with self.subTest(mrn=mrn, date=lims_date):
+                    self.assert_same_features(mrn, result, lims_date)
+                self.db.insert_test_result(mrn, lims_date, result)
+
+
+    def test_features_match_for_lims_only_history(self):
+        self.db.insert_patient('0012352', 29, 'f')
+        dates = ['20240101100000', '20240102090000', '20240105100000', '20240301100000']
+        for date, result in zip(dates, [80.0, 95.5, 120.25, 70.0]):
+            self.db.insert_test_result('0012352', date, result)
+        for date in ['20240103100000', '20240305100000', '20240901100000']:
+            with self.subTest(date=date):
+                self.assert_same_features('0012352', 101.0, date)
+
+
+    def test_features_match_for_results_before_the_last_one(self):
+        self.db.insert_patient('0012352', 29, 'f')
+        for date, result in zip(['20240301100000', '20240310100000'], [80.0, 95.5]):
+            self.db.insert_test_result('0012352', date, result)
+        for date in ['20240302100000', '20240308100000', '20240311100000']:
+            with self.subTest(date=date):
+                self.assert_same_features('0012352', 101.0, date)
+
+
+    def test_summary_is_read_from_the_features_table(self):
+        self.db.insert_patient('822825', 40, 'f')
+        self.db.insert_test_result('822825', '20240301100000', 80.0)
+        expected = self.db.get_feature_state('822825').to_row()
+        # a cache miss reads the patient's row, not their test results
+        self.db.feature_cache.clear()
+        self.db.connection.execute("DELETE FROM test_results WHERE mrn_id = (SELECT id FROM mrns WHERE mrn = '822825')")
+        self.assertEqual(self.db.get_feature_state('822825').to_row(), expected)
+        # and a rebuild regenerates the rows from the test results
+        self.assertEqual(self.db.rebuild_features(), len(self.db.connection.execute(
+            'SELECT DISTINCT mrn_id FROM test_results'
+        ).fetchall()))
+        self.assertEqual(len(self.db.get_feature_state('822825')), 0)
+        self.db.insert_patient('65289', 56, 'f')
+        self.assert_same_features('65289', 101.0, '20240301100000')
+
+
+    def test_discharged_patients_are_evicted_first(self):
+        cache = FeatureCache(capacity=2)
+        cache.get('1', FeatureSummary)
+        cache.get('2', FeatureSummary)
+        cache.discharge('2')
+        cache.get('3', FeatureSummary)
+        self.assertIn('1', cache)
+        self.assertNotIn('2', cache)
+        self.assertIn('3', cache)
+
+
+    def test_summary_matches_the_feature_state(self):
+        rng = random.Random(11)
+        summary = FeatureSummary()
+        state = PatientFeatureState()
+        date = datetime(2024, 1, 1)
+        for i in range(500):
+            # mostly in order, sometimes a result from before the last one
+            date += timedelta(hours=rng.choice([-60, 1, 12, 30, 49, 24 * 5]))
+            result = round(rng.uniform(40, 400), 2)
+            summary.add_time(int(date.timestamp()), 1, result)
+            state.add_time(int(date.timestamp()), 1, result)
+            if i % 7 == 0:
+                summary = FeatureSummary.from_row(summary.to_row())
+            later = int((date + timedelta(hours=rng.choice([1, 48, 72]))).timestamp())
+            with self.subTest(i=i):
+                self.assertEqual(len(summary), len(state))
+                self.assertEqual(summary.median(), state.median())
+                if later >= summary.last_time:
+                    self.assertEqual(summary.D_value_at(101.0, later), state.D_value_at(101.0, later))
+
+
+    def test_summary_keeps_the_results_near_the_median(self):
+        rng = random.Random(5)
+        rows = []
+        summary = FeatureSummary(lambda: rows, window=4)
+        # drifting results move the median past the ones kept
+        for i in range(400):
+            result = round(rng.uniform(40, 200) + i * rng.choice([-1, 1, 2]), 2)
+            rows.append((i * 3600, 1, result))
+            summary.add_time(i * 3600, 1, result)
+            if i % 13 == 0:
+                summary = FeatureSummary.from_row(summary.to_row(), lambda: rows, window=4)
+            with self.subTest(i=i):
+                self.assertEqual(summary.median(), statistics.median(row[2] for row in rows))
+                self.assertLessEqual(len(summary.lower_half), 8)
+                self.assertLessEqual(len(summary.upper_half), 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
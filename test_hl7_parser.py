@@ -0,0 +1,28 @@
+import unittest
+from unittest.mock import patch
+from fixtures import synthetic_messages
+from hl7_parser import parse_message
+from utils import parse_hl7_message, parse_system_message
+
+
+class TestHL7Parser(unittest.TestCase):
+    def test_matches_hl7_parse(self):
+        for data in synthetic_messages('data/history.csv', 600):
+            with self.subTest(message=data):
+                self.assertEqual(parse_message(data), parse_system_message(parse_hl7_message(data)))
+
+
+    def test_accepts_new_line_separators(self):
+        data = b"MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240924153600||ORU^R01|||2.5\nPID|1||54229\nOBR|1||||||20240924153600\nOBX|1|SN|CREATININE||103.56923163550283"
+        self.assertEqual(parse_message(data), ('LIMS', '54229', ['20240924153600', 103.56923163550283]))
+
+
+    def test_unexpected_messages_fall_back_to_hl7_parse(self):
+        data = b"MSH|^~\\&|SIMULATION|SOUTH RIVERSIDE|||20240924153400||ADT^A08|||2.5\rPID|1||853518\r"
+        with patch('hl7_parser.parse_hl7_message', wraps=parse_hl7_message) as fallback:
+            self.assertEqual(parse_message(data), ('PAS-discharge', '853518', ['', '']))
+        fallback.assert_called_once()
+
+
+if __name__ == '__main__':
+    unittest.main()
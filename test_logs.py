@@ -0,0 +1,59 @@
+import io
+import json
+import logging
+import unittest
+from logs import configure_logging, stop_logging
+
+
+class TestLogging(unittest.TestCase):
+    def setUp(self):
+        self.root = logging.getLogger()
+        self.handlers = self.root.handlers[:]
+        self.level = self.root.level
+        self.stream = io.StringIO()
+
+
+    def tearDown(self):
+        stop_logging()
+        for handler in self.root.handlers[:]:
+            self.root.removeHandler(handler)
+        for handler in self.handlers:
+            self.root.addHandler(handler)
+        self.root.setLevel(self.level)
+
+
+    def test_records_are_written_as_json_by_the_listener(self):
+        configure_logging('INFO', 'json', self.stream)
+        logger = logging.getLogger('test_logs')
+        logger.debug('Parsed values: %s', '822825')
+        logger.info('Page for %s on %s sent.', '822825', '2024-01-01 06:12:00')
+        try:
+            raise OSError('disk full')
+        except OSError:
+            logger.exception('Snapshot failed')
+        # stopping writes the records still queued
+        stop_logging()
+        lines = [json.loads(line) for line in self.stream.getvalue().splitlines()]
+        self.assertEqual([line['level'] for line in lines], ['INFO', 'ERROR'])
+        self.assertEqual(lines[0]['message'], 'Page for 822825 on 2024-01-01 06:12:00 sent.')
+        self.assertEqual(lines[0]['logger'], 'test_logs')
+        self.assertIn('OSError: disk full', lines[1]['exception'])
+
+
+    def test_arguments_are_not_formatted_below_the_level(self):
+        class Argument:
+            formatted = False
+
+            def __str__(self):
+                Argument.formatted = True
+                return 'argument'
+
+        configure_logging('WARNING', 'text', self.stream)
+        logging.getLogger('test_logs').info('Message %s', Argument())
+        stop_logging()
+        self.assertFalse(Argument.formatted)
+        self.assertEqual(self.stream.getvalue(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
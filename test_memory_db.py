@@ -1,13 +1,22 @@
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
 import unittest
+from unittest.mock import patch
+from constants import SUMMARY_MEDIAN_WINDOW
 from memory_db import InMemoryDatabase
-from datetime import datetime
+from feature_cache import PatientFeatureState
+from datetime import datetime, timedelta
 
 class TestInMemoryDatabase(unittest.TestCase):
     def setUp(self):
         """
-        Initialises the database before each test.
+        Initialises the database before each test, in a temporary directory.
         """
-        self.db = InMemoryDatabase('data/history.csv')
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.db = InMemoryDatabase('data/history.csv', state_dir=self.state_dir.name)
 
 
     def tearDown(self):
@@ -15,6 +24,7 @@ class TestInMemoryDatabase(unittest.TestCase):
         Closes the database after each test.
         """
         self.db.close()
+        self.state_dir.cleanup()
 
 
     def test_insert_and_get_for_patient_features(self):
@@ -49,7 +59,7 @@ class TestInMemoryDatabase(unittest.TestCase):
 
 
     def test_insert_and_get_for_test_result(self):
-        date = str(datetime.today())
+        date = str(datetime.today().replace(microsecond=0))
         actual_record = ('0012352', date, 109.43)
         # insert
         self.db.insert_test_result(*actual_record)
@@ -59,7 +69,7 @@ class TestInMemoryDatabase(unittest.TestCase):
 
     
     def test_insert_and_get_for_test_results(self):
-        actual_record = ('0012352', str(datetime.today()), 109.43)
+        actual_record = ('0012352', str(datetime.today().replace(microsecond=0)), 109.43)
         # insert
         self.db.insert_test_result(*actual_record)
         # get
@@ -68,7 +78,7 @@ class TestInMemoryDatabase(unittest.TestCase):
 
     
     def test_get_patient_history(self):
-        date = str(datetime.today())
+        date = str(datetime.today().replace(microsecond=0))
         patient = ['0012352', 29, 'f']
         test_result = ['0012352', date, 109.43]
         # insert
@@ -79,6 +89,18 @@ class TestInMemoryDatabase(unittest.TestCase):
         self.assertEqual(tuple(patient + test_result[1:]), queried_record)
 
 
+    def test_history_is_bulk_loaded_and_indexed(self):
+        # the history rows are loaded and the (mrn, date) pair is unique
+        self.assertEqual(
+            self.db.get_test_result('822825', '2024-01-01 06:12:00'), ('822825', '2024-01-01 06:12:00', 68.58)
+        )
+        inserted = self.db.insert_test_results(
+            [('822825', '2024-01-01 06:12:00', 1.0), ('0012352', '20240924153600', 109.43)]
+        )
+        self.assertEqual(inserted, 1)
+        self.assertEqual(self.db.get_test_result('822825', '2024-01-01 06:12:00')[2], 68.58)
+
+
     def test_discharge_patient(self):
         patient = ['0012352', 29, 'f']
         # insert
@@ -90,5 +112,224 @@ class TestInMemoryDatabase(unittest.TestCase):
         self.assertIsNone(queried_record)
 
 
+
+    def test_compaction_archives_old_results(self):
+        results = sorted(self.db.get_all_test_results('822825'), key=str)
+        expected = self.db.get_feature_state('822825').to_row()
+        used_bytes = self.db.used_bytes()
+        archived, reclaimed = self.db.compact(age=7 * 24 * 60 * 60)
+        self.assertGreater(archived, 0)
+        # net of the summaries stored for the move
+        self.assertEqual(reclaimed, used_bytes - self.db.used_bytes())
+        # the results more than a week older than the latest one are archived
+        self.assertEqual(
+            sorted(date for _, date, _ in self.db.get_test_results('822825')),
+            ['2024-01-17 06:27:00', '2024-01-23 17:55:00'],
+        )
+        self.assertEqual(sorted(self.db.get_all_test_results('822825'), key=str), results)
+        self.db.feature_cache.clear()
+        self.assertEqual(self.db.get_feature_state('822825').to_row(), expected)
+        # summaries rebuilt, e.g. after a bulk load, still see the archived results
+        self.db.rebuild_features()
+        self.assertEqual(self.db.get_feature_state('822825').to_row(), expected)
+        # so does the D of a result older than the latest one
+        full = PatientFeatureState()
+        for date, result in results:
+            full.add_result(date, result)
+        self.assertEqual(
+            self.db.get_feature_state('822825').D_value(60.0, '2024-01-12 10:00:00'),
+            full.D_value(60.0, '2024-01-12 10:00:00'),
+        )
+        # and a compacted store compacts nothing more
+        self.assertEqual(self.db.compact(age=7 * 24 * 60 * 60)[0], 0)
+
+    def test_test_result_summary_and_features_are_one_transaction(self):
+        self.db.insert_patient('0012352', 29, 'f')
+        with self.assertRaises(sqlite3.OperationalError):
+            self.db.insert_test_result('0012352', '20240924153600', 109.43, {'no_such_column': 1})
+        # neither the result nor its summary were committed
+        self.assertIsNone(self.db.get_test_result('0012352', '20240924153600'))
+        self.assertEqual(self.db.connection.execute(
+            "SELECT last_time FROM features WHERE mrn = '0012352'"
+        ).fetchone(), (None,))
+        self.assertEqual(len(self.db.get_feature_state('0012352')), 0)
+
+    def test_compacted_summary_does_not_keep_the_archived_results(self):
+        self.db.insert_patient('0012352', 29, 'f')
+        date = datetime(2020, 1, 1)
+        for i in range(1000):
+            self.db.insert_test_result(
+                '0012352', (date + timedelta(days=i)).strftime('%Y%m%d%H%M%S'), 50.0 + i % 97
+            )
+        self.db.compact(age=30 * 24 * 60 * 60)
+        self.assertEqual(len(self.db.get_test_results('0012352')), 31)
+        # the results around the median, not the thousand of them
+        median_bytes = self.db.connection.execute(
+            "SELECT length(lower_results) + length(upper_results) FROM features WHERE mrn = '0012352'"
+        ).fetchone()[0]
+        self.assertLessEqual(median_bytes, 2 * SUMMARY_MEDIAN_WINDOW * 8)
+        self.assertGreaterEqual(self.db.summary_bytes(), median_bytes)
+        # a stored summary still has the median of every result
+        self.db.feature_cache.clear()
+        history = self.db.get_all_test_results('0012352')
+        self.assertEqual(len(history), 1000)
+        self.assertEqual(
+            self.db.get_feature_state('0012352').median(),
+            statistics.median(result for _, result in history),
+        )
+
+    def test_compaction_waits_for_a_write_in_progress(self):
+        results = self.db.get_test_results('822825')
+        compactor = threading.Thread(
+            target=self.db.compact, kwargs={'age': 7 * 24 * 60 * 60}
+        )
+        # a write of the message loop, not committed yet
+        with self.db.write_lock:
+            self.db.connection.execute(
+                "INSERT INTO patients (mrn, age, sex) VALUES ('31251122', 42, 'm')"
+            )
+            compactor.start()
+            compactor.join(0.2)
+            self.assertTrue(compactor.is_alive())
+            self.assertEqual(self.db.get_test_results('822825'), results)
+            self.db.connection.rollback()
+        compactor.join()
+        self.assertIsNone(self.db.get_patient('31251122'))
+        self.assertEqual(len(self.db.get_test_results('822825')), 2)
+
+    def test_snapshot_waits_for_a_write_in_progress(self):
+        snapshotter = threading.Thread(target=self.db.snapshot)
+        with self.db.write_lock:
+            self.db.connection.execute(
+                "INSERT INTO patients (mrn, age, sex) VALUES ('31251122', 42, 'm')"
+            )
+            snapshotter.start()
+            snapshotter.join(0.2)
+            self.assertTrue(snapshotter.is_alive())
+            self.db.connection.rollback()
+        snapshotter.join()
+        with sqlite3.connect(self.db.db_path) as disk_connection:
+            self.assertIsNone(
+                disk_connection.execute(
+                    "SELECT * FROM patients WHERE mrn = '31251122'"
+                ).fetchone()
+            )
+
+    def test_discharge_queued_during_a_snapshot_is_kept(self):
+        self.db.insert_patient('31251122', 42, 'm')
+        self.db.insert_patient('31251123', 24, 'f')
+        self.db.discharge_patient('31251122')
+        db = self.db
+
+        class DiskConnection:
+            """
+            The on-disk database, discharging a patient as the queue is applied.
+            """
+            def __init__(self):
+                self.connection = sqlite3.connect(':memory:')
+                self.connection.execute('CREATE TABLE patients (mrn TEXT, age INTEGER, sex TEXT)')
+
+            def execute(self, *args):
+                db.discharge_patient('31251123')
+                return self.connection.execute(*args)
+
+            def commit(self):
+                self.connection.commit()
+
+        self.db.execute_queued_operations(DiskConnection())
+        # applied on the next snapshot
+        self.assertEqual(self.db.discharged_patient_mrns, {'31251123': True})
+
+
+class TestJournalPersistence(unittest.TestCase):
+    def setUp(self):
+        """
+        Points the on-disk database and journal to a temporary directory.
+        """
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.state_dir.name, 'database.db')
+        self.journal_path = os.path.join(self.state_dir.name, 'journal.log')
+        self.paths = patch.multiple(
+            'memory_db', ON_DISK_DB_PATH=self.db_path, ON_DISK_JOURNAL_PATH=self.journal_path
+        )
+        self.paths.start()
+
+
+    def tearDown(self):
+        self.paths.stop()
+        self.state_dir.cleanup()
+
+
+    def test_persist_only_appends_to_journal(self):
+        db = InMemoryDatabase('data/history.csv', persistence_mode='journal')
+        snapshot_mtime = os.path.getmtime(self.db_path)
+        db.insert_patient('0012352', 29, 'f')
+        db.insert_test_result('0012352', '20240924153600', 109.43)
+        db.persist_db()
+        # the snapshot is untouched, the deltas are in the journal
+        self.assertEqual(snapshot_mtime, os.path.getmtime(self.db_path))
+        with open(self.journal_path) as journal:
+            self.assertEqual(len(journal.readlines()), 2)
+        db.close()
+
+
+    def test_recovery_replays_acknowledged_messages(self):
+        db = InMemoryDatabase('data/history.csv', persistence_mode='journal')
+        db.insert_patient('0012352', 29, 'f')
+        db.insert_patient('65289', 56, 'f')
+        db.insert_test_result('0012352', '20240924153600', 109.43)
+        db.discharge_patient('65289')
+        db.persist_db()
+        # simulate a crash: the journal is never folded into a snapshot
+        db.journal.close()
+        db.connection.close()
+
+        recovered = InMemoryDatabase('data/history.csv', persistence_mode='journal')
+        self.assertEqual(recovered.get_patient('0012352'), ('0012352', 29, 'f'))
+        self.assertIsNone(recovered.get_patient('65289'))
+        self.assertEqual(
+            recovered.get_test_result('0012352', '20240924153600'),
+            ('0012352', 20240924153600, 109.43),
+        )
+        # the replayed journal has been folded into the snapshot
+        self.assertEqual(os.path.getsize(self.journal_path), 0)
+        recovered.close()
+
+
+    def test_snapshot_truncates_journal(self):
+        db = InMemoryDatabase('data/history.csv', persistence_mode='journal')
+        db.insert_patient('0012352', 29, 'f')
+        db.persist_db()
+        db.snapshot()
+        self.assertEqual(os.path.getsize(self.journal_path), 0)
+        self.assertFalse(os.path.exists(self.journal_path + '.old'))
+        db.close()
+
+
+    def test_text_dated_snapshot_is_migrated(self):
+        db = InMemoryDatabase('data/history.csv', persistence_mode='journal')
+        db.close()
+        # rewrite the snapshot's test results as they were stored before
+        with sqlite3.connect(self.db_path) as connection:
+            connection.execute('DROP TABLE test_results')
+            connection.execute('DROP TABLE mrns')
+            connection.execute('CREATE TABLE test_results (mrn TEXT, date TEXT, result REAL)')
+            connection.executemany(
+                'INSERT INTO test_results VALUES (?, ?, ?)',
+                [('822825', '2024-01-01 06:12:00', 68.58), ('822825', 20240924153600, 109.43)],
+            )
+
+        migrated = InMemoryDatabase('data/history.csv', persistence_mode='journal')
+        self.assertEqual(
+            migrated.get_test_results('822825'),
+            [('822825', 20240924153600, 109.43), ('822825', '2024-01-01 06:12:00', 68.58)],
+        )
+        migrated.close()
+        # the migrated results were folded into a fresh snapshot
+        with sqlite3.connect(self.db_path) as connection:
+            columns = [row[1] for row in connection.execute('PRAGMA table_info(test_results)')]
+        self.assertEqual(columns, ['mrn_id', 'time', 'lims', 'result'])
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -27,7 +27,7 @@ expected_num_patients = memory_cursor.execute(count_all_patients_query).fetchone
 actual_num_patients = disk_cursor.execute(count_all_patients_query).fetchone()
 
 # test present test results
-count_all_test_results_query = "SELECT Count(mrn) FROM test_results"
+count_all_test_results_query = "SELECT Count(*) FROM test_results"
 expected_num_results = memory_cursor.execute(count_all_test_results_query).fetchone()
 actual_num_results = disk_cursor.execute(count_all_test_results_query).fetchone()
 
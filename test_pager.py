@@ -0,0 +1,129 @@
+import os
+import pickle
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from prometheus_client import CollectorRegistry, Counter, Gauge, Summary
+from pager import Pager, PagerQueue, backoff_delay
+
+
+class PagerHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length'])).decode()
+        server = self.server
+        with server.lock:
+            status = server.statuses.pop(0) if server.statuses else 200
+            server.requests.append((body, status))
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestPager(unittest.TestCase):
+    def setUp(self):
+        """
+        Starts a local pager service and points the pager state to a temporary
+        directory.
+        """
+        self.server = ThreadingHTTPServer(('localhost', 0), PagerHandler)
+        self.server.lock = threading.Lock()
+        self.server.statuses = []
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.queue_path = os.path.join(self.state_dir.name, 'pager.db')
+        self.stack_path = os.path.join(self.state_dir.name, 'pager.pkl')
+        self.patches = patch.multiple(
+            'pager',
+            ON_DISK_PAGER_STACK_PATH=self.stack_path,
+            PAGER_BACKOFF_BASE=0.01,
+        )
+        self.patches.start()
+        registry = CollectorRegistry()
+        self.metrics = (
+            Gauge('queue_depth', 'Queue depth', ['stage'], registry=registry),
+            Summary('stage_latency', 'Stage latency', ['stage'], registry=registry),
+            Counter('failures', 'Failures', registry=registry),
+        )
+
+
+    def tearDown(self):
+        self.patches.stop()
+        self.server.shutdown()
+        self.server.server_close()
+        self.state_dir.cleanup()
+
+
+    def make_pager(self):
+        return Pager(f'localhost:{self.server.server_port}', *self.metrics, queue_path=self.queue_path)
+
+
+    def wait_for_pages(self, pager, count):
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline:
+            sent = [body for body, status in self.server.requests if status == 200]
+            if len(sent) >= count and pager.pending() == 0:
+                return sent
+            time.sleep(0.01)
+        self.fail('pages were not sent in time')
+
+
+    def test_failed_pages_are_retried(self):
+        self.server.statuses = [500, 500]
+        pager = self.make_pager()
+        pager.start()
+        pager.page('822825', '20240124224300')
+        self.assertEqual(self.wait_for_pages(pager, 1), ['822825,20240124224300'])
+        self.assertEqual(len(self.server.requests), 3)
+        self.assertEqual(self.metrics[2]._value.get(), 2)
+        pager.stop()
+
+
+    def test_duplicate_pages_are_dropped(self):
+        pager = self.make_pager()
+        pager.start()
+        pager.page('822825', '20240124224300')
+        pager.page('822825', '20240124224300')
+        self.wait_for_pages(pager, 1)
+        pager.stop()
+        # a replayed message does not page again after a restart either
+        pager = self.make_pager()
+        pager.start()
+        pager.page('822825', '20240124224300')
+        pager.page('822825', '20240125010000')
+        self.assertEqual(len(self.wait_for_pages(pager, 2)), 2)
+        pager.stop()
+
+
+    def test_unsent_pages_survive_a_restart(self):
+        with open(self.stack_path, 'wb') as file:
+            pickle.dump([('65289', '20240101120000')], file)
+        queue = PagerQueue(self.queue_path)
+        queue.add('822825', '20240124224300')
+        queue.close()
+
+        pager = self.make_pager()
+        self.assertFalse(os.path.exists(self.stack_path))
+        pager.start()
+        self.assertEqual(
+            sorted(self.wait_for_pages(pager, 2)),
+            ['65289,20240101120000', '822825,20240124224300'],
+        )
+        pager.stop()
+
+
+    def test_backoff_is_capped(self):
+        with patch('pager.PAGER_BACKOFF_CAP', 2.0):
+            delays = [backoff_delay(attempts) for attempts in range(50)]
+        self.assertTrue(all(0 <= delay <= 2.0 for delay in delays))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest.mock import patch
+from prometheus_client import CollectorRegistry, Counter, Gauge, Summary
+from pipeline import InboundLog, Stage
+
+
+class TestInboundLog(unittest.TestCase):
+    def setUp(self):
+        """
+        Points the inbound log and its offset to a temporary directory.
+        """
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.log_path = os.path.join(self.state_dir.name, 'inbound.log')
+        self.paths = patch.multiple(
+            'pipeline',
+            ON_DISK_INBOUND_LOG_PATH=self.log_path,
+            ON_DISK_INBOUND_OFFSET_PATH=os.path.join(self.state_dir.name, 'inbound.offset'),
+        )
+        self.paths.start()
+
+
+    def tearDown(self):
+        self.paths.stop()
+        self.state_dir.cleanup()
+
+
+    def test_uncommitted_messages_are_pending_after_restart(self):
+        log = InboundLog()
+        first = log.append(b'MSH|first')
+        second = log.append(b'MSH|second')
+        third = log.append(b'MSH|third')
+        log.sync()
+        log.commit(first)
+        log.close()
+
+        log = InboundLog()
+        self.assertEqual(log.pending(), [(second, b'MSH|second'), (third, b'MSH|third')])
+        # sequence numbers keep growing across restarts
+        self.assertGreater(log.append(b'MSH|fourth'), third)
+        log.close()
+
+
+    def test_torn_record_is_dropped(self):
+        log = InboundLog()
+        seq = log.append(b'MSH|complete')
+        log.append(b'MSH|torn')
+        log.close()
+        os.truncate(self.log_path, os.path.getsize(self.log_path) - 3)
+
+        log = InboundLog()
+        self.assertEqual(log.pending(), [(seq, b'MSH|complete')])
+        log.close()
+
+
+    def test_log_is_emptied_once_processed(self):
+        with patch('pipeline.INBOUND_LOG_MAX_BYTES', 0):
+            log = InboundLog()
+            seq = log.append(b'MSH|message')
+            log.sync()
+            log.commit(seq)
+            log.close()
+        self.assertEqual(os.path.getsize(self.log_path), 0)
+        log = InboundLog()
+        self.assertEqual(log.pending(), [])
+        self.assertEqual(log.append(b'MSH|next'), seq + 1)
+        log.close()
+
+
+class TestStage(unittest.TestCase):
+    def setUp(self):
+        registry = CollectorRegistry()
+        self.metrics = (
+            Gauge('queue_depth', 'Queue depth', ['stage'], registry=registry),
+            Summary('stage_latency', 'Stage latency', ['stage'], registry=registry),
+            Counter('failures', 'Failures', registry=registry),
+        )
+
+
+    def test_items_are_handled_in_order_and_failures_skipped(self):
+        handled = []
+
+        def handle(item):
+            if item == 3:
+                raise ValueError('bad message')
+            handled.append(item)
+
+        stage = Stage('scoring', handle, 2, *self.metrics)
+        stage.start()
+        for item in range(10):
+            stage.put(item)
+        stage.stop()
+        self.assertEqual(handled, [0, 1, 2, 4, 5, 6, 7, 8, 9])
+        self.assertEqual(self.metrics[2]._value.get(), 1)
+
+
+    def test_full_queue_blocks_the_producer(self):
+        release = threading.Event()
+        idle = []
+        stage = Stage('paging', lambda item: release.wait(), 1, *self.metrics, on_idle=lambda: idle.append(True))
+        stage.start()
+        stage.put('handled')
+        stage.put('queued')
+        producer = threading.Thread(target=stage.put, args=('blocked',))
+        producer.start()
+        producer.join(0.2)
+        self.assertTrue(producer.is_alive())
+        release.set()
+        producer.join()
+        stage.stop()
+        self.assertTrue(idle)
+
+
+    def test_items_put_before_the_start_are_held_without_blocking(self):
+        handled = []
+        stage = Stage('scoring', handled.append, 1, *self.metrics)
+        producer = threading.Thread(target=lambda: [stage.put(item) for item in range(5)])
+        producer.start()
+        producer.join(1)
+        self.assertFalse(producer.is_alive())
+        stage.start()
+        stage.put(5)
+        stage.stop()
+        self.assertEqual(handled, [0, 1, 2, 3, 4, 5])
+
+
+if __name__ == '__main__':
+    unittest.main()
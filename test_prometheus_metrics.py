@@ -0,0 +1,42 @@
+import socket
+import unittest
+import urllib.error
+import urllib.request
+from prometheus_metrics import Health, start_metrics_server
+
+
+class TestHealthEndpoints(unittest.TestCase):
+    def setUp(self):
+        with socket.socket() as probe:
+            probe.bind(('localhost', 0))
+            self.port = probe.getsockname()[1]
+        self.health = Health()
+        start_metrics_server(self.port, self.health)
+
+
+    def get(self, path):
+        try:
+            with urllib.request.urlopen(f'http://localhost:{self.port}{path}', timeout=5) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read()
+
+
+    def test_ready_once_warmed_up_and_live(self):
+        self.assertEqual(self.get('/live'), (200, b'ok'))
+        self.assertEqual(self.get('/ready'), (503, b'not ok'))
+        self.health.ready.set()
+        self.assertEqual(self.get('/ready'), (200, b'ok'))
+        alive = [True]
+        self.health.checks.append(lambda: alive[0])
+        alive[0] = False
+        self.assertEqual(self.get('/live')[0], 503)
+        self.assertEqual(self.get('/ready')[0], 503)
+        # the metrics are still served on the other paths
+        status, body = self.get('/metrics')
+        self.assertEqual(status, 200)
+        self.assertIn(b'python_info', body)
+
+
+if __name__ == '__main__':
+    unittest.main()
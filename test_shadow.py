@@ -0,0 +1,90 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+import numpy as np
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+from compiled_tree import load_compiled_tree
+from constants import DT_MODEL_PATH, MLP_MODEL_PATH
+from shadow import ShadowScorer
+
+
+class TestShadowScorer(unittest.TestCase):
+    def setUp(self):
+        """
+        Metrics in a registry of their own, and the predictions in a temporary
+        directory.
+        """
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.state_dir.name, 'shadow.db')
+        self.registry = CollectorRegistry()
+        self.metrics = [
+            Counter('shadow_predictions', '', ['model'], registry=self.registry),
+            Counter('shadow_disagreements', '', ['model', 'primary', 'challenger'], registry=self.registry),
+            Gauge('shadow_agreement_rate', '', ['model'], registry=self.registry),
+            Histogram('shadow_inference_seconds', '', ['model'], registry=self.registry),
+            Counter('shadow_dropped', '', registry=self.registry),
+            Counter('failures', '', registry=self.registry),
+        ]
+
+
+    def tearDown(self):
+        self.state_dir.cleanup()
+
+
+    def shadow(self, model_paths, **kwargs):
+        return ShadowScorer(model_paths, *self.metrics, path=self.path, **kwargs)
+
+
+    def test_challengers_score_the_same_features(self):
+        tree = load_compiled_tree(DT_MODEL_PATH)
+        rng = np.random.default_rng(3)
+        rows = np.column_stack([
+            rng.integers(20, 90, 200), rng.integers(0, 2, 200), rng.uniform(40, 300, (200, 5)),
+            rng.integers(0, 2, 200), rng.uniform(-50, 150, 200),
+        ])
+        shadow = self.shadow([DT_MODEL_PATH, MLP_MODEL_PATH], batch_size=16)
+        shadow.start()
+        for i, row in enumerate(rows):
+            self.assertTrue(shadow.submit(str(i), '20240601100000', row.tolist(), tree.predict_one(row)))
+        shadow.stop()
+
+        # the decision tree always agrees with itself
+        self.assertEqual(shadow.agreement()['dt_model'], 1.0)
+        sample = self.registry.get_sample_value
+        for model in ['dt_model', 'mlp_without_age_sex']:
+            self.assertEqual(sample('shadow_predictions_total', {'model': model}), 200)
+            # in batches of up to 16
+            self.assertGreaterEqual(sample('shadow_inference_seconds_count', {'model': model}), 13)
+        disagreements = sum(
+            sample('shadow_disagreements_total', {'model': 'mlp_without_age_sex', 'primary': primary, 'challenger': challenger}) or 0
+            for primary, challenger in [('y', 'n'), ('n', 'y')]
+        )
+        self.assertEqual(disagreements, round(200 * (1 - shadow.agreement()['mlp_without_age_sex'])))
+        with sqlite3.connect(self.path) as connection:
+            counts = dict(connection.execute('SELECT model, COUNT(*) FROM predictions GROUP BY model'))
+        self.assertEqual(counts, {'dt_model': 200, 'mlp_without_age_sex': 200})
+
+
+    def test_submit_drops_vectors_instead_of_waiting(self):
+        # not started, so nothing is taken off the queue
+        shadow = self.shadow([MLP_MODEL_PATH], queue_size=2)
+        self.assertTrue(shadow.submit('1', '20240601100000', [40, 1, 80, 0, 0, 0, 0, 0, 0], 'n'))
+        self.assertTrue(shadow.submit('2', '20240601100000', [40, 1, 80, 0, 0, 0, 0, 0, 0], 'n'))
+        self.assertFalse(shadow.submit('3', '20240601100000', [40, 1, 80, 0, 0, 0, 0, 0, 0], 'n'))
+        self.assertEqual(self.registry.get_sample_value('shadow_dropped_total'), 1)
+        shadow.stop()
+
+
+    def test_a_challenger_that_cannot_be_loaded_stops_shadow_scoring(self):
+        shadow = self.shadow([os.path.join(self.state_dir.name, 'missing.joblib')])
+        shadow.start()
+        shadow.submit('1', '20240601100000', [40, 1, 80, 0, 0, 0, 0, 0, 0], 'n')
+        shadow.stop()
+        self.assertTrue(shadow.broken)
+        self.assertEqual(self.registry.get_sample_value('failures_total'), 1)
+        self.assertFalse(shadow.submit('2', '20240601100000', [40, 1, 80, 0, 0, 0, 0, 0, 0], 'n'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import multiprocessing
+import threading
+import unittest
+from prometheus_client import CollectorRegistry, Counter
+from benchmarks.workload import generate_workload
+from hl7_parser import message_mrn, parse_message
+from sharding import Shard, ShardFeed, forward
+from utils import shard_of, read_history_csv, populate_test_results_table
+
+
+def echo_worker(index, count, connection, log):
+    """
+    Shard process acknowledging every message after putting it in its log.
+    """
+    feed = ShardFeed(connection)
+    try:
+        while True:
+            hl7_data = feed.read_message()
+            log.put((index, hl7_data))
+            feed.acknowledge()
+    except EOFError:
+        feed.close()
+
+
+def group_worker(index, count, connection, log):
+    """
+    Shard process acknowledging the messages it reads together at once.
+    """
+    feed = ShardFeed(connection)
+    try:
+        while True:
+            messages = feed.read_messages(window=0.05)
+            log.put((index, [hl7_data for hl7_data, _ in messages]))
+            feed.acknowledge(len(messages))
+    except EOFError:
+        feed.close()
+
+
+class FakeFeed:
+    def __init__(self, messages, stopping):
+        self.messages = list(messages)
+        self.stopping = stopping
+        self.acknowledged = 0
+
+    def read_messages(self):
+        if not self.messages:
+            self.stopping.set()
+            return []
+        # groups of a few messages, as received back to back
+        group, self.messages = self.messages[:5], self.messages[5:]
+        return [(message, None) for message in group]
+
+    def acknowledge(self, count=1):
+        self.acknowledged += count
+
+
+class FakeShard:
+    def __init__(self, calls=None):
+        self.messages = []
+        self.calls = [] if calls is None else calls
+
+    def submit(self, messages):
+        self.calls.append(('submit', self))
+        self.messages.extend(messages)
+
+    def collect(self, count):
+        self.calls.append(('collect', self))
+
+
+class TestSharding(unittest.TestCase):
+    def setUp(self):
+        _, self.stream, _ = generate_workload(patients=100, messages=600)
+
+
+    def test_message_mrn_matches_the_parser(self):
+        for message in self.stream:
+            self.assertEqual(message_mrn(message), parse_message(message)[1])
+
+
+    def test_messages_of_a_patient_go_to_one_shard_in_order(self):
+        stopping = threading.Event()
+        feed = FakeFeed(self.stream, stopping)
+        shards = [FakeShard() for _ in range(3)]
+        forward(feed, shards, stopping, Counter('failures', 'Failures', registry=CollectorRegistry()))
+        self.assertEqual(feed.acknowledged, len(self.stream))
+        for index, shard in enumerate(shards):
+            for message in shard.messages:
+                self.assertEqual(shard_of(message_mrn(message), 3), index)
+        for mrn in {message_mrn(message) for message in self.stream}:
+            shard = shards[shard_of(mrn, 3)]
+            self.assertEqual(
+                [message for message in shard.messages if message_mrn(message) == mrn],
+                [message for message in self.stream if message_mrn(message) == mrn],
+            )
+
+
+    def test_a_group_is_sent_to_every_shard_before_waiting_for_one(self):
+        stopping = threading.Event()
+        feed = FakeFeed(self.stream[:5], stopping)
+        calls = []
+        shards = [FakeShard(calls) for _ in range(3)]
+        forward(feed, shards, stopping, Counter('failures', 'Failures', registry=CollectorRegistry()))
+        self.assertEqual(feed.acknowledged, 5)
+        actions = [action for action, _ in calls]
+        self.assertEqual(actions, sorted(actions, reverse=True))
+        self.assertEqual(
+            [shard for action, shard in calls if action == 'submit'],
+            [shard for action, shard in calls if action == 'collect'],
+        )
+
+
+    def test_shard_process_acknowledges_each_message(self):
+        context = multiprocessing.get_context('spawn')
+        log = context.Queue()
+        shard = Shard(1, 2, echo_worker, (log,), context)
+        for message in self.stream[:20]:
+            shard.send(message)
+        self.assertEqual([log.get(timeout=10) for _ in range(20)], [(1, message) for message in self.stream[:20]])
+        shard.close()
+        shard.process.join(10)
+        self.assertEqual(shard.process.exitcode, 0)
+
+
+    def test_shard_process_acknowledges_a_group_at_once(self):
+        context = multiprocessing.get_context('spawn')
+        log = context.Queue()
+        shard = Shard(0, 1, group_worker, (log,), context)
+        shard.send_messages(self.stream[:20])
+        received = []
+        while len(received) < 20:
+            received += log.get(timeout=10)[1]
+        self.assertEqual(received, self.stream[:20])
+        shard.close()
+        shard.process.join(10)
+        self.assertEqual(shard.process.exitcode, 0)
+
+
+    def test_shards_split_the_history(self):
+        class RowsCollector:
+            def insert_test_results(self, rows):
+                self.rows = list(rows)
+                return len(self.rows)
+
+        rows = list(read_history_csv('data/history.csv'))
+        loaded = []
+        for index in range(3):
+            db = RowsCollector()
+            populate_test_results_table(db, 'data/history.csv', (index, 3))
+            self.assertTrue(all(shard_of(row[0], 3) == index for row in db.rows))
+            loaded += db.rows
+        self.assertEqual(sorted(loaded), sorted(rows))
+
+
+if __name__ == '__main__':
+    unittest.main()
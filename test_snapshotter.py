@@ -0,0 +1,62 @@
+import threading
+import time
+import unittest
+from prometheus_client import CollectorRegistry, Gauge, Summary
+from snapshotter import Snapshotter
+
+
+class TestSnapshotter(unittest.TestCase):
+    def setUp(self):
+        self.snapshots = []
+        self.taken = threading.Event()
+
+
+    def snapshot(self):
+        self.snapshots.append(time.monotonic())
+        self.taken.set()
+
+
+    def test_snapshot_after_enough_changes(self):
+        snapshotter = Snapshotter(self.snapshot, changes=3, interval=60)
+        snapshotter.start()
+        snapshotter.changed(2)
+        self.assertFalse(self.taken.wait(0.2))
+        snapshotter.changed()
+        self.assertTrue(self.taken.wait(5))
+        snapshotter.stop()
+        self.assertEqual(len(self.snapshots), 1)
+        self.assertEqual(snapshotter.staleness(), 0)
+
+
+    def test_snapshot_after_interval_and_metrics(self):
+        registry = CollectorRegistry()
+        duration = Summary('snapshot_duration_seconds', 'duration', registry=registry)
+        staleness = Gauge('snapshot_staleness_seconds', 'staleness', registry=registry)
+        snapshotter = Snapshotter(self.snapshot, changes=1000, interval=0.3)
+        snapshotter.export(duration, staleness)
+        snapshotter.start()
+        # nothing changed, nothing to snapshot
+        self.assertFalse(self.taken.wait(0.5))
+        self.assertEqual(registry.get_sample_value('snapshot_staleness_seconds'), 0)
+        snapshotter.changed()
+        time.sleep(0.1)
+        self.assertGreater(registry.get_sample_value('snapshot_staleness_seconds'), 0)
+        self.assertTrue(self.taken.wait(5))
+        snapshotter.stop()
+        self.assertEqual(registry.get_sample_value('snapshot_duration_seconds_count'), 1)
+
+
+    def test_failed_snapshot_keeps_changes_pending(self):
+        def fail():
+            raise OSError('disk full')
+
+        snapshotter = Snapshotter(fail, changes=1, interval=60)
+        snapshotter.changed()
+        with self.assertRaises(OSError):
+            snapshotter.take_snapshot()
+        self.assertTrue(snapshotter.is_due())
+        self.assertGreater(snapshotter.staleness(), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
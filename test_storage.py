@@ -0,0 +1,166 @@
+import tempfile
+import unittest
+from constants import STORAGE_BACKENDS
+from storage import Storage, open_database, storage_class
+from utils import shard_of
+
+
+class StorageConformance:
+    """
+    Behaviour every storage backend must have. Subclasses set `backend`.
+    """
+
+    backend = None
+
+    def setUp(self):
+        self.state_dir = tempfile.TemporaryDirectory()
+        self.db = self.open()
+
+
+    def tearDown(self):
+        self.db.close()
+        self.state_dir.cleanup()
+
+
+    def open(self, shard=None):
+        return open_database(self.backend, 'data/history.csv', 'journal', shard, self.state_dir.name)
+
+
+    def test_is_a_storage(self):
+        self.assertIsInstance(self.db, Storage)
+        self.assertTrue(self.db.database_loaded())
+        self.assertEqual(
+            self.db.get_test_result('822825', '2024-01-01 06:12:00'), ('822825', '2024-01-01 06:12:00', 68.58)
+        )
+
+
+    def test_admit_and_discharge(self):
+        self.db.insert_patient('0012352', 29, 'f')
+        # an admitted patient is not admitted again
+        self.db.insert_patient('0012352', 30, 'm')
+        self.assertEqual(self.db.get_patient('0012352'), ('0012352', 29, 'f'))
+        self.db.discharge_patient('0012352')
+        self.assertIsNone(self.db.get_patient('0012352'))
+        self.assertEqual(self.db.get_patient_history('0012352'), [])
+
+
+    def test_test_results(self):
+        self.db.insert_patient('0012352', 29, 'f')
+        self.db.insert_test_result('0012352', '20240924153600', 109.43)
+        self.db.insert_test_result('0012352', '20240924153600', 1.0)
+        inserted = self.db.insert_test_results(
+            [('0012352', '2024-01-01 06:12:00', 80.5), ('822825', '2024-01-01 06:12:00', 1.0)]
+        )
+        self.assertEqual(inserted, 1)
+        # LIMS dates come back as integers, history dates as text
+        self.assertEqual(self.db.get_test_result('0012352', '20240924153600'), ('0012352', 20240924153600, 109.43))
+        self.assertIsNone(self.db.get_test_result('0012352', '20240925153600'))
+        self.assertEqual(
+            sorted(self.db.get_test_results('0012352'), key=str),
+            [('0012352', '2024-01-01 06:12:00', 80.5), ('0012352', 20240924153600, 109.43)],
+        )
+        self.assertEqual(
+            sorted(self.db.get_patient_history('0012352'), key=str),
+            [('0012352', 29, 'f', '2024-01-01 06:12:00', 80.5), ('0012352', 29, 'f', 20240924153600, 109.43)],
+        )
+        self.assertEqual(len(self.db.get_feature_state('0012352')), 2)
+        self.db.insert_test_result('0012352', '20240925153600', 99.0)
+        self.assertEqual(len(self.db.get_feature_state('0012352')), 3)
+
+
+    def test_patient_features(self):
+        record = ('31251122', 42, 'm', 142.22, 127.45, 1.12, 156.89, 0.91, False, 0, None)
+        self.db.insert_patient_features(*record)
+        self.assertEqual(self.db.get_patient_features('31251122'), record)
+        self.db.update_patient_features('31251122', RV1=114.98, aki='y')
+        self.assertEqual(
+            self.db.get_patient_features('31251122'),
+            ('31251122', 42, 'm', 142.22, 114.98, 1.12, 156.89, 0.91, False, 0, 'y'),
+        )
+        self.assertIsNone(self.db.get_patient_features('0012352'))
+
+
+    def test_features_of_a_new_patient_are_stored(self):
+        # the features row is updated, even for a patient who has none yet
+        self.db.update_patient_features('31251122', age=42, sex='m', C1=142.22, has_changed_48h=0, aki='n')
+        expected = ('31251122', 42, 'm', 142.22, None, None, None, None, 0, None, 'n')
+        self.assertEqual(self.db.get_patient_features('31251122'), expected)
+        self.db.close()
+        self.db = self.open()
+        self.assertEqual(self.db.get_patient_features('31251122'), expected)
+
+
+    def test_features_are_stored_with_the_test_result(self):
+        self.db.insert_patient('0012352', 29, 'f')
+        features = dict(age=29, sex='f', C1=109.43, has_changed_48h=0, aki='n')
+        self.db.insert_test_result('0012352', '20240924153600', 109.43, features)
+        expected = ('0012352', 29, 'f', 109.43, None, None, None, None, 0, None, 'n')
+        self.assertEqual(self.db.get_patient_features('0012352'), expected)
+        # a result already stored leaves the row as it is
+        self.db.insert_test_result('0012352', '20240924153600', 1.0, dict(features, aki='y'))
+        self.assertEqual(self.db.get_patient_features('0012352'), expected)
+        self.assertEqual(len(self.db.get_feature_state('0012352')), 1)
+
+
+    def test_persisted_changes_survive_a_crash(self):
+        self.db.insert_patient('0012352', 29, 'f')
+        self.db.insert_patient('65289', 56, 'f')
+        self.db.insert_test_result('0012352', '20240924153600', 109.43)
+        self.db.discharge_patient('65289')
+        self.db.persist_db()
+        # the crashed store is never closed
+        self.db = self.open()
+        self.assertEqual(self.db.get_patient('0012352'), ('0012352', 29, 'f'))
+        self.assertIsNone(self.db.get_patient('65289'))
+        self.assertEqual(self.db.get_test_result('0012352', '20240924153600'), ('0012352', 20240924153600, 109.43))
+
+
+    def test_closed_store_is_reopened(self):
+        self.db.insert_patient('0012352', 29, 'f')
+        self.db.insert_test_result('0012352', '20240924153600', 109.43)
+        self.db.snapshot()
+        self.db.insert_test_result('0012352', '20240925153600', 99.0)
+        expected = sorted(self.db.get_test_results('822825'), key=str)
+        self.db.close()
+        self.db = self.open()
+        self.assertEqual(self.db.get_patient('0012352'), ('0012352', 29, 'f'))
+        self.assertEqual(len(self.db.get_test_results('0012352')), 2)
+        self.assertEqual(sorted(self.db.get_test_results('822825'), key=str), expected)
+
+
+    def test_shard_only_loads_its_patients(self):
+        mrns = ['822825', '65289', '522854', '100199']
+        with tempfile.TemporaryDirectory() as state_dir:
+            db = open_database(self.backend, 'data/history.csv', 'journal', (1, 2), state_dir)
+            for mrn in mrns:
+                self.assertEqual(bool(db.get_test_results(mrn)), shard_of(mrn, 2) == 1)
+            db.close()
+
+
+class TestSQLiteStorage(StorageConformance, unittest.TestCase):
+    backend = 'sqlite'
+
+
+class TestColumnarStorage(StorageConformance, unittest.TestCase):
+    backend = 'columnar'
+
+
+class TestBackends(unittest.TestCase):
+    def test_every_backend_is_tested(self):
+        tested = {case.backend for case in StorageConformance.__subclasses__()}
+        self.assertEqual(tested, set(STORAGE_BACKENDS))
+
+
+    def test_storage_class_is_the_class_opened(self):
+        for backend in STORAGE_BACKENDS:
+            with tempfile.TemporaryDirectory() as state_dir:
+                db = open_database(backend, 'data/history.csv', 'journal', None, state_dir)
+                self.assertIs(type(db), storage_class(backend))
+                db.close()
+        # the columnar store has no stored summaries to compact or rebuild
+        self.assertFalse(storage_class('columnar').stores_summaries)
+        self.assertTrue(storage_class('sqlite').stores_summaries)
+
+
+if __name__ == '__main__':
+    unittest.main()
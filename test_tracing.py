@@ -0,0 +1,59 @@
+import time
+import unittest
+from unittest.mock import patch
+from prometheus_client import CollectorRegistry, Histogram
+from tracing import Trace, Tracer
+
+
+class TestTracer(unittest.TestCase):
+    def setUp(self):
+        self.registry = CollectorRegistry()
+        self.steps = Histogram(
+            'message_step_seconds', 'steps', ['step', 'message_type'], registry=self.registry
+        )
+        self.messages = Histogram(
+            'request_processing_seconds', 'messages', ['message_type'], registry=self.registry
+        )
+
+
+    def sample(self, name, **labels):
+        return self.registry.get_sample_value(name, labels)
+
+
+    def test_steps_are_observed_by_message_type(self):
+        tracer = Tracer(self.steps, self.messages, sample_rate=0)
+        trace = Trace()
+        trace.add('read', 0.002)
+        with trace.step('parse'):
+            pass
+        total = tracer.finish(trace, 'LIMS', '822825')
+        self.assertGreater(total, 0)
+        self.assertEqual(self.sample('message_step_seconds_count', step='read', message_type='LIMS'), 1)
+        self.assertEqual(self.sample('message_step_seconds_sum', step='read', message_type='LIMS'), 0.002)
+        self.assertEqual(self.sample('message_step_seconds_count', step='parse', message_type='LIMS'), 1)
+        self.assertEqual(self.sample('request_processing_seconds_count', message_type='LIMS'), 1)
+        self.assertIsNone(self.sample('request_processing_seconds_count', message_type='PAS-admit'))
+
+
+    def test_slow_sampled_messages_are_dumped(self):
+        tracer = Tracer(self.steps, self.messages, sample_rate=1.0, slow_seconds=0.01)
+        fast = Trace()
+        slow = Trace(time.perf_counter() - 0.5)
+        slow.add('lookup', 0.3)
+        with self.assertLogs('tracing', level='WARNING') as logged:
+            tracer.finish(fast, 'LIMS', '1')
+            tracer.finish(slow, 'LIMS', '822825')
+        self.assertEqual(len(logged.records), 1)
+        dump = logged.records[0].getMessage()
+        self.assertIn('822825', dump)
+        self.assertIn('lookup=300.0ms', dump)
+        self.assertIn('waiting=', dump)
+        # turned off, nothing is dumped
+        tracer.sample_rate = 0
+        with patch('tracing.logger') as logger:
+            tracer.finish(Trace(time.perf_counter() - 0.5), 'LIMS', '822825')
+        logger.warning.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
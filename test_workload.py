@@ -0,0 +1,51 @@
+import os
+import tempfile
+import unittest
+from benchmarks.workload import generate_workload, write_history_csv
+from hl7_parser import parse_message
+from utils import read_history_csv
+
+
+class TestWorkload(unittest.TestCase):
+    def test_same_seed_gives_the_same_workload(self):
+        self.assertEqual(generate_workload(seed=3, messages=500), generate_workload(seed=3, messages=500))
+        self.assertNotEqual(generate_workload(seed=3, messages=500), generate_workload(seed=4, messages=500))
+
+
+    def test_stream_is_consistent(self):
+        history, stream, labels = generate_workload(
+            patients=50, messages=2000, aki_prevalence=0.5, interval='lognormal'
+        )
+        self.assertEqual(len(stream), 2000)
+        admitted = set()
+        last_date = ''
+        lims = set()
+        for message in stream:
+            category, mrn, data = parse_message(message)
+            if category == 'PAS-admit':
+                admitted.add(mrn)
+            elif category == 'PAS-discharge':
+                admitted.remove(mrn)
+            else:
+                # results come in date order, for admitted patients
+                self.assertIn(mrn, admitted)
+                self.assertGreaterEqual(data[0], last_date)
+                last_date = data[0]
+                lims.add((mrn, data[0]))
+        self.assertTrue(labels)
+        self.assertTrue(set(labels) <= lims)
+
+
+    def test_history_is_written_in_the_wide_layout(self):
+        history, _, _ = generate_workload(patients=50, messages=10)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'history.csv')
+            write_history_csv(path, history)
+            rows = list(read_history_csv(path))
+        self.assertEqual(len(rows), sum(len(results) for results in history.values()))
+        mrn, date, result = rows[0]
+        self.assertEqual((date, result), (history[mrn][0][0].strftime('%Y-%m-%d %H:%M:%S'), history[mrn][0][1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
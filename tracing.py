@@ -0,0 +1,98 @@
+import logging
+import random
+import time
+from contextlib import contextmanager
+from constants import TRACE_SAMPLE_RATE, TRACE_SLOW_SECONDS
+from prometheus_metrics import observe_step_latency, observe_message_latency
+
+logger = logging.getLogger(__name__)
+
+
+class Trace:
+    """
+    The time spent in each step of handling one message, from its frame starting
+    to arrive to it being scored. The steps are observed once the message type is
+    known, when the tracer finishes the trace.
+    """
+
+    __slots__ = ("started", "steps")
+
+    def __init__(self, started=None):
+        self.started = time.perf_counter() if started is None else started
+        self.steps = []
+
+    def add(self, step, seconds):
+        self.steps.append((step, seconds))
+
+    @contextmanager
+    def step(self, name):
+        """
+        Time the body of the `with` block as the step `name`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.steps.append((name, time.perf_counter() - start))
+
+
+class Tracer:
+    """
+    Observes the steps of every message in the `step_histogram` and its whole
+    handling time in the `message_histogram`, both labelled by message type. A
+    `sample_rate` share of the messages are also checked against `slow_seconds`,
+    and the slow ones have their breakdown logged as a warning.
+    """
+
+    def __init__(
+        self,
+        step_histogram,
+        message_histogram,
+        sample_rate=TRACE_SAMPLE_RATE,
+        slow_seconds=TRACE_SLOW_SECONDS,
+    ):
+        self.step_histogram = step_histogram
+        self.message_histogram = message_histogram
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.random = random.Random()
+
+    def finish(self, trace, message_type, description=""):
+        """
+        Observe a trace once its message has been handled.
+        Args:
+            - trace {Trace}: the trace of the message
+            - message_type {str}: the message category, e.g. "LIMS"
+            - description {str}: what identifies the message in a slow message dump
+        Returns:
+            - total {float}: the seconds from the frame arriving to now
+        """
+        total = time.perf_counter() - trace.started
+        for step, seconds in trace.steps:
+            observe_step_latency(self.step_histogram, step, message_type, seconds)
+        observe_message_latency(self.message_histogram, message_type, total)
+        if (
+            self.sample_rate > 0
+            and total >= self.slow_seconds
+            and self.random.random() < self.sample_rate
+        ):
+            logger.warning(self.breakdown(trace, message_type, description, total))
+        return total
+
+    @staticmethod
+    def breakdown(trace, message_type, description, total):
+        """
+        One line with the time spent in each step, steps taken more than once
+        added up, and in between them as "waiting", mostly for the scoring stage.
+        """
+        steps = {}
+        for step, seconds in trace.steps:
+            steps[step] = steps.get(step, 0.0) + seconds
+        waiting = total - sum(steps.values())
+        breakdown = " ".join(
+            f"{step}={seconds * 1000:.1f}ms" for step, seconds in steps.items()
+        )
+        return (
+            f"Slow {message_type} message {description} took {total * 1000:.1f}ms: "
+            f"{breakdown} waiting={waiting * 1000:.1f}ms"
+        )
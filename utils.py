@@ -2,8 +2,11 @@ import hl7
 import pandas as pd
 import numpy as np
 import datetime
+import calendar
+import zlib
 import joblib
 import csv
+import logging
 import sys
 from statistics import median
 from constants import (
@@ -11,14 +14,19 @@ from constants import (
     MLLP_END_CHAR,
     REVERSE_LABELS_MAP,
     MLLP_END_OF_BLOCK,
-    ON_DISK_PAGER_STACK_PATH,
+    MLLP_BUFFER_SIZE,
+    LIMS_DATE_FORMAT,
+    HISTORY_DATE_FORMAT,
 )
-import requests
+from prometheus_metrics import increment_failure_counter
+import select
 import sys
 import time
 import socket
 import pickle
 
+logger = logging.getLogger(__name__)
+
 
 def process_mllp_message(data):
     """
@@ -40,13 +48,26 @@ def parse_hl7_message(hl7_data):
     return message
 
 
+# The framed ACK the simulator expects is the same for every message but for its
+# timestamp, to the second
+ACK_PREFIX = MLLP_START_CHAR + b"MSH|^~\\&|||||"
+ACK_SUFFIX = b"||ACK||P|2.5\rMSA|AA|\r" + MLLP_END_CHAR
+# the second and the framed ACK last built, swapped together
+last_acknowledgement = (None, None)
+
+
 def create_acknowledgement():
     """
-    Creates an HL7 ACK message for the received message.
+    Creates an HL7 ACK message for the received message. It is only built again
+    once the second of its timestamp has changed.
     """
-    # Construct the ACK message based on the simulator's expectations
-    ack_msg = f"MSH|^~\\&|||||{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}||ACK||P|2.5\rMSA|AA|\r"
-    framed_ack = MLLP_START_CHAR + ack_msg.encode() + MLLP_END_CHAR
+    global last_acknowledgement
+    second = int(time.time())
+    built_second, framed_ack = last_acknowledgement
+    if second != built_second:
+        timestamp = time.strftime("%Y%m%d%H%M%S", time.localtime(second))
+        framed_ack = ACK_PREFIX + timestamp.encode() + ACK_SUFFIX
+        last_acknowledgement = (second, framed_ack)
     return framed_ack
 
 
@@ -97,30 +118,64 @@ def predict_with_mlp(mlp_model, data):
     return labels
 
 
-def populate_test_results_table(db, path):
+def read_history_csv(path):
     """
-    Reads in the patient test result history and populates the table.
+    Streams the (mrn, date, result) triples out of the wide history file, one row
+    of the file at a time.
     Args:
-        - db {InMemoryDatabase}: the database object
         - path {str}: path to the data
     """
     with open(path, newline="") as f:
         rows = csv.reader(f)
-        for i, row in enumerate(rows):
-            # skip header
-            if i == 0:
-                continue
-
+        # skip header
+        next(rows, None)
+        for row in rows:
             # remove empty strings
             while row and row[-1] == "":
                 row.pop()
 
             mrn = row[0]
-            # for each date, result pair insert into the table
+            # for each date, result pair yield a test result
             for j in range(1, len(row), 2):
-                date = row[j]
-                result = float(row[j + 1])
-                db.insert_test_result(mrn, date, result)
+                yield mrn, row[j], float(row[j + 1])
+
+
+def shard_of(mrn, shards):
+    """
+    Index of the shard owning a patient, stable across processes and restarts.
+    Args:
+        - mrn {str}: the patient's MRN
+        - shards {int}: the number of shards
+    """
+    return zlib.crc32(str(mrn).encode()) % shards
+
+
+def populate_test_results_table(db, path, shard=None):
+    """
+    Reads in the patient test result history and bulk loads it into the table in a
+    single transaction.
+    Args:
+        - db {InMemoryDatabase}: the database object
+        - path {str}: path to the data
+        - shard {tuple}: (index, count) to only load the patients of one shard
+    Returns:
+        - inserted {int}: the number of test results inserted
+    """
+    start_time = time.perf_counter()
+    rows = read_history_csv(path)
+    if shard is not None:
+        index, count = shard
+        rows = (row for row in rows if shard_of(row[0], count) == index)
+    inserted = db.insert_test_results(rows)
+    elapsed = max(time.perf_counter() - start_time, 1e-9)
+    logger.info(
+        "Loaded %d test results from %s in %.2fs (%.0f rows/s)",
+        inserted,
+        path,
+        elapsed,
+        inserted / elapsed,
+    )
+    return inserted
 
 
 def populate_patients_table(db, path):
@@ -206,6 +261,79 @@ def calculate_age(date_of_birth):
     return age
 
 
+EPOCH = datetime.datetime(1970, 1, 1)
+ONE_SECOND = datetime.timedelta(seconds=1)
+
+
+def to_epoch_seconds(date):
+    """
+    Converts a creatinine result date to seconds since the epoch. Dates from
+    history.csv are "%Y-%m-%d %H:%M:%S" strings (fractions of a second are
+    dropped), dates from LIMS are "%Y%m%d%H%M%S" strings, which SQLite hands
+    back as integers. The usual 14 digit LIMS dates are sliced rather than
+    parsed with strptime, which is several times slower.
+
+    Args:
+    - date (str or int): The date of the creatinine result.
+
+    Returns:
+    - int: The date in seconds since the epoch.
+    """
+    if is_lims_date(date):
+        date = str(date)
+        if len(date) == 14:
+            parsed = datetime.datetime(
+                int(date[0:4]),
+                int(date[4:6]),
+                int(date[6:8]),
+                int(date[8:10]),
+                int(date[10:12]),
+                int(date[12:14]),
+            )
+        else:
+            parsed = datetime.datetime.strptime(date, LIMS_DATE_FORMAT)
+    else:
+        parsed = datetime.datetime.fromisoformat(date)
+    return (parsed - EPOCH) // ONE_SECOND
+
+
+def is_lims_date(date):
+    """
+    Whether a creatinine result date is in the LIMS "%Y%m%d%H%M%S" format, i.e. one
+    that SQLite stores as an integer.
+    """
+    return type(date) == int or date.isdigit()
+
+
+def encode_date(date):
+    """
+    Split a creatinine result date into the integers it is stored as.
+
+    Args:
+    - date (str or int): The date of the creatinine result.
+
+    Returns:
+    - (time, lims) (tuple): seconds since the epoch, and 1 for a LIMS date or 0
+      for a history.csv one.
+    """
+    return to_epoch_seconds(date), int(is_lims_date(date))
+
+
+def decode_date(time_, lims):
+    """
+    The date as SQLite used to store it, before dates were stored as integers:
+    an integer for LIMS dates, text for history.csv dates.
+
+    Args:
+    - time_ (int): The date in seconds since the epoch.
+    - lims (int): Whether it is a LIMS date.
+    """
+    moment = time.gmtime(int(time_))
+    if lims:
+        return int(time.strftime(LIMS_DATE_FORMAT, moment))
+    return time.strftime(HISTORY_DATE_FORMAT, moment)
+
+
 def D_value_compute(creat_latest_result, d1, lis):
     """
     Computes the D value, a measure based on the difference creatinine result values.
@@ -298,76 +426,6 @@ def label_encode(sex):
         return 1
 
 
-def send_pager_request(mrn, latest_creatine_date, pager_address, pager_stack):
-    """
-    Sends pager requests for a given MRN and attempts to send additional requests from a stack until a failure occurs or all are sent.
-
-    Args:
-    - mrn (str): The mrn to send.
-    - latest_creatine_date (str): The latest date of creatine measurement associated with the MRN.
-    - pager_address (str): The pager service address
-    - pager_stack (list of tuples): A stack (list) of MRNs and their associated creatine dates to send.
-
-    Returns:
-    - pager_stack (list of tuples): Updated pager stack with any requests that failed to send.
-
-    Note:
-    - This function uses an exponential backoff strategy for retries upon failed requests.
-    """
-    print("Sending a page for mrn:", mrn)
-    # Define the URL for the pager request.
-    pager_host, pager_port = strip_url(pager_address)
-    print("Pager host and port: ", pager_host, pager_port)
-
-    url = f"http://{pager_host}:{pager_port}/page"
-    headers = {"Content-Type": "text/plain"}
-
-    def attempt_send_request(mrn, latest_creatine_date):
-        # Convert the MRN to a string and encode it to bytes, as the body of the POST request.
-        data = str(mrn) + "," + str(latest_creatine_date)
-        data = data.encode("utf-8")
-        retry_delay = 0.4  # 0.4 second retry delay so we meet latency
-        retries = 0
-        max_retries = 3
-        is_success = False
-        while retries < max_retries:
-            # Send the POST request with the MRN as the body.
-            response = requests.post(url, data=data, headers=headers)
-
-            # Check the response status code and print appropriate message.
-            if response.status_code == 200:
-                print(f"Request successful, server responded: {response.text}")
-                is_success = True
-                break
-            else:
-                print(
-                    f"Attempt {retries + 1}: Request failed, status code: {response.status_code}, message: {response.text}"
-                )
-                retries += 1
-                print("Retrying in", retry_delay, "seconds...")
-                retry_delay = retry_delay * retries
-                time.sleep(retry_delay)
-        return is_success
-
-    # First try to send the current MRN
-    print("Sending current MRN: ", mrn)
-    if attempt_send_request(mrn, latest_creatine_date):
-        # If successful, attempt to send all requests in the stack
-        print("Trying to send remaining pages...")
-        while len(pager_stack) != 0:
-            next_mrn, creatine_date = pager_stack.pop()
-            if not attempt_send_request(next_mrn, creatine_date):
-                # If a request fails, stop and re-append remaining requests including the failed one
-                pager_stack.append(next_mrn, creatine_date)  # Re-add the failed MRN
-                break
-    else:
-        # If initial request fails, append it to the stack
-        pager_stack.append((mrn, latest_creatine_date))
-    if len(pager_stack) != 0:
-        print("Current pager stack:", pager_stack)
-    return pager_stack
-
-
 def load_model(file_path):
     """
     Loads a machine learning model from a pickle file.
@@ -384,10 +442,10 @@ def load_model(file_path):
                 model = pickle.load(file)
         return model
     except FileNotFoundError:
-        print("File not found.")
+        logger.error("File not found.")
         return None
     except Exception as e:
-        print(f"An error occurred: {e}")
+        logger.error("An error occurred: %s", e)
         return None
 
 
@@ -395,7 +453,7 @@ def strip_url(url):
     """
     Strips the URL and returns the host and port alone.
     """
-    print("Parsing URL:", url)
+    logger.debug("Parsing URL: %s", url)
     url = url.split("://")[-1]
 
     # Split the URL by "/" to separate the host and potentially the port
@@ -412,33 +470,6 @@ def strip_url(url):
     return host, port
 
 
-def define_graceful_shutdown(db, current_socket, pager_stack):
-    """
-    Returns a function to gracefully shutdown the application. It is a wrapper as the signal library expects only signum and frame as the arguemnts and this way we can persisting the database, close the socket, and save the pager stack.
-
-    Args:
-    - db: Database object with `persist_db` and `close` methods.
-    - current_socket: Dictionary containing the socket object under "sock" key.
-    - pager_stack: Data structure to be saved on disk.
-
-    Returns:
-    - A signal handler function for graceful shutdown.
-    """
-
-    def graceful_shutdown(signum, frame):
-        print("Graceful shutdown procedure started.")
-        db.persist_db()
-        db.close()
-        print("Database persisted.")
-        current_socket["sock"].close()
-        print("MLLP connection closed.")
-        with open(ON_DISK_PAGER_STACK_PATH, "wb") as file:
-            pickle.dump(pager_stack, file)
-        sys.exit(0)
-
-    return graceful_shutdown
-
-
 def exponential_backoff_retry(func):
     """
     Wraps a function to automatically retry with exponential backoff upon failure.
@@ -462,8 +493,11 @@ def exponential_backoff_retry(func):
             except Exception as e:
                 wait_time = base_delay * (2**attempt)  # Exponential backoff
                 attempt += 1
-                print(
-                    f"Attempt {attempt}, failed. Error: {e}; retrying in {wait_time} seconds..."
+                logger.warning(
+                    "Attempt %d, failed. Error: %s; retrying in %s seconds...",
+                    attempt,
+                    e,
+                    wait_time,
                 )
                 wait_time = min(
                     threshold, wait_time
@@ -492,7 +526,7 @@ def connect_to_mllp(host, port):
     """
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.connect((host, int(port)))
-    print(f"Connected to MLLP on {host}:{port}")
+    logger.info("Connected to MLLP on %s:%s", host, port)
     return sock
 
 
@@ -513,9 +547,161 @@ def read_from_mllp(sock):
             buffer += data
         return buffer, False
     except ConnectionResetError as e:
-        print("Connection was reset, reconnecting...")
+        logger.warning("Connection was reset, reconnecting...")
         sock.close()
         return None, True
     except Exception as e:
-        print(f"Failed to read an MLLP message; error: {e}")
+        logger.warning("Failed to read an MLLP message; error: %s", e)
         return None, False
+
+
+class MLLPReader:
+    """
+    Reads MLLP frames from a socket one at a time. Data is received straight into a
+    reusable buffer with `recv_into`, bytes of the next frame that arrive with the
+    current one are kept for the next call, and frames split across reads (as sent
+    by the simulator's --short_messages mode) are put back together without
+    re-copying what was already received. Errors ending a group of messages are
+    counted by `failure_counter`, if given.
+    """
+
+    def __init__(self, sock, buffer_size=MLLP_BUFFER_SIZE, failure_counter=None):
+        self.sock = sock
+        self.failure_counter = failure_counter
+        self.buffer = bytearray(buffer_size)
+        # received but not yet returned bytes are buffer[start:end]
+        self.start = 0
+        self.end = 0
+        # where to resume looking for the end of the current frame
+        self.scanned = 0
+        # perf_counter time the first bytes of the current frame were received at,
+        # and of the frame of the last message returned
+        self.frame_started = None
+        self.message_started = None
+
+    def next_frame(self):
+        """
+        Returns the HL7 message of the next complete frame in the buffer, without
+        the MLLP framing, or None if there is no complete frame yet. A frame
+        without a start block is dropped and returned as an empty message.
+        """
+        end_index = self.buffer.find(
+            MLLP_END_CHAR, max(self.start, self.scanned), self.end
+        )
+        if end_index == -1:
+            # the two byte end marker may be split across reads
+            self.scanned = max(self.start, self.end - len(MLLP_END_CHAR) + 1)
+            return None
+        start_index = self.buffer.find(MLLP_START_CHAR, self.start, end_index)
+        with memoryview(self.buffer) as view:
+            message = bytes(view[start_index + 1 : end_index]) if start_index != -1 else b""
+        self.start = end_index + len(MLLP_END_CHAR)
+        if self.start == self.end:
+            self.start = self.end = 0
+        else:
+            # the next frame has started arriving already
+            self.frame_started = time.perf_counter()
+        self.scanned = self.start
+        return message
+
+    def receive(self):
+        """
+        Receive more data into the free end of the buffer, moving the unread bytes
+        to the front or growing the buffer when it is full.
+        """
+        if self.end == len(self.buffer):
+            unread = self.end - self.start
+            if self.start > 0:
+                self.buffer[:unread] = self.buffer[self.start : self.end]
+                self.scanned -= self.start
+                self.start, self.end = 0, unread
+            if self.end == len(self.buffer):
+                self.buffer.extend(bytes(len(self.buffer)))
+        frame_starts = self.start == self.end
+        with memoryview(self.buffer) as view:
+            received = self.sock.recv_into(view[self.end :])
+        if received == 0:
+            raise ConnectionResetError("Connection closed by the MLLP server")
+        if frame_starts:
+            self.frame_started = time.perf_counter()
+        self.end += received
+
+    def read_message(self):
+        """
+        Reads the next HL7 message from the MLLP connection. If the connection is
+        reset during reading, the socket is closed and a reconnection is requested.
+
+        Returns:
+        - A tuple containing the HL7 message (without framing) and a boolean flag.
+          The flag is True if the connection was reset and needs reconnection, False
+          otherwise. If an error occurs, returns None for the message and the
+          appropriate flag.
+        """
+        try:
+            started = self.frame_started
+            message = self.next_frame()
+            while message is None:
+                self.receive()
+                started = self.frame_started
+                message = self.next_frame()
+            self.message_started = started
+            return message, False
+        except ConnectionResetError as e:
+            logger.warning("Connection was reset, reconnecting...")
+            self.sock.close()
+            return None, True
+        except Exception as e:
+            logger.warning("Failed to read an MLLP message; error: %s", e)
+            return None, False
+
+    def poll(self, timeout):
+        """
+        Returns whether a complete frame is buffered, or data arrives within
+        `timeout` seconds. With only part of a frame buffered a read would wait
+        for the sender, so the socket decides.
+        """
+        if (
+            self.buffer.find(MLLP_END_CHAR, max(self.start, self.scanned), self.end)
+            != -1
+        ):
+            return True
+        return bool(select.select([self.sock], [], [], timeout)[0])
+
+    def read_messages(self, max_count, window=0.0):
+        """
+        Reads the next HL7 message, then the ones after it that were received
+        already or arrive within `window` seconds, up to `max_count` messages, so
+        they can be made durable and acknowledged together.
+
+        Returns:
+        - A list of (message, frame_started) tuples, empty if nothing valid was
+          received, and the reconnection flag of `read_message`. An error after
+          the first message ends the list, it is raised again by the next read.
+        """
+        message, need_to_reconnect = self.read_message()
+        if message is None:
+            return [], need_to_reconnect
+        messages = [(message, self.message_started)]
+        deadline = time.perf_counter() + window
+        try:
+            while len(messages) < max_count:
+                started = self.frame_started
+                message = self.next_frame()
+                if message is not None:
+                    messages.append((message, started))
+                    continue
+                timeout = max(deadline - time.perf_counter(), 0)
+                if not select.select([self.sock], [], [], timeout)[0]:
+                    break
+                self.receive()
+        except (OSError, ValueError) as error:
+            # the connection failed or was closed: the messages read so far are
+            # returned, and the next read runs into the error again
+            logger.warning(
+                "Stopped reading a group after %d messages; error: %s",
+                len(messages),
+                error,
+            )
+            if self.failure_counter is not None:
+                increment_failure_counter(self.failure_counter)
+        return messages, False
@@ -1,3 +1,4 @@
+import socket
 import unittest
 from utils import (
     process_mllp_message,
@@ -8,14 +9,41 @@ from utils import (
     parse_system_message,
     strip_url,
     read_from_mllp,
+    MLLPReader,
 )
 from memory_db import InMemoryDatabase
 import hl7
 from constants import MLLP_END_OF_BLOCK
 from unittest.mock import patch
+from prometheus_client import CollectorRegistry, Counter
 from datetime import datetime
 
 
+class FakeSocket:
+    """
+    Socket returning the given chunks from recv_into, then end of stream.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+        self.reads = 0
+        self.closed = False
+
+    def recv_into(self, buffer):
+        self.reads += 1
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        size = min(len(chunk), len(buffer))
+        buffer[:size] = chunk[:size]
+        if size < len(chunk):
+            self.chunks.insert(0, chunk[size:])
+        return size
+
+    def close(self):
+        self.closed = True
+
+
 class TestUtilsClient(unittest.TestCase):
     def test_process_mllp_message(self):
         """
@@ -139,6 +167,87 @@ class TestUtilsClient(unittest.TestCase):
         self.assertIsNone(result)
         self.assertFalse(needs_reconnection)
 
+    def test_mllp_reader_keeps_bytes_of_the_next_frame(self):
+        # two frames and the start of a third arrive in one read
+        sock = FakeSocket(
+            [b"\x0bMSH|first\x1c\x0d\x0bMSH|second\x1c\x0d\x0bMSH|th", b"ird\x1c\x0d"]
+        )
+        reader = MLLPReader(sock)
+        self.assertEqual(reader.read_message(), (b"MSH|first", False))
+        self.assertEqual(reader.read_message(), (b"MSH|second", False))
+        self.assertEqual(reader.read_message(), (b"MSH|third", False))
+        self.assertEqual(sock.reads, 2)
+
+    def test_mllp_reader_joins_split_frames(self):
+        # the end marker itself is split across reads, as with --short_messages
+        sock = FakeSocket([b"\x0bMSH|first", b"\x1c", b"\x0d\x0bMSH|se", b"cond\x1c\x0d"])
+        reader = MLLPReader(sock, buffer_size=8)
+        self.assertEqual(reader.read_message(), (b"MSH|first", False))
+        self.assertEqual(reader.read_message(), (b"MSH|second", False))
+
+    def test_mllp_reader_grows_buffer_for_large_messages(self):
+        message = b"MSH|" + b"x" * 10000
+        frame = b"\x0b" + message + b"\x1c\x0d"
+        sock = FakeSocket([frame[i : i + 1000] for i in range(0, len(frame), 1000)])
+        reader = MLLPReader(sock, buffer_size=64)
+        self.assertEqual(reader.read_message(), (message, False))
+
+    def test_mllp_reader_requests_reconnection_when_closed(self):
+        sock = FakeSocket([b"\x0bMSH|partial"])
+        reader = MLLPReader(sock)
+        self.assertEqual(reader.read_message(), (None, True))
+        self.assertTrue(sock.closed)
+
+    def test_mllp_reader_groups_messages_received_back_to_back(self):
+        upstream, sock = socket.socketpair()
+        with upstream, sock:
+            upstream.sendall(b"\x0bMSH|first\x1c\x0d\x0bMSH|second\x1c\x0d\x0bMSH|th")
+            reader = MLLPReader(sock)
+            messages, need_to_reconnect = reader.read_messages(64)
+            self.assertFalse(need_to_reconnect)
+            self.assertEqual([message for message, _ in messages], [b"MSH|first", b"MSH|second"])
+            self.assertTrue(all(started is not None for _, started in messages))
+            # a message completed within the window joins the group
+            upstream.sendall(b"ird\x1c\x0d\x0bMSH|fourth\x1c\x0d\x0bMSH|fifth\x1c\x0d")
+            messages, _ = reader.read_messages(2, window=0.5)
+            self.assertEqual([message for message, _ in messages], [b"MSH|third", b"MSH|fourth"])
+            messages, _ = reader.read_messages(64)
+            self.assertEqual([message for message, _ in messages], [b"MSH|fifth"])
+
+    def test_mllp_reader_polls_ready_only_for_a_complete_frame(self):
+        upstream, sock = socket.socketpair()
+        with upstream, sock:
+            upstream.sendall(b"\x0bMSH|first\x1c\x0d\x0bMSH|se")
+            reader = MLLPReader(sock)
+            self.assertEqual(reader.read_message(), (b"MSH|first", False))
+            # only part of the next frame is buffered, and nothing is on the socket
+            self.assertFalse(reader.poll(0.05))
+            upstream.sendall(b"cond\x1c\x0d")
+            self.assertTrue(reader.poll(0.5))
+            self.assertEqual(reader.read_message(), (b"MSH|second", False))
+
+    def test_mllp_reader_counts_an_error_ending_a_group(self):
+        failures = Counter("failures", "Failures", registry=CollectorRegistry())
+        sock = FakeSocket([b"\x0bMSH|first\x1c\x0d\x0bMSH|se"])
+        reader = MLLPReader(sock, failure_counter=failures)
+        with patch("utils.select.select", return_value=([sock], [], [])):
+            messages, need_to_reconnect = reader.read_messages(64, window=0.5)
+        self.assertEqual([message for message, _ in messages], [b"MSH|first"])
+        self.assertFalse(need_to_reconnect)
+        self.assertEqual(failures._value.get(), 1)
+        # the next read runs into the closed connection again
+        self.assertEqual(reader.read_messages(64), ([], True))
+
+    def test_acknowledgement_is_built_once_per_second(self):
+        with patch("utils.time.time", return_value=1727190960.5):
+            first = create_acknowledgement()
+            self.assertIs(create_acknowledgement(), first)
+        with patch("utils.time.time", return_value=1727190961.2):
+            second = create_acknowledgement()
+        self.assertNotEqual(second, first)
+        self.assertEqual(len(second), len(first))
+        self.assertTrue(second.endswith(b"||ACK||P|2.5\rMSA|AA|\r\x1c\r"))
+
     @patch("utils.datetime")
     def test_calculate_age(self, mock_datetime):
         # Set the current date to May 21, 2021 for consistent testing